@@ -0,0 +1,163 @@
+#/usr/bin/env python
+#
+# adaptive_slices  Store probe histograms at a coarse timeslice normally and at
+#                  a fine timeslice around latency anomalies. The collector
+#                  samples fine slices into a ring kept in memory. Slices
+#                  leaving the ring are merged into coarse slices. When a slice
+#                  looks anomalous compared to the rest of the ring (a jump in
+#                  a probe's p99, or in the rate of failed ters) the ring, and
+#                  the slices that follow for a while, are stored as they are.
+#                  Every fine slice is stored exactly once, either on its own or
+#                  as part of a coarse slice, so the totals are the same as with
+#                  a fixed timeslice.
+
+from collections import deque
+
+from histogram import TER_FIRST_BIN
+
+
+class Slice:
+    def __init__(self, timestamp, timings, ters):
+        self.timestamp = timestamp
+        # Histograms keyed on (table, probe id, tgid), and (probe id, tgid)
+        self.timings = timings
+        self.ters = ters
+        # stored on its own, so it's not part of a coarse slice
+        self.stored = False
+
+
+def _add(total, histograms, sign=1):
+    for key, h in histograms.items():
+        if key in total:
+            total[key] = total[key] + h if sign > 0 else total[key] - h
+        else:
+            total[key] = h
+
+
+def _failure_rate(h):
+    total = h.total()
+    if total == 0:
+        return 0
+    return 1 - h.counts[0 - TER_FIRST_BIN] / total
+
+
+class AdaptiveSlices:
+    def __init__(self,
+                 write,
+                 coarse_slices,
+                 ring_size=120,
+                 after=60,
+                 jump_bins=2,
+                 min_count=20,
+                 ter_factor=4,
+                 min_failure_rate=0.05):
+        '''
+        `write(timestamp, timings, ters)` stores a slice. Slices are merged
+        `coarse_slices` at a time. An anomaly stores the `ring_size` slices
+        before it and the `after` slices after it at full resolution. A slice
+        is anomalous when a probe's p99 is `jump_bins` log2 bins above the p99
+        of the ring, or its rate of failed ters is `ter_factor` times that of
+        the ring (and at least `min_failure_rate`). Only probes with
+        `min_count` calls in the slice are checked.
+        '''
+        self.write = write
+        self.coarse_slices = coarse_slices
+        self.ring = deque()
+        self.ring_size = ring_size
+        self.after = after
+        self.jump_bins = jump_bins
+        self.min_count = min_count
+        self.ter_factor = ter_factor
+        self.min_failure_rate = min_failure_rate
+        # sums of the histograms of the ring, the baseline for anomalies
+        self.baseline_timings = {}
+        self.baseline_ters = {}
+        # slices merged into the next coarse slice
+        self.coarse = []
+        # fine slices still to store after the last anomaly
+        self.fine_left = 0
+
+    def anomalies(self, s):
+        '''Reasons the slice is anomalous, empty if it's not'''
+        reasons = []
+        for key, h in s.timings.items():
+            table, probe_id, tgid = key
+            base = self.baseline_timings.get(key)
+            if table != 'timings' or base is None:
+                continue
+            if h.total() < self.min_count or base.total() < self.min_count:
+                continue
+            p99, base_p99 = h.percentile(99), base.percentile(99)
+            if p99 >= base_p99 + self.jump_bins:
+                reasons.append(f'probe {probe_id} (pid {tgid}) p99 went from '
+                               f'bin {base_p99:.0f} to {p99:.0f}')
+        for key, h in s.ters.items():
+            probe_id, tgid = key
+            base = self.baseline_ters.get(key)
+            if base is None or h.total() < self.min_count:
+                continue
+            rate, base_rate = _failure_rate(h), _failure_rate(base)
+            if rate >= max(base_rate * self.ter_factor, self.min_failure_rate):
+                reasons.append(f'probe {probe_id} (pid {tgid}) failures went '
+                               f'from {base_rate:.1%} to {rate:.1%}')
+        return reasons
+
+    def add(self, timestamp, timings, ters):
+        '''
+        Add a fine slice of timings and ters (Histograms keyed as in `Slice`).
+        Returns the reasons the slice is anomalous.
+        '''
+        # probes that weren't called aren't kept
+        s = Slice(timestamp, {k: h
+                              for k, h in timings.items() if h.total()},
+                  {k: h
+                   for k, h in ters.items() if h.total()})
+        reasons = self.anomalies(s)
+        if reasons:
+            # the coarse slice in progress is older than the ring, store it
+            # first so slices are stored in time order
+            self._write_coarse()
+            # store the ring leading up to the anomaly
+            for r in self.ring:
+                self._store(r)
+            self.fine_left = self.after + 1
+        if self.fine_left:
+            self.fine_left -= 1
+            self._store(s)
+        self.ring.append(s)
+        _add(self.baseline_timings, s.timings)
+        _add(self.baseline_ters, s.ters)
+        while len(self.ring) > self.ring_size:
+            self._retire(self.ring.popleft())
+        return reasons
+
+    def _store(self, s):
+        if not s.stored:
+            self.write(s.timestamp, s.timings, s.ters)
+            s.stored = True
+
+    def _retire(self, s):
+        '''Drop a slice from the ring into the next coarse slice'''
+        _add(self.baseline_timings, s.timings, -1)
+        _add(self.baseline_ters, s.ters, -1)
+        if not s.stored:
+            self.coarse.append(s)
+            if len(self.coarse) >= self.coarse_slices:
+                self._write_coarse()
+
+    def _write_coarse(self):
+        if not self.coarse:
+            return
+        timings, ters = {}, {}
+        for s in self.coarse:
+            _add(timings, s.timings)
+            _add(ters, s.ters)
+        # stamped like a slice of the fixed timeslice: when it ended
+        self.write(self.coarse[-1].timestamp, timings, ters)
+        self.coarse = []
+
+    def flush(self):
+        '''Store everything not stored yet, in coarse slices'''
+        while self.ring:
+            self._retire(self.ring.popleft())
+        self._write_coarse()
@@ -0,0 +1,323 @@
+#/usr/bin/env python
+#
+# collection_db   Database the collected probe data is stored in. This is kept
+#                 separate from the collector so tools that don't need bcc can
+#                 write collection databases.
+
+from contextlib import contextmanager
+import sqlite3
+
+
+class DB:
+    def __init__(self, file_name='data.db'):
+        self.file_name = file_name
+        self.conn = sqlite3.connect(self.file_name)
+        # set inside `transaction`, the add_ methods don't commit
+        self.in_transaction = False
+        # create tables, if needed
+        if not self.has_table('probes'):
+            print('Creating db tables')
+            self.create_tables()
+        else:
+            self.upgrade_tables()
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        if not self.in_transaction:
+            self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Commit everything added in the block at once, or nothing if the block
+        raises
+        '''
+        self.in_transaction = True
+        try:
+            yield
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self.in_transaction = False
+
+    def create_tables(self):
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE collections (id INTEGER PRIMARY KEY ASC,
+                                  start INTEGER, end INTEGER, git_commit TEXT);
+        ''')
+        c.execute('''
+        CREATE TABLE probes (id INTEGER PRIMARY KEY ASC, description TEXT);
+        ''')
+        # N.B. sqlite was not comipled with foreign key support on my dev machine.
+        # the following will not work
+        # CREATE TABLE timings (FOREIGN KEY (probe_id) REFERENCES probes(id)...
+        c.execute('''
+        CREATE TABLE timings (probe_id INTEGER, timestamp INTEGER,
+                              log_bin INTEGER, counts INTEGER,
+                              node INTEGER DEFAULT 0);
+        ''')
+        self.create_self_timings_table()
+        c.execute('''
+        CREATE TABLE ters (probe_id INTEGER, timestamp INTEGER,
+                           ter INTEGER, counts INTEGER,
+                           node INTEGER DEFAULT 0);
+        ''')
+
+        # store the version and other info as tags
+        c.execute('''
+        CREATE TABLE tags (collection_id INTEGER, tag TEXT);
+        ''')
+        c.execute('''
+        CREATE TABLE transactions (id CHARACTER(64),
+              type INTEGER, timestamp INTEGER, duration INTEGER, ter INTEGER,
+              node INTEGER DEFAULT 0, offcpu INTEGER, futex INTEGER);
+        ''')
+        c.execute('''
+        CREATE INDEX IdIndex ON transactions (id);
+        ''')
+        self.create_nodes_table()
+        self.create_collection_nodes_table()
+        self.create_profile_tables()
+        self.create_load_tables()
+        # probes are added with `add_probe` as they are first traced
+        self.conn.commit()
+
+    def create_self_timings_table(self):
+        # self (exclusive) time of a probe: the time not spent in other
+        # probes called from it. Same layout as timings.
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE self_timings (probe_id INTEGER, timestamp INTEGER,
+                                   log_bin INTEGER, counts INTEGER,
+                                   node INTEGER DEFAULT 0);
+        ''')
+
+    def create_nodes_table(self):
+        # the rippled instance a row was collected from. Node 0 is used for
+        # rows collected before nodes were tracked.
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE nodes (id INTEGER PRIMARY KEY ASC, name TEXT UNIQUE);
+        ''')
+        c.execute('''INSERT INTO nodes VALUES (0, 'default');''')
+
+    def create_collection_nodes_table(self):
+        # nodes a collection has data for. Collections from different nodes
+        # may overlap in time once several databases are merged.
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE collection_nodes (collection_id INTEGER, node INTEGER);
+        ''')
+
+    def create_profile_tables(self):
+        # sampled stacks. Function names and stacks are stored once, the
+        # samples reference them.
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE frames (id INTEGER PRIMARY KEY ASC, name TEXT UNIQUE);
+        ''')
+        # comma separated frame ids, root first
+        c.execute('''
+        CREATE TABLE stacks (id INTEGER PRIMARY KEY ASC, frames TEXT UNIQUE);
+        ''')
+        c.execute('''
+        CREATE TABLE stack_samples (timestamp INTEGER, stack_id INTEGER,
+                                    counts INTEGER, node INTEGER DEFAULT 0);
+        ''')
+        c.execute('''
+        CREATE INDEX StackSamplesTimeIndex ON stack_samples (timestamp);
+        ''')
+
+    def create_load_tables(self):
+        # load of the traced process every timeslice: the cpu use and context
+        # switches of its threads, summed over threads with the same name
+        # (less any number), and the number of transactions of every type.
+        # `seconds` is the length of the slice.
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE thread_names (id INTEGER PRIMARY KEY ASC, name TEXT UNIQUE);
+        ''')
+        c.execute('''
+        CREATE TABLE thread_load (timestamp INTEGER, node INTEGER,
+                                  thread_id INTEGER, threads INTEGER,
+                                  cpu INTEGER, switches INTEGER, seconds REAL);
+        ''')
+        c.execute('''
+        CREATE TABLE tx_counts (timestamp INTEGER, node INTEGER, type INTEGER,
+                                counts INTEGER, seconds REAL);
+        ''')
+
+    def has_table(self, name):
+        c = self.conn.cursor()
+        c.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?;",
+            (name, ))
+        return c.fetchone()[0] != 0
+
+    def upgrade_tables(self):
+        '''Add the tables and columns newer collectors use to an existing db'''
+        if not self.has_table('nodes'):
+            self.create_nodes_table()
+        if not self.has_table('collection_nodes'):
+            self.create_collection_nodes_table()
+        if not self.has_table('frames'):
+            self.create_profile_tables()
+        if not self.has_table('self_timings'):
+            self.create_self_timings_table()
+        if not self.has_table('thread_load'):
+            self.create_load_tables()
+        c = self.conn.cursor()
+        for table in ['timings', 'ters', 'transactions']:
+            columns = [r[1] for r in c.execute(f'PRAGMA table_info({table});')]
+            if 'node' not in columns:
+                c.execute(
+                    f'ALTER TABLE {table} ADD COLUMN node INTEGER DEFAULT 0;')
+        columns = [
+            r[1] for r in c.execute('PRAGMA table_info(transactions);')
+        ]
+        # wait times, null unless collected in off-cpu mode
+        for column in ['offcpu', 'futex']:
+            if column not in columns:
+                c.execute(
+                    f'ALTER TABLE transactions ADD COLUMN {column} INTEGER;')
+        self.conn.commit()
+
+    def add_node(self, name):
+        '''Return the id of the node with the given name, adding it if needed'''
+        c = self.conn.cursor()
+        c.execute('INSERT OR IGNORE INTO nodes (name) VALUES (?);', (name, ))
+        c.execute('SELECT id FROM nodes WHERE name = ?;', (name, ))
+        node_id = c.fetchone()[0]
+        self.commit()
+        return node_id
+
+    def add_probe(self, description):
+        '''Return the id of the probe with the given description, adding it if needed'''
+        c = self.conn.cursor()
+        c.execute('SELECT id FROM probes WHERE description = ?;',
+                  (description, ))
+        r = c.fetchone()
+        if r:
+            return r[0]
+        c.execute('INSERT INTO probes (description) VALUES (?);',
+                  (description, ))
+        self.commit()
+        return c.lastrowid
+
+    def add_frame(self, name):
+        '''Return the id of the frame with the given function name, adding it if needed'''
+        c = self.conn.cursor()
+        c.execute('INSERT OR IGNORE INTO frames (name) VALUES (?);', (name, ))
+        c.execute('SELECT id FROM frames WHERE name = ?;', (name, ))
+        return c.fetchone()[0]
+
+    def add_stack(self, frame_ids):
+        '''Return the id of the stack of frame ids (root first), adding it if needed'''
+        frames = ','.join(map(str, frame_ids))
+        c = self.conn.cursor()
+        c.execute('INSERT OR IGNORE INTO stacks (frames) VALUES (?);',
+                  (frames, ))
+        c.execute('SELECT id FROM stacks WHERE frames = ?;', (frames, ))
+        return c.fetchone()[0]
+
+    def add_stack_samples(self, timestamp, samples):
+        '''`samples` is a list of (stack_id, count, node) tuples'''
+        c = self.conn.cursor()
+        values = [(timestamp, stack_id, int(count), node)
+                  for stack_id, count, node in samples if count]
+        if values:
+            c.executemany(
+                'INSERT INTO stack_samples (timestamp, stack_id, counts, node) VALUES (?, ?, ?, ?);',
+                values)
+        self.commit()
+
+    def add_thread_name(self, name):
+        '''Return the id of the thread group with the given name, adding it if needed'''
+        c = self.conn.cursor()
+        c.execute('INSERT OR IGNORE INTO thread_names (name) VALUES (?);',
+                  (name, ))
+        c.execute('SELECT id FROM thread_names WHERE name = ?;', (name, ))
+        return c.fetchone()[0]
+
+    def add_thread_load(self, timestamp, seconds, load, node=0):
+        '''`load` is a list of (thread id, threads, cpu usec, context switches)'''
+        c = self.conn.cursor()
+        values = [(timestamp, node, thread_id, int(threads), int(cpu),
+                   int(switches), seconds)
+                  for thread_id, threads, cpu, switches in load]
+        if values:
+            c.executemany(
+                'INSERT INTO thread_load (timestamp, node, thread_id, threads, cpu, switches, seconds) VALUES (?, ?, ?, ?, ?, ?, ?);',
+                values)
+        self.commit()
+
+    def add_tx_counts(self, timestamp, seconds, counts, node=0):
+        '''`counts` maps transaction type to the number of transactions'''
+        c = self.conn.cursor()
+        values = [(timestamp, node, tx_type, int(n), seconds)
+                  for tx_type, n in counts.items() if n]
+        if values:
+            c.executemany(
+                'INSERT INTO tx_counts (timestamp, node, type, counts, seconds) VALUES (?, ?, ?, ?, ?);',
+                values)
+        self.commit()
+
+    def add_timing(self, probe_id, timestamp, histogram, node=0,
+                   table='timings'):
+        '''
+        Add the non zero bins of a log2 `histogram.Histogram`. `table` is
+        timings for inclusive time or self_timings for self time
+        '''
+        c = self.conn.cursor()
+        bins, counts = histogram.to_rows()
+        values = [(probe_id, timestamp, b, v, node)
+                  for b, v in zip(bins.tolist(), counts.tolist())]
+        if values:
+            c.executemany(
+                f'INSERT INTO {table} (probe_id, timestamp, log_bin, counts, node) VALUES (?, ?, ?, ?, ?);',
+                values)
+        self.commit()
+
+    def add_ters(self, probe_id, timestamp, histogram, node=0):
+        '''Add the non zero bins of a ter `histogram.Histogram`'''
+        c = self.conn.cursor()
+        ters, counts = histogram.to_rows()
+        values = [(probe_id, timestamp, ter, v, node)
+                  for ter, v in zip(ters.tolist(), counts.tolist())]
+        if values:
+            c.executemany(
+                'INSERT INTO ters (probe_id, timestamp, ter, counts, node) VALUES (?, ?, ?, ?, ?);',
+                values)
+        self.commit()
+
+    def add_collection(self, start, end, commit, tags, nodes=()):
+        c = self.conn.cursor()
+        values = (start, end, commit)
+        c.execute(
+            'INSERT INTO collections (start, end, git_commit) VALUES (?, ?, ?);',
+            values)
+        values = []
+        collection_id = c.lastrowid
+        for t in tags:
+            values.append((collection_id, t))
+        c.executemany('INSERT INTO tags VALUES (?,?);', values)
+        c.executemany('INSERT INTO collection_nodes VALUES (?,?);',
+                      [(collection_id, n) for n in nodes])
+        self.commit()
+        return collection_id
+
+    def add_tx(self, txid_hex, timestamp, duration, tx_type, ter, node=0,
+               offcpu=None, futex=None):
+        '''`offcpu` and `futex` are the wait times (nsec) in off-cpu mode'''
+        c = self.conn.cursor()
+        values = (txid_hex, timestamp, duration, tx_type, ter, node, offcpu,
+                  futex)
+        c.execute(
+            'INSERT INTO transactions (id, timestamp, duration, type, ter, node, offcpu, futex) VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+            values)
+        self.commit()
@@ -0,0 +1,315 @@
+#/usr/bin/env python
+#
+# fleet_merge   Merge the collection databases from many nodes into a single
+#               database the reports can open. Source databases are read in
+#               parallel, one per worker process. Merged collections are
+#               remembered, so rerunning the merge only copies new collections,
+#               and a transaction already in the db (the same id, node,
+#               timestamp and duration, from a copy of a source) is stored once.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import os
+import pandas as pd
+import sqlite3
+
+from collection_db import DB
+
+
+def source_key(path):
+    return os.path.realpath(path)
+
+
+def default_node_name(path):
+    '''Name for rows collected before nodes were tracked: the db file name'''
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _has_column(conn, table, column):
+    return column in [
+        r[1] for r in conn.execute(f'PRAGMA table_info({table});')
+    ]
+
+
+def _has_table(conn, table):
+    c = conn.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?;",
+        (table, ))
+    return c.fetchone()[0] != 0
+
+
+def read_source(path, merged_ids):
+    '''
+    Read the collections of a source database that are not in `merged_ids`,
+    along with their tags, nodes and data. This runs in a worker process.
+    '''
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    collections = pd.read_sql_query(
+        'select * from collections order by start;', conn)
+    # a collection's window ends where the next one of the source starts, if
+    # that's before its end, so the windows don't overlap
+    next_start = collections['start'].shift(-1)
+    collections = collections.assign(window_end=next_start.where(
+        next_start <= collections['end']))
+    collections = collections[~collections['id'].isin(merged_ids)]
+    result = {'path': path, 'collections': collections.drop(
+        columns=['window_end'])}
+    if collections.empty:
+        return result
+
+    ids = ','.join(map(str, collections['id']))
+    result['tags'] = pd.read_sql_query(
+        f'select * from tags where collection_id in ({ids});', conn)
+    result['probes'] = pd.read_sql_query('select * from probes;', conn)
+    if _has_table(conn, 'nodes'):
+        result['nodes'] = pd.read_sql_query('select * from nodes;', conn)
+    else:
+        result['nodes'] = pd.DataFrame({'id': [0], 'name': ['default']})
+    if _has_table(conn, 'collection_nodes'):
+        result['collection_nodes'] = pd.read_sql_query(
+            f'select * from collection_nodes where collection_id in ({ids});',
+            conn)
+    else:
+        result['collection_nodes'] = pd.DataFrame(
+            {'collection_id': [], 'node': []})
+
+    # data is associated with a collection by its time range
+    windows = []
+    for start, end, window_end in zip(collections['start'],
+                                      collections['end'],
+                                      collections['window_end']):
+        if pd.isna(window_end):
+            end_clause = f'timestamp <= {end}'
+        else:
+            end_clause = f'timestamp < {int(window_end)}'
+        windows.append(f'(timestamp >= {start} and {end_clause})')
+    where_clause = 'where ' + ' or '.join(windows)
+    columns = {
+        'timings': 'probe_id, timestamp, log_bin, counts',
+        'self_timings': 'probe_id, timestamp, log_bin, counts',
+        'ters': 'probe_id, timestamp, ter, counts',
+        'transactions': 'id, type, timestamp, duration, ter',
+        'thread_load': 'timestamp, thread_id, threads, cpu, switches, seconds',
+        'tx_counts': 'timestamp, type, counts, seconds'
+    }
+    # columns added later, null in older databases
+    optional_columns = {'transactions': ['offcpu', 'futex']}
+    for table, cols in columns.items():
+        optional = optional_columns.get(table, [])
+        if not _has_table(conn, table):
+            # collected before the table was added
+            result[table] = pd.DataFrame(
+                columns=[c.strip() for c in cols.split(',')] + optional +
+                ['node'])
+            continue
+        for c in optional:
+            cols += ', ' + (c if _has_column(conn, table, c) else
+                            f'NULL as {c}')
+        node = 'node' if _has_column(conn, table, 'node') else '0 as node'
+        result[table] = pd.read_sql_query(
+            f'select {cols}, {node} from {table} {where_clause};', conn)
+    if _has_table(conn, 'thread_names'):
+        result['thread_names'] = pd.read_sql_query(
+            'select * from thread_names;', conn)
+    else:
+        result['thread_names'] = pd.DataFrame({'id': [], 'name': []})
+    if _has_table(conn, 'stack_samples'):
+        result['stack_samples'] = pd.read_sql_query(
+            f'select timestamp, stack_id, counts, node from stack_samples {where_clause};',
+            conn)
+        result['stacks'] = pd.read_sql_query(
+            f'select * from stacks where id in (select stack_id from stack_samples {where_clause});',
+            conn)
+        result['frames'] = pd.read_sql_query('select * from frames;', conn)
+    else:
+        # collected before stacks were sampled
+        result['stack_samples'] = pd.DataFrame(
+            columns=['timestamp', 'stack_id', 'counts', 'node'])
+        result['stacks'] = pd.DataFrame({'id': [], 'frames': []})
+        result['frames'] = pd.DataFrame({'id': [], 'name': []})
+    return result
+
+
+class FleetDB(DB):
+    '''Consolidated database of collections merged from many nodes'''
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        c = self.conn.cursor()
+        # maps the collections in the source databases to merged collections
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS merged_collections (source TEXT,
+               source_id INTEGER, collection_id INTEGER,
+               PRIMARY KEY (source, source_id));
+        ''')
+        # a node may apply a transaction more than once, so (id, node) isn't
+        # unique, but the same application is only stored once even if its
+        # source is merged again under another name
+        c.execute('''
+        DROP INDEX IF EXISTS TxNodeIndex;
+        ''')
+        c.execute('''
+        DELETE FROM transactions WHERE rowid NOT IN (SELECT min(rowid)
+               FROM transactions GROUP BY id, node, timestamp, duration);
+        ''')
+        c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS TxApplyIndex
+               ON transactions (id, node, timestamp, duration);
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS TimingsTimeIndex ON timings (timestamp);
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS SelfTimingsTimeIndex ON self_timings (timestamp);
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS TersTimeIndex ON ters (timestamp);
+        ''')
+        self.conn.commit()
+
+    def merged_ids(self, path):
+        c = self.conn.cursor()
+        c.execute('SELECT source_id FROM merged_collections WHERE source = ?;',
+                  (source_key(path), ))
+        return [r[0] for r in c.fetchall()]
+
+    def merge(self, data):
+        '''
+        Add the data read by `read_source`. Return the number of new
+        collections. A source is merged in one transaction, so a failed merge
+        leaves nothing behind and is redone by the next run.
+        '''
+        if data['collections'].empty:
+            return 0
+        with self.transaction():
+            return self._merge(data)
+
+    def _merge(self, data):
+        collections = data['collections']
+        path = data['path']
+
+        node_map = {}
+        for node_id, name in zip(data['nodes']['id'], data['nodes']['name']):
+            if node_id == 0:
+                name = default_node_name(path)
+            node_map[node_id] = self.add_node(name)
+        probe_map = {
+            probe_id: self.add_probe(description)
+            for probe_id, description in zip(data['probes']['id'],
+                                             data['probes']['description'])
+        }
+
+        thread_map = {
+            thread_id: self.add_thread_name(name)
+            for thread_id, name in zip(data['thread_names']['id'],
+                                       data['thread_names']['name'])
+        }
+
+        c = self.conn.cursor()
+        for t in [
+                'timings', 'self_timings', 'ters', 'transactions',
+                'thread_load', 'tx_counts'
+        ]:
+            df = data[t].copy()
+            df['node'] = df['node'].fillna(0).astype(int).map(node_map)
+            if 'probe_id' in df:
+                df['probe_id'] = df['probe_id'].map(probe_map)
+            if 'thread_id' in df:
+                df['thread_id'] = df['thread_id'].map(thread_map)
+            self._insert(t, df)
+
+        frame_map = {
+            frame_id: self.add_frame(name)
+            for frame_id, name in zip(data['frames']['id'],
+                                      data['frames']['name'])
+        }
+        stack_map = {
+            stack_id: self.add_stack(
+                [frame_map[int(f)] for f in frames.split(',') if f])
+            for stack_id, frames in zip(data['stacks']['id'],
+                                        data['stacks']['frames'])
+        }
+        df = data['stack_samples'].copy()
+        df['node'] = df['node'].fillna(0).astype(int).map(node_map)
+        df['stack_id'] = df['stack_id'].map(stack_map)
+        self._insert('stack_samples', df)
+
+        tags = data['tags']
+        collection_nodes = data['collection_nodes']
+        all_nodes = sorted(
+            set(data['timings']['node']) | set(data['ters']['node'])
+            | set(data['transactions']['node']))
+        for row in collections.itertuples(index=False):
+            nodes = collection_nodes.loc[collection_nodes['collection_id'] ==
+                                         row.id, 'node']
+            if nodes.empty:
+                # collected before nodes were tracked, the db had one node
+                nodes = all_nodes or [0]
+            nodes = sorted(set(node_map[n] for n in nodes))
+            collection_id = self.add_collection(
+                row.start, row.end, row.git_commit,
+                tags.loc[tags['collection_id'] == row.id, 'tag'], nodes)
+            c.execute('INSERT INTO merged_collections VALUES (?, ?, ?);',
+                      (source_key(path), row.id, collection_id))
+        return len(collections)
+
+    def _insert(self, table, df):
+        columns = ', '.join(df.columns)
+        placeholders = ', '.join('?' * len(df.columns))
+        # transactions already merged from a copy of the source are skipped
+        ignore = ' OR IGNORE' if table == 'transactions' else ''
+        self.conn.cursor().executemany(
+            f'INSERT{ignore} INTO {table} ({columns}) VALUES ({placeholders});',
+            df.itertuples(index=False, name=None))
+
+
+def source_files(sources, exclude):
+    '''Expand directories into the db files they contain'''
+    result = []
+    for s in sources:
+        if os.path.isdir(s):
+            result.extend(sorted(glob.glob(os.path.join(s, '*.db'))))
+        else:
+            result.append(s)
+    return [f for f in result if source_key(f) != source_key(exclude)]
+
+
+def run(db_file, sources, jobs=None):
+    db = FleetDB(db_file)
+    files = source_files(sources, db_file)
+    merged = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(read_source, f, db.merged_ids(f)): f
+            for f in files
+        }
+        for future in as_completed(futures):
+            try:
+                n = db.merge(future.result())
+            except (sqlite3.Error, pd.errors.DatabaseError) as e:
+                print(f'Skipping {futures[future]}: {e}')
+                continue
+            merged += n
+            if n:
+                print(f'Merged {n} collections from {futures[future]}')
+    print(f'Merged {merged} new collections from {len(files)} databases')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Merge collection databases from many nodes into one")
+    parser.add_argument(
+        "--db", required=True, help="Database file to merge the results into")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of worker processes. Defaults to the number of cpus")
+    parser.add_argument(
+        "sources",
+        nargs='+',
+        help="Collection databases, or directories of .db files, to merge")
+    args = parser.parse_args()
+
+    run(args.db, args.sources, args.jobs)
@@ -0,0 +1,267 @@
+#/usr/bin/env python
+#
+# histogram     Histograms of integer bins backed by numpy arrays. Used for the
+#               log2 usec timing histograms and the ter histograms by the
+#               collector, the dbs and the reports. A Histogram may be a stack
+#               of histograms (one per timeslice, for example): the last axis
+#               of `counts` is the bins and operations apply to every
+#               histogram of the stack at once.
+
+import numpy as np
+import pandas as pd
+
+# log2 usec bins of the timing histograms (bpf_log2l of the usec)
+LOG2_BINS = 64
+# ters of the ters table: negative return codes down to -399 (the negs
+# histogram) through tec codes up to 150
+TER_FIRST_BIN = -399
+TER_BINS = 551
+
+
+def log2_bins(values):
+    '''
+    bpf_log2l bins of non negative integers: the bit length of the value, and
+    1 for 0 (bpf_log2l puts 0 and 1 in the same bin)
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    # v = m * 2^e with 0.5 <= m < 1, so e is the bit length (0 for 0)
+    _, exponents = np.frexp(values.astype(np.float64))
+    exponents = exponents.astype(np.int64)
+    # values above 2^53 may round up to the next power of two as floats
+    exponents -= values < np.left_shift(1, np.maximum(exponents - 1, 0))
+    return np.maximum(exponents, 1)
+
+
+class Histogram:
+    def __init__(self, counts, first_bin=0):
+        '''`counts` is indexed on bin - `first_bin` in the last axis'''
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.first_bin = first_bin
+
+    @classmethod
+    def zeros(cls, num_bins, first_bin=0, shape=()):
+        return cls(np.zeros((*shape, num_bins), dtype=np.int64), first_bin)
+
+    @classmethod
+    def from_rows(cls, bins, counts, num_bins, first_bin=0, index=None,
+                  size=None):
+        '''
+        Histogram of sparse (bin, count) rows, as stored in the timings and
+        ters tables. With `index` the rows are added to the `index`th
+        histogram of a stack of `size` histograms. Rows with bins out of range
+        are dropped.
+        '''
+        offsets = np.asarray(bins, dtype=np.int64) - first_bin
+        counts = np.asarray(counts, dtype=np.int64)
+        keep = (offsets >= 0) & (offsets < num_bins)
+        if index is None:
+            return cls(
+                np.bincount(
+                    offsets[keep], weights=counts[keep],
+                    minlength=num_bins), first_bin)
+        flat = np.asarray(index, dtype=np.int64)[keep] * num_bins + offsets[keep]
+        result = np.bincount(
+            flat, weights=counts[keep], minlength=size * num_bins)
+        return cls(result.reshape(size, num_bins), first_bin)
+
+    @classmethod
+    def from_frame(cls, df, keys, bin_column, num_bins, first_bin=0):
+        '''
+        Stack of the histograms of the rows of a timings or ters data frame
+        with the same `keys` columns. Returns a data frame of the keys (sorted)
+        and the stack, with a histogram for every row of the keys.
+        '''
+        if df.empty:
+            return (pd.DataFrame({k: [] for k in keys}),
+                    cls.zeros(num_bins, first_bin, (0, )))
+        groups = df.groupby(keys, sort=True)
+        key_frame = groups.size().reset_index()[keys]
+        return key_frame, cls.from_rows(
+            df[bin_column], df['counts'], num_bins, first_bin,
+            groups.ngroup().to_numpy(), len(key_frame))
+
+    def to_rows(self):
+        '''
+        Sparse rows of the non zero bins: (bins, counts), preceded by the
+        index of the histogram in the stack for every stack axis
+        '''
+        index = np.nonzero(self.counts)
+        return (*index[:-1], index[-1] + self.first_bin, self.counts[index])
+
+    @property
+    def num_bins(self):
+        return self.counts.shape[-1]
+
+    @property
+    def bins(self):
+        return np.arange(self.first_bin, self.first_bin + self.num_bins)
+
+    def __getitem__(self, index):
+        '''Histograms of a stack. The index must not select bins'''
+        return Histogram(self.counts[index], self.first_bin)
+
+    def _check(self, other):
+        if (self.first_bin, self.num_bins) != (other.first_bin,
+                                               other.num_bins):
+            raise ValueError('histograms have different bins')
+
+    def __add__(self, other):
+        self._check(other)
+        return Histogram(self.counts + other.counts, self.first_bin)
+
+    def __sub__(self, other):
+        self._check(other)
+        return Histogram(self.counts - other.counts, self.first_bin)
+
+    def __iadd__(self, other):
+        self._check(other)
+        self.counts += other.counts
+        return self
+
+    def add_values(self, values):
+        '''Count log2 values (see `log2_bins`). Larger values go in the last bin'''
+        offsets = np.clip(
+            log2_bins(values) - self.first_bin, 0, self.num_bins - 1)
+        np.add.at(self.counts, offsets, 1)
+
+    def merge(self, axis=0):
+        '''Sum of the histograms of a stack'''
+        return Histogram(self.counts.sum(axis=axis), self.first_bin)
+
+    def coarsen(self, factor):
+        '''
+        Stack with the sum of every `factor` consecutive histograms of this
+        stack (the last one may have fewer)
+        '''
+        if len(self.counts) == 0:
+            return self
+        starts = np.arange(0, len(self.counts), factor)
+        return Histogram(
+            np.add.reduceat(self.counts, starts, axis=0), self.first_bin)
+
+    def rebin(self, factor):
+        '''Combine every `factor` bins: bin b is counted in bin b // factor'''
+        first_bin = self.first_bin // factor
+        left = self.first_bin - first_bin * factor
+        right = -(self.num_bins + left) % factor
+        pad = [(0, 0)] * (self.counts.ndim - 1) + [(left, right)]
+        counts = np.pad(self.counts, pad)
+        return Histogram(
+            counts.reshape(*counts.shape[:-1], -1, factor).sum(axis=-1),
+            first_bin)
+
+    def total(self):
+        return self.counts.sum(axis=-1)
+
+    def _bin_where(self, mask, last=False):
+        '''First (or last) bin where mask is set, nan where it's never set'''
+        if last:
+            offsets = self.num_bins - 1 - np.argmax(mask[..., ::-1], axis=-1)
+        else:
+            offsets = np.argmax(mask, axis=-1)
+        return np.where(mask.any(axis=-1), offsets + self.first_bin, np.nan)
+
+    def percentile(self, q):
+        '''Bin holding the `q` percentile, nan for empty histograms'''
+        total = self.total()
+        cumulative = np.cumsum(self.counts, axis=-1)
+        return self._bin_where(
+            (cumulative >= q / 100 * total[..., np.newaxis])
+            & (total[..., np.newaxis] > 0))
+
+    def min_bin(self):
+        return self._bin_where(self.counts != 0)
+
+    def max_bin(self):
+        return self._bin_where(self.counts != 0, last=True)
+
+    def mean(self):
+        '''Mean of log2 bins, counting every bin as its upper bound (2^bin)'''
+        total = self.total()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (self.counts * np.exp2(self.bins)).sum(axis=-1) / total
+
+    def log2_stats(self):
+        '''
+        Mean, median, min and max (as log2 of the bin bounds) and count of
+        log2 histograms, as the columns of a data frame
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.log2(self.mean())
+        return {
+            'mean': mean,
+            'median': self.percentile(50),
+            'min': self.min_bin(),
+            'max': self.max_bin(),
+            'count': self.total()
+        }
+
+
+def ter_histogram(result, tecs, negs):
+    '''
+    Histogram of ters from the result (success, failure), tec and negative
+    return code histograms collected by the probes
+    '''
+    h = Histogram.zeros(TER_BINS, TER_FIRST_BIN)
+    # success is ter 0, tec slot i is ter 100 + i and negs slot i is ter -i
+    h.counts[0 - TER_FIRST_BIN] += result.counts[0]
+    h.counts[100 - TER_FIRST_BIN:100 - TER_FIRST_BIN + tecs.num_bins] += tecs.counts
+    h.counts[-np.arange(1, negs.num_bins) - TER_FIRST_BIN] += negs.counts[1:]
+    return h
+
+
+class LogSketch:
+    '''
+    Mergeable quantile sketch of non negative values with a bounded relative
+    error: a value is counted in bin ceil(log_gamma(value)), so every
+    quantile is within `relative_accuracy` of the true value. Sketches of
+    chunks of data can be merged, so quantiles of any amount of data are
+    computed in constant memory.
+    '''
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        # bin -> count, zeros are counted separately as log(0) has no bin
+        self.bins = {}
+        self.zeros = 0
+
+    def add_values(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        positive = values[values > 0]
+        self.zeros += len(values) - len(positive)
+        bins, counts = np.unique(
+            np.ceil(np.log(positive) / self.log_gamma).astype(np.int64),
+            return_counts=True)
+        for b, n in zip(bins.tolist(), counts.tolist()):
+            self.bins[b] = self.bins.get(b, 0) + n
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('sketches have different accuracies')
+        for b, n in other.bins.items():
+            self.bins[b] = self.bins.get(b, 0) + n
+        self.zeros += other.zeros
+        return self
+
+    def count(self):
+        return self.zeros + sum(self.bins.values())
+
+    def quantiles(self, qs):
+        '''Values at the quantiles `qs` (0 to 1), nan if the sketch is empty'''
+        qs = np.atleast_1d(np.asarray(qs, dtype=np.float64))
+        total = self.count()
+        if total == 0:
+            return np.full(len(qs), np.nan)
+        bins = np.array(sorted(self.bins), dtype=np.int64)
+        counts = np.array([self.bins[b] for b in bins], dtype=np.int64)
+        cumulative = self.zeros + np.cumsum(counts)
+        # rank of the quantile, as in numpy's 'lower' interpolation
+        ranks = np.floor(qs * (total - 1))
+        i = np.searchsorted(cumulative, ranks, side='right')
+        # the middle of a bin (in relative terms) is 2 gamma^b / (gamma + 1)
+        values = 2 * np.power(self.gamma, bins[np.minimum(i, len(bins) - 1)]
+                              .astype(np.float64)) / (self.gamma + 1)
+        return np.where(ranks < self.zeros, 0.0, values)
@@ -0,0 +1,109 @@
+#/usr/bin/env python
+#
+# metrics_exporter  Serve the collector's probe histograms and counters over
+#                   http in the OpenMetrics text format, so Prometheus can
+#                   scrape them. The sampler renders a snapshot of the metrics
+#                   and scrapes return the last snapshot as is: a scrape
+#                   never reads the BPF maps or the db.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import threading
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# log2 usec bins of the histograms exported as buckets. Slower calls are only
+# counted in the +Inf bucket.
+MAX_BUCKET = 32
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"'
+                          for k, v in labels.items()) + '}'
+
+
+def _float(value):
+    return repr(float(value))
+
+
+def histogram_family(name, help, series):
+    '''
+    Lines of a histogram family. `series` is a list of (labels, histogram)
+    where the histogram is a log2 usec `histogram.Histogram` (as collected by
+    the probes). Bins are exported as buckets in seconds.
+    '''
+    lines = [
+        f'# TYPE {name} histogram', f'# UNIT {name} seconds',
+        f'# HELP {name} {help}'
+    ]
+    # bin i counts the times under 2^i usec
+    bounds = [_float(2**i / 1e6) for i in range(MAX_BUCKET)]
+    for labels, histogram in series:
+        cumulative = np.cumsum(histogram.counts)
+        count = int(cumulative[-1]) if len(cumulative) else 0
+        for i, le in enumerate(bounds):
+            n = int(cumulative[min(i, len(cumulative) - 1)]) if count else 0
+            lines.append(
+                f'{name}_bucket{_labels({**labels, "le": le})} {n}')
+        lines.append(f'{name}_bucket{_labels({**labels, "le": "+Inf"})} {count}')
+        lines.append(f'{name}_count{_labels(labels)} {count}')
+    return lines
+
+
+def counter_family(name, help, series):
+    '''Lines of a counter family. `series` is a list of (labels, value)'''
+    lines = [f'# TYPE {name} counter', f'# HELP {name} {help}']
+    for labels, value in series:
+        lines.append(f'{name}_total{_labels(labels)} {int(value)}')
+    return lines
+
+
+def render(families):
+    '''OpenMetrics exposition of a list of families (lists of lines)'''
+    lines = [line for family in families for line in family]
+    lines.append('# EOF')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class MetricsExporter:
+    '''Http server of the last metrics snapshot, run on a background thread'''
+
+    def __init__(self, port, address=''):
+        self.snapshot = render([])
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                # the snapshot is replaced, never modified, so no lock is needed
+                body = exporter.snapshot
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # don't log every scrape
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def update(self, families):
+        self.snapshot = render(families)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
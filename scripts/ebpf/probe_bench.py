@@ -0,0 +1,232 @@
+#/usr/bin/env python
+#
+# probe_bench   Measure what the probes of tx_latency.py cost the traced
+#               process, without rippled. Builds probe_bench_target.c (a
+#               program with rippled's probed functions and transactor_exit
+#               USDT), runs it with no probes and then with each collector
+#               mode attached, and reports the time added to every call and
+#               the throughput lost. Needs root, bcc and a C compiler.
+
+import argparse
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import time
+
+from collection_db import DB
+from probe_catalog import DEFAULT_CATALOG, load_catalog, resolve_probes
+from symbol_index import symbol_index
+from tx_latency import TXLatency, TXProfiler, TXUSDTProbes
+
+TARGET_SOURCE = os.path.dirname(
+    os.path.realpath(__file__)) + '/probe_bench_target.c'
+
+# collector modes, in the order they are run. `all` is what tx_latency.py
+# attaches with off-cpu mode and the profiler on.
+MODES = ['baseline', 'latency', 'usdt', 'offcpu', 'profile', 'all']
+
+
+def build_target(directory, cc='cc'):
+    '''Compile the target program, return its path'''
+    exe = os.path.join(directory, 'probe_bench_target')
+    # -fno-omit-frame-pointer so the profiler can walk the stacks
+    subprocess.run([
+        cc, '-O2', '-g', '-fno-omit-frame-pointer', '-Wl,--build-id', '-o',
+        exe, TARGET_SOURCE
+    ],
+                   check=True)
+    return exe
+
+
+class Collector:
+    '''The collector objects of a mode, attached to one target process'''
+
+    def __init__(self, mode, pid, exe, db, catalog_file, frequency):
+        targets = [(pid, exe)]
+        node_of = lambda tgid: 0
+        self.latency = None
+        self.usdt = None
+        self.profiler = None
+        if mode in ['latency', 'all']:
+            probes = resolve_probes(
+                load_catalog(catalog_file), targets, symbol_index())
+            for p in probes:
+                p.id = db.add_probe(p.name)
+            self.latency = TXLatency(probes, targets)
+            self.latency.attach_probes()
+        if mode in ['usdt', 'offcpu', 'all']:
+            self.usdt = TXUSDTProbes(
+                db=db,
+                targets=targets,
+                node_of=node_of,
+                offcpu=mode != 'usdt')
+            self.usdt.attach_probes()
+        if mode in ['profile', 'all']:
+            self.profiler = TXProfiler(
+                db=db, targets=targets, node_of=node_of, frequency=frequency)
+            self.profiler.attach_probes()
+
+    def poll(self):
+        '''Drain the events of the per event probes'''
+        if self.usdt:
+            self.usdt.b.perf_buffer_poll(timeout=10)
+        else:
+            time.sleep(0.01)
+
+    def finish(self):
+        '''Read what was collected, so the user space cost is included'''
+        if self.latency:
+            self.latency.dist()
+            self.latency.ters()
+        if self.profiler:
+            self.profiler.sample(int(time.time()))
+        if self.usdt:
+            self.usdt.b.perf_buffer_poll(timeout=10)
+            return self.usdt.lost
+        return 0
+
+    def close(self):
+        for c in [self.latency, self.usdt, self.profiler]:
+            if c is not None:
+                c.b.cleanup()
+
+
+def run_mode(mode, exe, calls, rate, db, catalog_file, frequency):
+    '''
+    Run the target with the mode's probes attached. Returns a dictionary of
+    calls, nsec spent in the calls, nsec elapsed and lost events.
+    '''
+    proc = subprocess.Popen([exe, str(calls), str(rate)],
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    collector = None
+    try:
+        if proc.stdout.readline().strip() != 'ready':
+            raise RuntimeError('the target did not start')
+        if mode != 'baseline':
+            collector = Collector(mode, proc.pid, exe, db, catalog_file,
+                                  frequency)
+        proc.stdin.write('go\n')
+        proc.stdin.flush()
+        while True:
+            ready, _, _ = select.select([proc.stdout], [], [], 0)
+            if ready:
+                break
+            if collector:
+                collector.poll()
+            else:
+                time.sleep(0.01)
+        done, in_calls, elapsed = map(int, proc.stdout.readline().split())
+        lost = collector.finish() if collector else 0
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        if collector:
+            collector.close()
+    return {
+        'calls': done,
+        'in_calls': in_calls,
+        'elapsed': elapsed,
+        'lost': lost
+    }
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def benchmark(modes, calls, rate=0, repeat=3, catalog_file=DEFAULT_CATALOG,
+              frequency=99, cc='cc'):
+    '''
+    Run every mode `repeat` times (interleaved, so drift affects all modes
+    alike) and return a list of result rows, one per mode, with the median
+    nsec per call, nsec added per call and throughput loss (both relative to
+    the baseline).
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        exe = build_target(directory, cc)
+        db = DB(os.path.join(directory, 'bench.db'))
+        runs = {mode: [] for mode in modes}
+        for _ in range(repeat):
+            for mode in modes:
+                runs[mode].append(
+                    run_mode(mode, exe, calls, rate, db, catalog_file,
+                             frequency))
+        db.close()
+
+    rows = []
+    for mode in modes:
+        ns_per_call = median([r['in_calls'] / r['calls'] for r in runs[mode]])
+        throughput = median(
+            [r['calls'] / r['elapsed'] * 1e9 for r in runs[mode]])
+        rows.append({
+            'mode': mode,
+            'ns_per_call': ns_per_call,
+            'calls_per_sec': throughput,
+            'lost': sum(r['lost'] for r in runs[mode])
+        })
+    if 'baseline' in modes:
+        base = rows[modes.index('baseline')]
+        for r in rows:
+            r['added_ns'] = r['ns_per_call'] - base['ns_per_call']
+            r['throughput_loss'] = 1 - r['calls_per_sec'] / base['calls_per_sec']
+    return rows
+
+
+def print_rows(rows, rate):
+    print(f'{"mode":<10} {"ns/call":>10} {"added ns":>10} {"calls/s":>12} '
+          f'{"loss":>7} {"lost":>8}')
+    for r in rows:
+        added = f'{r["added_ns"]:10.0f}' if 'added_ns' in r else f'{"":>10}'
+        # with a fixed rate the throughput is the rate, not a measure
+        loss = f'{r["throughput_loss"]:7.1%}' if 'throughput_loss' in r and not rate else f'{"":>7}'
+        print(f'{r["mode"]:<10} {r["ns_per_call"]:10.0f} {added} '
+              f'{r["calls_per_sec"]:12.0f} {loss} {r["lost"]:8d}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Measure the overhead of the tx_latency probes on a local target program")
+    parser.add_argument(
+        "--mode",
+        action='append',
+        choices=MODES,
+        help="Mode to run. May be repeated. Default is all the modes")
+    parser.add_argument(
+        "--calls",
+        type=int,
+        default=1000000,
+        help="Number of transactor calls of every run")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Transactor calls per second. 0 (the default) calls as fast as possible, to measure throughput")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs of every mode")
+    parser.add_argument(
+        "--catalog",
+        default=DEFAULT_CATALOG,
+        help="Probe catalog of the latency probes")
+    parser.add_argument(
+        "--profile-frequency",
+        type=int,
+        default=99,
+        help="Samples per second of the profile mode")
+    parser.add_argument("--cc", default='cc', help="C compiler")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print('probe_bench needs root to attach probes', file=sys.stderr)
+        sys.exit(1)
+    modes = args.mode or MODES
+    if 'baseline' not in modes:
+        modes = ['baseline'] + modes
+    rows = benchmark(modes, args.calls, args.rate, args.repeat, args.catalog,
+                     args.profile_frequency, args.cc)
+    print_rows(rows, args.rate)
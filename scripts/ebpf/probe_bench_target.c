@@ -0,0 +1,149 @@
+// probe_bench_target  Stand in for rippled when measuring what the probes of
+//                     tx_latency.py cost the traced process (see
+//                     probe_bench.py). It has functions with the mangled
+//                     names the probe catalog and the collector attach to, and
+//                     a `transactor_exit` USDT with the same arguments as
+//                     rippled's: pointers to the 32 byte transaction id, the
+//                     tx type and the ter.
+//
+// Usage: probe_bench_target <calls> [<calls per second>]
+// Prints "ready", waits for a line on stdin (so probes can be attached), runs
+// the calls and prints "<calls> <nsec in the calls> <nsec elapsed>".
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+// The USDT note of sys/sdt.h, written out so the target builds without the
+// systemtap headers. Arguments are 8 byte values in registers.
+#define BENCH_USDT3(provider, name, a1, a2, a3)                             \
+    __asm__ __volatile__(                                                   \
+        "990: nop\n"                                                        \
+        ".pushsection .note.stapsdt,\"?\",\"note\"\n"                       \
+        ".balign 4\n"                                                       \
+        ".4byte 992f-991f, 994f-993f, 3\n"                                  \
+        "991: .asciz \"stapsdt\"\n"                                         \
+        "992: .balign 4\n"                                                  \
+        "993: .8byte 990b\n"                                                \
+        ".8byte _.stapsdt.base\n"                                           \
+        ".8byte 0\n"                                                        \
+        ".asciz \"" #provider "\"\n"                                        \
+        ".asciz \"" #name "\"\n"                                            \
+        ".asciz \"8@%0 8@%1 8@%2\"\n"                                       \
+        "994: .balign 4\n"                                                  \
+        ".popsection\n"                                                     \
+        ".ifndef _.stapsdt.base\n"                                          \
+        ".pushsection .stapsdt.base,\"aG\",\"progbits\",.stapsdt.base,comdat\n" \
+        ".weak _.stapsdt.base\n"                                            \
+        ".hidden _.stapsdt.base\n"                                          \
+        "_.stapsdt.base: .space 1\n"                                        \
+        ".size _.stapsdt.base, 1\n"                                         \
+        ".popsection\n"                                                     \
+        ".endif\n"                                                          \
+        :                                                                   \
+        : "r"(a1), "r"(a2), "r"(a3))
+
+struct tx_t
+{
+    uint8_t id[32];
+    int type;
+    int ter;
+};
+
+// a little work, so a call costs about what a cheap function does
+static volatile uint64_t sink;
+
+// ripple::Payment::preflight(ripple::PreflightContext const&)
+__attribute__((noinline)) int
+preflight(struct tx_t* tx) __asm__("_ZN6ripple7Payment9preflightERKNS_16PreflightContextE");
+__attribute__((noinline)) int
+preflight(struct tx_t* tx)
+{
+    sink += tx->id[0];
+    return 0;
+}
+
+// ripple::Payment::doApply()
+__attribute__((noinline)) int
+do_apply(struct tx_t* tx) __asm__("_ZN6ripple7Payment7doApplyEv");
+__attribute__((noinline)) int
+do_apply(struct tx_t* tx)
+{
+    sink += tx->id[1];
+    return tx->ter;
+}
+
+// ripple::Transactor::operator()()
+__attribute__((noinline)) int
+transactor(struct tx_t* tx) __asm__("_ZN6ripple10TransactorclEv");
+__attribute__((noinline)) int
+transactor(struct tx_t* tx)
+{
+    int ter = preflight(tx);
+    if (ter == 0)
+        ter = do_apply(tx);
+    tx->ter = ter;
+    uint8_t* id = tx->id;
+    int* type = &tx->type;
+    int* ter_ptr = &tx->ter;
+    BENCH_USDT3(ripple, transactor_exit, id, type, ter_ptr);
+    return ter;
+}
+
+static uint64_t
+now_ns(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+int
+main(int argc, char** argv)
+{
+    if (argc < 2)
+    {
+        fprintf(stderr, "usage: %s <calls> [<calls per second>]\n", argv[0]);
+        return 1;
+    }
+    uint64_t calls = strtoull(argv[1], NULL, 10);
+    double rate = argc > 2 ? atof(argv[2]) : 0;
+
+    printf("ready\n");
+    fflush(stdout);
+    char line[16];
+    if (!fgets(line, sizeof(line), stdin))
+        return 1;
+
+    struct tx_t tx;
+    memset(&tx, 0, sizeof(tx));
+    uint64_t in_calls = 0;
+    uint64_t start = now_ns();
+    for (uint64_t i = 0; i < calls; ++i)
+    {
+        // a different id every call, like real transactions
+        memcpy(tx.id, &i, sizeof(i));
+        tx.ter = 0;
+        uint64_t t0 = now_ns();
+        transactor(&tx);
+        in_calls += now_ns() - t0;
+        if (rate > 0)
+        {
+            // wait for the call's turn
+            uint64_t due = start + (uint64_t)((i + 1) * 1e9 / rate);
+            uint64_t t = now_ns();
+            if (due > t)
+            {
+                struct timespec wait = {(due - t) / 1000000000,
+                                        (due - t) % 1000000000};
+                nanosleep(&wait, NULL);
+            }
+        }
+    }
+    uint64_t elapsed = now_ns() - start;
+    printf("%llu %llu %llu\n", (unsigned long long)calls,
+           (unsigned long long)in_calls, (unsigned long long)elapsed);
+    return 0;
+}
@@ -0,0 +1,85 @@
+#/usr/bin/env python
+#
+# probe_catalog Probes to attach, read from a json catalog (see
+#               probe_catalog.json). A probe times from the entry of one
+#               function to the return of another. Besides explicit probes,
+#               the catalog has phase patterns that add a probe for every
+#               function matching a glob on the demangled name, for example
+#               the preflight, preclaim and doApply of every transactor.
+
+import json
+import os
+
+DEFAULT_CATALOG = os.path.dirname(
+    os.path.realpath(__file__)) + '/probe_catalog.json'
+
+
+class Probe:
+    def __init__(self, name, ters):
+        self.name = name
+        # if the return codes of the exit function should be sampled
+        self.ters = ters
+        # id in the probes table, set when the probe is registered
+        self.id = None
+        # library -> (entry symbols, exit symbols), as mangled names
+        self.symbols = {}
+
+
+def load_catalog(file_name=DEFAULT_CATALOG):
+    with open(file_name, 'r') as file:
+        return json.load(file)
+
+
+def _mangled(symbols, name):
+    '''Mangled names of a catalog symbol, which may be given mangled or demangled'''
+    if name.startswith('_Z'):
+        if symbols is None or symbols.address(name) is not None:
+            return [name]
+        return []
+    if symbols is None:
+        return []
+    return [m for m, _, _ in symbols.match(name)]
+
+
+def resolve_probes(catalog, targets, index):
+    '''
+    Return the list of catalog Probes found in the traced binaries. `targets`
+    is a list of (pid, library) and `index` is a SymbolIndex.
+    '''
+    probes = {}
+    for library in sorted(set(library for _, library in targets)):
+        try:
+            symbols = index.symbols(library)
+        except (OSError, ValueError):
+            # only explicit mangled names can be used without the index
+            symbols = None
+
+        for p in catalog.get('probes', []):
+            entries = _mangled(symbols, p['entry'])
+            exits = _mangled(symbols, p.get('exit', p['entry']))
+            if not entries or not exits:
+                print(f'Probe {p["name"]} not found in {library}')
+                continue
+            probe = probes.setdefault(p['name'],
+                                      Probe(p['name'], p.get('ters', False)))
+            probe.symbols[library] = (entries, exits)
+
+        if symbols is None:
+            continue
+        excluded = set(m for pattern in catalog.get('exclude', [])
+                       for m, _, _ in symbols.match(pattern))
+        for phase in catalog.get('phases', []):
+            # the name of a phase probe is built from the part of the
+            # function name the wildcard matched (the transactor's class)
+            prefix, _, suffix = phase['pattern'].partition('*')
+            for mangled, demangled, _ in symbols.match(phase['pattern']):
+                if mangled in excluded:
+                    continue
+                matched = demangled[len(prefix):len(demangled) - len(suffix)]
+                name = phase['name'].format(matched)
+                probe = probes.setdefault(name,
+                                          Probe(name, phase.get('ters', False)))
+                entries, exits = probe.symbols.setdefault(library, ([], []))
+                entries.append(mangled)
+                exits.append(mangled)
+    return sorted(probes.values(), key=lambda p: p.name)
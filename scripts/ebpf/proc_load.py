@@ -0,0 +1,115 @@
+#/usr/bin/env python
+#
+# proc_load     CPU time and context switches of the threads of a traced
+#               process, read from /proc/<pid>/task/<tid>/schedstat. The files
+#               are opened once and re-read in place every sample, and the
+#               samples of all the threads are parsed in one pass, so sampling
+#               stays cheap with short timeslices.
+
+import numpy as np
+import os
+import re
+import time
+
+
+def thread_group(name):
+    '''Thread name without its number, so the threads of a pool are summed'''
+    return re.sub(r'[\s#:._-]*\d+$', '', name) or name
+
+
+class ThreadLoad:
+    def __init__(self, pid):
+        self.pid = pid
+        self.task_dir = f'/proc/{pid}/task'
+        # tid -> fd of the thread's schedstat file
+        self.fds = {}
+        # tid -> thread group name
+        self.groups = {}
+        # tid -> (cpu nsec, timeslices) at the last sample
+        self.last = {}
+        self.last_time = None
+        # counts are since the thread started, the first sample is the baseline
+        self.sample()
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+    def _open(self, tid):
+        try:
+            with open(f'{self.task_dir}/{tid}/comm', 'r') as file:
+                name = file.read().strip()
+            fd = os.open(f'{self.task_dir}/{tid}/schedstat', os.O_RDONLY)
+        except OSError:
+            return  # the thread exited
+        self.fds[tid] = fd
+        self.groups[tid] = thread_group(name)
+
+    def _update_threads(self):
+        '''Open the threads started, and close the threads exited, since the last sample'''
+        tids = set(int(t) for t in os.listdir(self.task_dir))
+        for tid in [t for t in self.fds if t not in tids]:
+            os.close(self.fds.pop(tid))
+            del self.groups[tid]
+            self.last.pop(tid, None)
+        for tid in tids:
+            if tid not in self.fds:
+                self._open(tid)
+
+    def sample(self):
+        '''
+        Return the seconds since the last sample and a dictionary keyed on
+        thread group of (number of threads, cpu usec, context switches) in
+        that time. Raises OSError if the process exited.
+        '''
+        now = time.monotonic()
+        self._update_threads()
+        tids = []
+        lines = []
+        for tid, fd in self.fds.items():
+            try:
+                # schedstat is: cpu nsec, run queue wait nsec, timeslices
+                lines.append(os.pread(fd, 128, 0))
+            except OSError:
+                continue  # exited since the task dir was read
+            tids.append(tid)
+        values = np.array(b' '.join(lines).split(), dtype=np.int64).reshape(
+            -1, 3)
+        # every time a thread is scheduled in is a timeslice, so the count of
+        # timeslices is the count of context switches
+        current = values[:, [0, 2]]
+        last = np.array([self.last.get(tid, (0, 0)) for tid in tids],
+                        dtype=np.int64).reshape(-1, 2)
+        delta = current - last
+
+        result = {}
+        for tid, (cpu, switches) in zip(tids, delta):
+            threads, total_cpu, total_switches = result.get(
+                self.groups[tid], (0, 0, 0))
+            result[self.groups[tid]] = (threads + 1, total_cpu + cpu // 1000,
+                                        total_switches + switches)
+        self.last = dict(zip(tids, map(tuple, current)))
+        seconds = now - self.last_time if self.last_time else 0
+        self.last_time = now
+        return seconds, result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Print the cpu use of the threads of a process")
+    parser.add_argument("pid", type=int, help="process to sample")
+    parser.add_argument(
+        "-s", "--interval", type=float, default=1, help="Seconds between samples")
+    args = parser.parse_args()
+
+    load = ThreadLoad(args.pid)
+    while True:
+        time.sleep(args.interval)
+        seconds, groups = load.sample()
+        for name, (threads, cpu, switches) in sorted(groups.items()):
+            print(f'{name:24} {threads:4} threads {100 * cpu / 1e6 / seconds:7.1f}% cpu '
+                  f'{switches / seconds:9.1f} switches/s')
+        print()
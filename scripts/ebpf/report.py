@@ -8,15 +8,75 @@
 import bokeh
 from bokeh.io import curdoc, show
 from bokeh.layouts import gridplot, layout, widgetbox, row, column
-from bokeh.models import ColumnDataSource, Dropdown, TextInput, Spacer
+from bokeh.models import ColumnDataSource, Dropdown, Range1d, TextInput, Spacer
 from bokeh.plotting import figure
 
 import argparse
 import datetime
-import numpy as np
+from functools import lru_cache
 import math
+import numpy as np
 import pandas as pd
-import sqlite3
+
+from histogram import Histogram, LOG2_BINS, TER_BINS, TER_FIRST_BIN
+from report_common import connect, read_probe
+
+# wait for the user to stop panning or zooming before fetching
+FETCH_DELAY_MS = 250
+# windows of timings kept in memory (see `fetch_window`)
+MAX_WINDOWS = 64
+
+
+@lru_cache(maxsize=MAX_WINDOWS)
+def fetch_window(file_name, collection_id, probe_id, stat, start, end, step):
+    '''
+    Stat of a probe of a collection for `start <= timestamp < end` (clipped
+    to the collection, the aligned window only keys the cache), with the
+    slices summed into `step` second buckets. Only the window is read from
+    the db (see `report_common.read_probe`): the coarsest rollup tier with a
+    slice per bucket if the db has rollups, otherwise the raw slices and the
+    segment logs. Returns a data frame of timestamp and `stat`.
+    '''
+    table, column = ('ters', 'ter') if stat == 'ter' else ('timings',
+                                                           'log_bin')
+    _, df = read_probe(
+        file_name,
+        table,
+        probe_id,
+        start,
+        end - 1,
+        collection_id,
+        max_points=(end - start) / step)
+    df = df.assign(timestamp=df['timestamp'] // step * step).groupby(
+        ['timestamp', column], as_index=False)['counts'].sum()
+    if stat == 'ter':
+        return df.rename(columns={'ter': stat})
+    keys, histograms = Histogram.from_frame(df, ['timestamp'], 'log_bin',
+                                            LOG2_BINS)
+    df = keys.assign(**histograms.log2_stats())
+    return df.loc[df['count'] > 0, ['timestamp', stat]]
+
+
+@lru_cache(maxsize=MAX_WINDOWS)
+def fetch_histogram(file_name, collection_id, probe_id, stat, start, end):
+    '''Histogram of the probe's timings (or ters) of a collection over `start <= timestamp <= end`'''
+    table, column, num_bins, first_bin = (
+        'ters', 'ter', TER_BINS,
+        TER_FIRST_BIN) if stat == 'ter' else ('timings', 'log_bin',
+                                                LOG2_BINS, 0)
+    _, df = read_probe(file_name, table, probe_id, start, end, collection_id)
+    return Histogram.from_rows(df[column], df['counts'], num_bins,
+                               first_bin).counts
+
+
+def window(start, end, max_points):
+    '''
+    Bucket size and bounds of the window to fetch to plot [start, end] with
+    about `max_points` points. Buckets are powers of two seconds and the
+    window is aligned to them, so small pans fetch the same windows.
+    '''
+    step = 2**max(0, math.ceil(math.log2(max(end - start, 1) / max_points)))
+    return step, int(start // step * step), int((end // step + 1) * step)
 
 
 class ReportData:
@@ -38,7 +98,7 @@ class ReportData:
         if not file_name:
             return
         self.file_name = file_name
-        self.conn = sqlite3.connect(self.file_name)
+        self.conn = connect(self.file_name)
         # create tables, if needed
         c = self.conn.cursor()
         c.execute(
@@ -53,11 +113,10 @@ class ReportData:
             index_col='id')
         self.probes = pd.read_sql_query(
             'select * from probes;', self.conn, index_col='id')
-        self.timings = pd.read_sql_query(
-            'select * from timings order by log_bin;', self.conn)
-        self.ters = pd.read_sql_query('select * from ters;', self.conn)
         self.tags = pd.read_sql_query('select * from tags;', self.conn)
-        self.cached_collection_data = {}
+        # timings and ters are fetched as they're plotted, one visible window
+        # at a time (see `fetch_window`)
+        self.pending_fetches = {}
         self.grid_dims = (2,2)
         num_grid_cells = self.grid_dims[0]*self.grid_dims[1]
         self.sources = np.array(
@@ -68,6 +127,9 @@ class ReportData:
         self.figures = np.array([
             figure(
                 plot_height=fig_dims[i%2][1], plot_width=fig_dims[i%2][0], #tools=tools, 
+                # a fixed range: a range fit to the data would change with
+                # every fetch, and trigger another one
+                x_range=Range1d(0, 1) if i%2 == 0 else None,
                 x_axis_label=fig_labels[i%2][0], y_axis_label=fig_labels[i%2][1])
             for i in range(num_grid_cells)
         ]).reshape(*self.grid_dims)
@@ -79,6 +141,9 @@ class ReportData:
                 self.figures[row, 2*col+1].y_range = self.figures[row, 2*col].y_range
                 self.figures[row, 2*col].background_fill_color = '#fafafa'
                 self.figures[row, 2*col+1].background_fill_color = '#fafafa'
+                for attr in ['start', 'end']:
+                    self.figures[row, 2*col].x_range.on_change(
+                        attr, lambda attr, old, new, row=row, col=2*col: self._schedule_fetch(row, col))
 
         self._init_controls()
         self.timings_plots()
@@ -153,12 +218,7 @@ class ReportData:
         probe_id = int(probe_id)
 
         probe_name = self.probes.loc[probe_id, 'description']
-        td = self.timings_data(collection_id)
-        if stat == 'ter':
-            df = td.ter_data_frame
-        else:
-            df = td.data_frame
-        df = df[df['probe_id'] == probe_id]
+        start, end = self.collections.loc[collection_id, ['start', 'end']]
         title=probe_name + ' ' + stat
         f = self.figures[row, col]
         f.xaxis.axis_label = 'timestamp'
@@ -169,32 +229,55 @@ class ReportData:
         tags = self.tags[self.tags['collection_id'] == collection_id]
         git_hash = self.collections.loc[collection_id,'git_commit']
         f.title.text = title + ': ' + ','.join(tags['tag']) + f' ({git_hash})'
-        if stat == 'ter':
-            hist = np.trim_zeros(td.global_ter_histogram[probe_id], 'f')
-            num_leading_zeros = len(td.global_ter_histogram[probe_id]) - len(hist)
-        else:
-            hist = np.trim_zeros(td.global_histogram[probe_id], 'f')
-            num_leading_zeros = len(td.global_histogram[probe_id]) - len(hist)
+        global_histogram = fetch_histogram(self.file_name, collection_id,
+                                           probe_id, stat, int(start),
+                                           int(end))
+        hist = np.trim_zeros(global_histogram, 'f')
+        num_leading_zeros = len(global_histogram) - len(hist)
         hist = np.trim_zeros(hist, 'b')
 
-        self.sources[row, col].data = dict(x=df['timestamp'], y=df[stat])
+        # show the whole collection, this fetches it
+        f.x_range.update(start=start, end=end, bounds=(start, end))
+        self._fetch(row, col)
         if stat == 'ter':
-            self.sources[row, col+1].data = dict(y=hist, x=[i+num_leading_zeros+td.min_ter for i in range(len(hist))])
+            self.sources[row, col+1].data = dict(y=hist, x=[i+num_leading_zeros+TER_FIRST_BIN for i in range(len(hist))])
         else:
             self.sources[row, col+1].data = dict(y=hist, x=[i+num_leading_zeros for i in range(len(hist))])
 
     def _update_db(self):
         self._update_db_file(self.db_file_control.value)
 
-    def timings_data(self, collection_id):
-        if collection_id in self.cached_collection_data:
-            return self.cached_collection_data[collection_id]
+    def _schedule_fetch(self, row, col):
+        '''Fetch the visible window once the range stops changing'''
+        pending = self.pending_fetches.pop((row, col), None)
+        if pending is not None:
+            curdoc().remove_timeout_callback(pending)
 
-        start, end = self.collections.loc[collection_id, ['start', 'end']]
-        t = self.timings.loc[(self.timings['timestamp'] >= start) & (self.timings['timestamp'] <= end), :]
-        ter = self.ters.loc[(self.ters['timestamp'] >= start) & (self.ters['timestamp'] <= end), :]
-        self.cached_collection_data[collection_id] = CollectionData(t, ter, len(self.probes))
-        return self.cached_collection_data[collection_id]
+        def fetch():
+            del self.pending_fetches[(row, col)]
+            self._fetch(row, col)
+
+        self.pending_fetches[(row, col)] = curdoc().add_timeout_callback(
+            fetch, FETCH_DELAY_MS)
+
+    def _fetch(self, row, col):
+        '''Plot the visible time range at the resolution of the plot'''
+        collection_id = self.collection_controls[row, col].value
+        probe_id = self.probe_controls[row, col].value
+        stat = self.stat_controls[row, col].value
+        if None in [collection_id, probe_id, stat]:
+            return
+        f = self.figures[row, col]
+        collection_start, collection_end = self.collections.loc[
+            int(collection_id), ['start', 'end']]
+        start = max(f.x_range.start, collection_start)
+        end = min(f.x_range.end, collection_end)
+        if end <= start:
+            return
+        step, start, end = window(start, end, f.plot_width)
+        df = fetch_window(self.file_name, int(collection_id), int(probe_id),
+                          stat, start, end, step)
+        self.sources[row, col].data = dict(x=df['timestamp'], y=df[stat])
 
     def timings_plots(self):
         rows = []
@@ -207,106 +290,6 @@ class ReportData:
         curdoc().title = "Rippled eBPF Probes"
 
 
-class CollectionData:
-    def __init__(self, timing_df, ter_df, num_probes):
-        self.min_ter = -99
-        self.max_ter = 150
-        self.init_timing_dataframe(timing_df)
-        self.init_histograms(timing_df, ter_df, num_probes)
-        self.ter_data_frame = ter_df
-
-    def init_timing_dataframe(self, in_df):
-        data = {
-            'timestamp': [],
-            'probe_id': [],
-            'mean': [],
-            'median': [],
-            'min': [],
-            'max': [],
-            'count': []
-        }
-        for g in in_df.groupby(['timestamp', 'probe_id']):
-            count = 0
-            total = 0
-            bin_right_bound = np.left_shift(1, g[1]['log_bin'])
-            for b, c in zip(bin_right_bound, g[1]['counts']):
-                count += c
-                total += c * b
-            if count == 0:
-                continue
-            mean = total / count
-            total = 0
-            culm_count = 0
-            median_index = count / 2
-            median = None
-            min_val = None
-            max_val = None
-            for b, c in zip(bin_right_bound, g[1]['counts']):
-                culm_count += c
-                if culm_count >= median_index and median is None:
-                    median = b
-                if min_val is None:
-                    min_val = b
-                max_val = b
-            data['timestamp'].append(g[0][0])
-            data['probe_id'].append(g[0][1])
-            data['mean'].append(math.log2(mean))
-            data['median'].append(math.log2(median))
-            data['min'].append(math.log2(min_val))
-            data['max'].append(math.log2(max_val))
-            data['count'].append(count)
-
-        self.data_frame = pd.DataFrame(data)
-
-    def init_histograms(self, in_df, ter_df, num_probes):
-        groups = in_df.groupby(['probe_id'])
-
-        # row for every probe, col for the histogram
-        global_histogram= np.zeros([num_probes, 64])
-        # local histogram is a dictionary keyed on probe_id, the value has a
-        # column for every timstamp and a row for every histogram bin
-        # The row and column indexes are this way so it may be easily displayed as an image
-        local_histograms = {}
-        for g in groups:
-            num_timestamps = len(g[1])
-            local_histograms[g[0]] = np.zeros([64, num_timestamps])
-
-        for g in groups:
-            probe_id = g[0]
-            sorted = g[1].sort_values(by='timestamp')
-            lh = local_histograms[probe_id]
-            for timestamp_index, (lb, c) in enumerate(zip(sorted['log_bin'], sorted['counts'])):
-                global_histogram[probe_id, lb] += c
-                lh[lb, timestamp_index] += c
-
-        groups = ter_df.groupby(['probe_id'])
-
-        # row for every probe, col for the histogram
-        num_bins = self.max_ter - self.min_ter + 1
-        global_ter_histogram= np.zeros([num_probes, num_bins])
-        # local histogram is a dictionary keyed on probe_id, the value has a
-        # column for every timstamp and a row for every histogram bin
-        # The row and column indexes are this way so it may be easily displayed as an image
-        local_ter_histograms = {}
-        for g in groups:
-            num_timestamps = len(g[1])
-            local_ter_histograms[g[0]] = np.zeros([num_bins, num_timestamps])
-
-        for g in groups:
-            probe_id = g[0]
-            sorted = g[1].sort_values(by='timestamp')
-            lh = local_ter_histograms[probe_id]
-            for timestamp_index, (tv, c) in enumerate(zip(sorted['ter'], sorted['counts'])):
-                global_ter_histogram[probe_id, tv-self.min_ter] += c
-                lh[tv-self.min_ter, timestamp_index] += c
-
-        self.global_histogram = global_histogram
-        self.local_histograms = local_histograms
-        self.global_ter_histogram = global_ter_histogram
-        self.local_ter_histograms = local_ter_histograms
-        # TBD: normalize the local histograms so timestamps with more stamples don't distort the plot
-
-
 def run(db_file='probes.db'):
     rd = ReportData(db_file)
 
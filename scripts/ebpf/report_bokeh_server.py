@@ -5,12 +5,15 @@
 # TBD: Individual transaction summary stats
 
 import bokeh
+from bokeh.core.properties import value
 from bokeh.io import curdoc, show
 from bokeh.layouts import gridplot, layout, widgetbox, row, column
 from bokeh.models import ColumnDataSource, Dropdown, TextInput, Spacer
+from bokeh.palettes import Viridis256
 from bokeh.plotting import figure
 
-from report_common import get_collection_data
+from functools import partial
+from report_common import collection_data_pool
 import datetime
 import numpy as np
 import math
@@ -23,6 +26,11 @@ class BokehServerReport:
             doc = curdoc()
         self.doc = doc
         self.file_name = None
+        # collections are loaded, and plots computed, on the pool shared by
+        # every session, so a slow load never blocks the server
+        self.pool = collection_data_pool()
+        # latest request of every panel, older results are dropped
+        self.requests = {}
         self.doc.title = "Rippled eBPF Probes"
         self.db_file_control = TextInput(value='', title='Db file:')
         self.db_file_control.on_change(
@@ -34,7 +42,34 @@ class BokehServerReport:
             return
 
         self.file_name = file_name
-        self.collection_data = get_collection_data(file_name)
+        self._request('db', file_name, None, lambda cd: cd, self._init_plots)
+        self.pool.precompute(file_name)
+
+    def _request(self, panel, file_name, collection_id, compute, apply):
+        '''
+        Run `compute(collection_data)` on the pool, then `apply` its result
+        on the session's next tick (bokeh models may only be changed there)
+        '''
+        request = self.requests.get(panel, 0) + 1
+        self.requests[panel] = request
+
+        def done(future):
+            if future.exception():
+                print(f'{panel}: {future.exception()}')
+                return
+            if self.requests[panel] == request:
+                self.doc.add_next_tick_callback(
+                    partial(self._apply, panel, request, apply,
+                            future.result()))
+
+        self.pool.map(compute, file_name, collection_id).add_done_callback(done)
+
+    def _apply(self, panel, request, apply, result):
+        if self.requests[panel] == request:
+            apply(result)
+
+    def _init_plots(self, collection_data):
+        self.collection_data = collection_data
         self.grid_dims = (2, 2)
         num_grid_cells = self.grid_dims[0] * self.grid_dims[1]
         self.sources = np.array([
@@ -68,6 +103,10 @@ class BokehServerReport:
                 self.figures[row, 2 * col +
                              1].background_fill_color = '#fafafa'
 
+        self._init_flamegraph()
+        self._init_phase_plot()
+        self._init_load_plot()
+        self._init_heatmap()
         self._init_controls()
         self.timings_plots()
 
@@ -80,7 +119,9 @@ class BokehServerReport:
         ]
         probe_menu = [self._probe_menu_item(row) for row in probes.iterrows()]
         stats_menu = [('mean', 'mean'), ('median', 'median'), ('min', 'min'),
-                      ('max', 'max'), ('count', 'count'), None, ('ter', 'ter')]
+                      ('max', 'max'), ('count', 'count'), None,
+                      ('self mean', 'self_mean'),
+                      ('self median', 'self_median'), None, ('ter', 'ter')]
         num_grid_cells = self.grid_dims[0] * self.grid_dims[1]
         self.collection_controls = np.array(
             [(Dropdown(
@@ -111,6 +152,244 @@ class BokehServerReport:
         self.grid_controls = np.array(all_controls).reshape(
             *self.grid_dims, len(controls))
 
+    def _init_flamegraph(self):
+        self.flame_source = ColumnDataSource(
+            data=dict(x0=[], x1=[], depth=[], top=[], name=[], count=[]))
+        self.flame_figure = figure(
+            plot_height=475,
+            plot_width=800,
+            tools='xpan,xwheel_zoom,reset,hover',
+            tooltips=[('function', '@name'), ('samples', '@count')],
+            x_axis_label='samples',
+            y_axis_label='stack depth')
+        self.flame_figure.quad(
+            left='x0',
+            right='x1',
+            bottom='depth',
+            top='top',
+            line_color='white',
+            fill_color='#e6550d',
+            source=self.flame_source)
+        self.flame_figure.background_fill_color = '#fafafa'
+        self.flame_collection_control = Dropdown(
+            label='Collection',
+            button_type='warning',
+            menu=[
+                self._collection_menu_item(row)
+                for row in self.collection_data.rd.collections.iterrows()
+            ])
+        self.flame_collection_control.on_change(
+            'value', lambda attr, old, new: self._update_flamegraph())
+
+    def _update_flamegraph(self):
+        collection_id = self.flame_collection_control.value
+        if collection_id is None:
+            return
+        self._request('flame', self.file_name, int(collection_id),
+                      lambda cd: cd.flamegraph(), self._apply_flamegraph)
+
+    def _apply_flamegraph(self, df):
+        num_samples = df.loc[df['depth'] == 0, 'count'].sum()
+        self.flame_figure.title.text = f'Sampled stacks: {num_samples} samples'
+        self.flame_source.data = dict(
+            x0=df['x0'],
+            x1=df['x1'],
+            depth=df['depth'],
+            top=df['depth'] + 0.95,
+            name=df['name'],
+            count=df['count'])
+
+    def _init_phase_plot(self):
+        phases = self.collection_data.phases
+        self.phase_source = ColumnDataSource(
+            data=dict(timestamp=[], **{p: [] for p in phases}))
+        self.phase_figure = figure(
+            plot_height=475,
+            plot_width=800,
+            tools='xpan,xwheel_zoom,reset,hover',
+            tooltips=[('phase', '$name'), ('usec', '@$name')],
+            x_axis_label='timestamp',
+            y_axis_label='total time (usec)')
+        self.phase_renderers = self.phase_figure.vbar_stack(
+            phases,
+            x='timestamp',
+            width=0.9,
+            color=['#3182bd', '#31a354', '#e6550d'][:len(phases)],
+            legend=[value(p) for p in phases],
+            source=self.phase_source)
+        self.phase_figure.background_fill_color = '#fafafa'
+        self.phase_collection_control = Dropdown(
+            label='Collection',
+            button_type='warning',
+            menu=[
+                self._collection_menu_item(row)
+                for row in self.collection_data.rd.collections.iterrows()
+            ])
+        self.phase_transactor_control = Dropdown(
+            label='Transactor',
+            button_type='warning',
+            menu=[(t, t) for t in self.collection_data.transactors()])
+        for c in [self.phase_collection_control, self.phase_transactor_control]:
+            c.on_change('value',
+                        lambda attr, old, new: self._update_phase_plot())
+
+    def _update_phase_plot(self):
+        collection_id = self.phase_collection_control.value
+        transactor = self.phase_transactor_control.value
+        if None in [collection_id, transactor]:
+            return
+        self._request('phase', self.file_name, int(collection_id),
+                      lambda cd: (cd.phases, cd.phase_breakdown(transactor)),
+                      partial(self._apply_phase_plot, transactor))
+
+    def _apply_phase_plot(self, transactor, result):
+        phases, df = result
+        self.phase_figure.title.text = f'{transactor} time per phase'
+        if len(df) > 1:
+            # bar width is the smallest time between slices
+            width = 0.9 * np.diff(df.index).min()
+            for r in self.phase_renderers:
+                r.glyph.width = width
+        self.phase_source.data = dict(
+            timestamp=df.index, **{p: df[p]
+                                   for p in phases})
+
+    def _init_load_plot(self):
+        self.load_source = ColumnDataSource(
+            data=dict(x=[], y=[], timestamp=[]))
+        self.load_figure = figure(
+            plot_height=475,
+            plot_width=800,
+            tools='pan,wheel_zoom,reset,hover',
+            tooltips=[('timestamp', '@timestamp'), ('load', '@x'),
+                      ('latency', '@y')],
+            x_axis_label='load',
+            y_axis_label='mean (log2 usec)')
+        self.load_figure.circle(x='x', y='y', source=self.load_source)
+        self.load_figure.background_fill_color = '#fafafa'
+        self.load_collection_control = Dropdown(
+            label='Collection',
+            button_type='warning',
+            menu=[
+                self._collection_menu_item(row)
+                for row in self.collection_data.rd.collections.iterrows()
+            ])
+        self.load_probe_control = Dropdown(
+            label='Probe',
+            button_type='warning',
+            menu=[
+                self._probe_menu_item(row)
+                for row in self.collection_data.rd.probes.iterrows()
+            ])
+        thread_groups = sorted(set(self.collection_data.rd.thread_load['name']))
+        self.load_metric_control = Dropdown(
+            label='Load',
+            button_type='warning',
+            menu=[('tx/s', 'tx_rate'), ('cpu (cores)', 'cpu'),
+                  ('context switches/s', 'switch_rate'), None] +
+            [(f'{g} cpu (cores)', f'cpu:{g}') for g in thread_groups])
+        for c in [
+                self.load_collection_control, self.load_probe_control,
+                self.load_metric_control
+        ]:
+            c.on_change('value',
+                        lambda attr, old, new: self._update_load_plot())
+
+    def _update_load_plot(self):
+        collection_id = self.load_collection_control.value
+        probe_id = self.load_probe_control.value
+        metric = self.load_metric_control.value
+        if None in [collection_id, probe_id, metric]:
+            return
+        self._request(
+            'load', self.file_name, int(collection_id),
+            lambda cd: (cd.rd.probes.loc[int(probe_id), 'description'],
+                        cd.latency_vs_load(int(probe_id))),
+            partial(self._apply_load_plot, metric))
+
+    def _apply_load_plot(self, metric, result):
+        probe_name, df = result
+        if metric not in df:
+            # the thread group has no threads in this collection
+            df = df.iloc[0:0].assign(**{metric: []})
+        self.load_figure.title.text = f'{probe_name} latency vs load'
+        labels = {
+            item[1]: item[0]
+            for item in self.load_metric_control.menu if item
+        }
+        self.load_figure.xaxis.axis_label = labels.get(metric, metric)
+        self.load_source.data = dict(
+            x=df[metric], y=df['mean'], timestamp=df['timestamp'])
+
+    def _init_heatmap(self):
+        self.heatmap_source = ColumnDataSource(
+            data=dict(image=[], x=[], y=[], dw=[], dh=[]))
+        self.heatmap_figure = figure(
+            plot_height=475,
+            plot_width=800,
+            tools='xpan,xwheel_zoom,reset,hover',
+            tooltips=[('timestamp', '$x{0}'), ('bin', '$y{0}'),
+                      ('fraction', '@image')],
+            x_axis_label='timestamp',
+            y_axis_label='log2 usec')
+        # a single image glyph rather than a rect per (slice, bin)
+        self.heatmap_figure.image(
+            image='image',
+            x='x',
+            y='y',
+            dw='dw',
+            dh='dh',
+            palette=Viridis256,
+            source=self.heatmap_source)
+        self.heatmap_collection_control = Dropdown(
+            label='Collection',
+            button_type='warning',
+            menu=[
+                self._collection_menu_item(row)
+                for row in self.collection_data.rd.collections.iterrows()
+            ])
+        self.heatmap_probe_control = Dropdown(
+            label='Probe',
+            button_type='warning',
+            menu=[
+                self._probe_menu_item(row)
+                for row in self.collection_data.rd.probes.iterrows()
+            ])
+        self.heatmap_kind_control = Dropdown(
+            label='Histogram',
+            button_type='warning',
+            menu=[('timings', 'timings'), ('ters', 'ters')])
+        for c in [
+                self.heatmap_collection_control, self.heatmap_probe_control,
+                self.heatmap_kind_control
+        ]:
+            c.on_change('value', lambda attr, old, new: self._update_heatmap())
+
+    def _update_heatmap(self):
+        collection_id = self.heatmap_collection_control.value
+        probe_id = self.heatmap_probe_control.value
+        kind = self.heatmap_kind_control.value
+        if None in [collection_id, probe_id, kind]:
+            return
+        ters = kind == 'ters'
+        # no more columns than the plot has pixels
+        width = self.heatmap_figure.plot_width
+        self._request(
+            'heatmap', self.file_name, int(collection_id),
+            lambda cd: (cd.rd.probes.loc[int(probe_id), 'description'],
+                        cd.heatmap(int(probe_id), width, ters=ters)),
+            partial(self._apply_heatmap, kind))
+
+    def _apply_heatmap(self, kind, result):
+        probe_name, heatmap = result
+        ters = kind == 'ters'
+        self.heatmap_figure.title.text = f'{probe_name} {kind} per slice'
+        self.heatmap_figure.yaxis.axis_label = 'ter' if ters else 'log2 usec'
+        if heatmap is None:
+            self.heatmap_source.data = dict(image=[], x=[], y=[], dw=[], dh=[])
+            return
+        self.heatmap_source.data = {k: [v] for k, v in heatmap.items()}
+
     def _collection_menu_item(self, collection_row):
         id = collection_row[0]
         v = collection_row[1]
@@ -131,18 +410,29 @@ class BokehServerReport:
         probe_id = self.probe_controls[row, col].value
         stat = self.stat_controls[row, col].value
         if None in [collection_id, probe_id, stat]:
+            # drop any result still being computed
+            self.requests[(row, col)] = self.requests.get((row, col), 0) + 1
             self.sources[row, col].data = dict(x=[], y=[])
             self.sources[row, col + 1].data = dict(x=[], y=[])
             return
 
         collection_id = int(collection_id)
         probe_id = int(probe_id)
+        self._request((row, col), self.file_name, collection_id, lambda cd: cd,
+                      partial(self._apply_grid, row, col, collection_id,
+                              probe_id, stat))
+
+    def _apply_grid(self, row, col, collection_id, probe_id, stat,
+                    collection_data):
         probe_name = self.collection_data.rd.probes.loc[probe_id,
                                                         'description']
-        self.collection_data = get_collection_data(self.file_name,
-                                                   collection_id)
+        self.collection_data = collection_data
+        column = stat
         if stat == 'ter':
             df = self.collection_data.rd.ters
+        elif stat.startswith('self_'):
+            df = self.collection_data.self_data_frame
+            column = stat[len('self_'):]
         else:
             df = self.collection_data.data_frame
         df = df[df['probe_id'] == probe_id]
@@ -168,7 +458,7 @@ class BokehServerReport:
                 self.collection_data.global_histogram[probe_id]) - len(hist)
         hist = np.trim_zeros(hist, 'b')
 
-        self.sources[row, col].data = dict(x=df['timestamp'], y=df[stat])
+        self.sources[row, col].data = dict(x=df['timestamp'], y=df[column])
         if stat == 'ter':
             self.sources[row, col + 1].data = dict(
                 y=hist,
@@ -192,6 +482,25 @@ class BokehServerReport:
                         widgetbox(*self.grid_controls[r, 2 * c]),
                         self.figures[r, 2 * c], self.figures[r, 2 * c + 1]))
                 rows.append(Spacer(height=10))
+        rows.append(
+            row(
+                widgetbox(self.phase_collection_control,
+                          self.phase_transactor_control), self.phase_figure))
+        rows.append(Spacer(height=10))
+        rows.append(
+            row(
+                widgetbox(self.load_collection_control,
+                          self.load_probe_control, self.load_metric_control),
+                self.load_figure))
+        rows.append(Spacer(height=10))
+        rows.append(
+            row(
+                widgetbox(self.heatmap_collection_control,
+                          self.heatmap_probe_control,
+                          self.heatmap_kind_control), self.heatmap_figure))
+        rows.append(Spacer(height=10))
+        rows.append(
+            row(widgetbox(self.flame_collection_control), self.flame_figure))
         l = column(*rows)
         self.doc.add_root(l)
         self.doc.title = "Rippled eBPF Probes"
@@ -3,11 +3,40 @@
 # report_common Non-gui parts of a report. This will be used by different backends to
 #               show the report
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import lru_cache
 import numpy as np
-import math
 import pandas as pd
+import os
 import sqlite3
+import threading
+
+from histogram import Histogram, LogSketch, LOG2_BINS, TER_BINS, TER_FIRST_BIN
+
+from rollup import TIERS, bucket_start, choose_tier, rollup_extents, tier_table
+from segment_log import (hist_rows, read_segment, read_segments, segment_dir,
+                         segment_files, tx_rows)
+
+
+_connections = threading.local()
+
+
+def connect(file_name: str):
+    '''
+    Read only connection to a collection db, shared by everything that runs on
+    the calling thread. sqlite connections can't be used by several threads at
+    once, so every thread gets its own.
+    '''
+    if not hasattr(_connections, 'dbs'):
+        _connections.dbs = {}
+    if file_name not in _connections.dbs:
+        if not os.path.exists(file_name):
+            # don't let sqlite create an empty db
+            raise ValueError("Invalid Collection Database.")
+        _connections.dbs[file_name] = sqlite3.connect(
+            f'file:{os.path.abspath(file_name)}?mode=ro', uri=True)
+    return _connections.dbs[file_name]
 
 
 class ReportData:
@@ -17,17 +46,26 @@ class ReportData:
         with a `None` collection_id the cache doesn't know if it's present unless
         it has the collection_id.
         '''
-        conn = sqlite3.connect(file_name)
-        c = conn.cursor()
+        conn = connect(file_name)
         collections = pd.read_sql_query(
             'select * from collections order by start DESC limit(1);',
             conn,
             index_col='id')
         return collections.index[-1]
 
-    def __init__(self, file_name: str = 'probes.db', collection_id=None):
+    def __init__(self,
+                 file_name: str = 'probes.db',
+                 collection_id=None,
+                 node=None,
+                 max_points=None):
+        '''
+        Load a collection. If `node` is specified, only rows collected from
+        that node id are loaded, otherwise all the nodes are combined.
+        If the db has rollups (see rollup.py), the timings and ters are read
+        from the coarsest tier with at least `max_points` slices.
+        '''
         self.file_name = file_name
-        self.conn = sqlite3.connect(self.file_name)
+        self.conn = connect(self.file_name)
         c = self.conn.cursor()
         c.execute(
             "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='probes';"
@@ -43,136 +81,752 @@ class ReportData:
             'select * from collections order by start;',
             self.conn,
             index_col='id')
+        c.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='nodes';"
+        )
+        if c.fetchone()[0]:
+            self.nodes = pd.read_sql_query(
+                'select * from nodes;', self.conn, index_col='id')
+        else:
+            # collected before several nodes could be traced at once
+            self.nodes = pd.DataFrame({'name': ['default']}, index=pd.Index([0], name='id'))
         if collection_id is None:
             collection_id = self.collections.index[-1]
+        self.collection_id = collection_id
         start, end = self.collections.loc[collection_id, ['start', 'end']]
 
-        where_clause = f'where timestamp >= {start} and timestamp <= {end}'
-        self.timings = pd.read_sql_query(
-            f'select * from timings {where_clause} order by log_bin;',
-            self.conn)
+        # rollup tier the timings and ters are read from, 'raw' for the slices
+        # as they were collected
+        self.extents = rollup_extents(self.conn)
+        self.tier = choose_tier(self.extents, start, end, max_points)
+
+        node_clause = nodes_clause(self.conn, collection_id, node)
+        where_clause = f'where timestamp >= {start} and timestamp <= {end}' + node_clause
+        self.timings = read_tier(self.conn, self.extents, 'timings',
+                                 self.tier, start, end,
+                                 node_clause).sort_values(
+                                     'log_bin', kind='stable')
+        self_timings = read_tier(self.conn, self.extents, 'self_timings',
+                                 self.tier, start, end, node_clause)
+        if self_timings is not None:
+            self.self_timings = self_timings.sort_values(
+                'log_bin', kind='stable')
+        else:
+            # collected before self time was recorded
+            self.self_timings = self.timings.iloc[0:0]
         self.txns = pd.read_sql_query(
             f'select * from transactions {where_clause} order by timestamp;',
             self.conn)
-        self.ters = pd.read_sql_query(f'select * from ters {where_clause};',
-                                      self.conn)
+        self.ters = read_tier(self.conn, self.extents, 'ters', self.tier, start,
+                              end, node_clause)
         self.tags = pd.read_sql_query(
             f'select * from tags where collection_id=={collection_id};',
             self.conn)
+        self._read_segments(start, end, node)
+        self._read_stacks(where_clause)
+        self._read_load(where_clause)
+
+    def _read_segments(self, start, end, node):
+        '''Add the rows written to segment logs and not compacted yet'''
+        directory = segment_dir(self.file_name)
+        if not os.path.isdir(directory):
+            return
+        nodes = row_nodes(self.conn, self.collection_id, node)
+
+        def frame(columns):
+            df = pd.DataFrame(columns)
+            if nodes:
+                df = df[df['node'].isin(nodes)]
+            return df
+
+        records = read_segments(directory, 'tx', start, end)
+        if len(records):
+            self.txns = pd.concat([self.txns, frame(tx_rows(records))],
+                                  ignore_index=True).sort_values('timestamp')
+        if self.tier != 'raw':
+            # rollups are built from the compacted rows
+            return
+        records = read_segments(directory, 'hist', start, end)
+        if len(records) == 0:
+            return
+        for table in ['timings', 'self_timings', 'ters']:
+            df = frame(hist_rows(records, table))
+            setattr(self, table,
+                    pd.concat([getattr(self, table), df], ignore_index=True))
+        self.timings = self.timings.sort_values('log_bin', kind='stable')
+        self.self_timings = self.self_timings.sort_values(
+            'log_bin', kind='stable')
+
+    def _read_stacks(self, where_clause):
+        '''Sampled stacks of the collection, summed over the collection'''
+        c = self.conn.cursor()
+        c.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='stack_samples';"
+        )
+        if c.fetchone()[0] == 0:
+            self.stacks = pd.DataFrame({'frames': [], 'counts': []})
+            self.frames = pd.DataFrame({'name': []})
+            return
+        self.stacks = pd.read_sql_query(
+            f'''select stacks.frames as frames, sum(counts) as counts
+            from (select * from stack_samples {where_clause}) as samples
+            join stacks on samples.stack_id = stacks.id group by stack_id;''',
+            self.conn)
+        self.frames = pd.read_sql_query(
+            'select * from frames;', self.conn, index_col='id')
+
+
+    def _read_load(self, where_clause):
+        '''Thread cpu use and transaction counts of every timeslice'''
+        c = self.conn.cursor()
+        c.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='thread_load';"
+        )
+        if c.fetchone()[0] == 0:
+            # collected before the load was recorded
+            self.thread_load = pd.DataFrame({
+                col: []
+                for col in ['timestamp', 'node', 'name', 'threads', 'cpu',
+                          'switches', 'seconds']
+            })
+            self.tx_counts = pd.DataFrame(
+                {col: []
+                 for col in ['timestamp', 'node', 'type', 'counts', 'seconds']})
+            return
+        self.thread_load = pd.read_sql_query(
+            f'''select timestamp, node, thread_names.name as name, threads,
+            cpu, switches, seconds
+            from (select * from thread_load {where_clause}) as load
+            join thread_names on load.thread_id = thread_names.id;''',
+            self.conn)
+        self.tx_counts = pd.read_sql_query(
+            f'select * from tx_counts {where_clause};', self.conn)
+
+
+def collection_nodes(conn, collection_id):
+    '''Nodes of a collection, empty if the db doesn't record them'''
+    c = conn.cursor()
+    c.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='collection_nodes';"
+    )
+    if c.fetchone()[0] == 0:
+        return []
+    c.execute('select node from collection_nodes where collection_id = ?;',
+              (int(collection_id), ))
+    return [r[0] for r in c.fetchall()]
+
+
+def row_nodes(conn, collection_id, node=None):
+    '''Nodes the rows of a collection are read from: `node`, or the collection's'''
+    if node is not None:
+        return [int(node)]
+    # collections merged from several databases may overlap in time, only use
+    # the nodes that belong to this collection
+    return collection_nodes(conn, collection_id)
+
+
+def nodes_clause(conn, collection_id, node=None):
+    '''sql condition (` and ...`) on the nodes of a collection's rows (see `row_nodes`)'''
+    nodes = row_nodes(conn, collection_id, node)
+    if not nodes:
+        return ''
+    return f' and node in ({",".join(map(str, nodes))})'
+
+
+def read_tier(conn, extents, table, tier, start, end, condition=''):
+    '''
+    Rows of `table` from `start` to `end` (inclusive) matching the sql
+    `condition` (starting with ` and`). Only the tier's buckets that are
+    entirely in the range are read from the tier, as the others also hold the
+    slices of whatever was collected just before or after. The partial
+    buckets at the ends are read from the finer tiers. `extents` are the
+    `rollup_extents` of the db. Returns None if the db has no such table.
+    '''
+    names = ['raw'] + [name for name, _ in TIERS]
+    finer = names[names.index(tier) - 1] if tier != 'raw' else None
+    if finer is not None and finer in extents and extents[finer][0] > start:
+        # the finer slices were dropped, use the tier's partial buckets
+        finer = None
+    if tier == 'raw' or finer is None:
+        first, last = bucket_start(tier, start), end + 1
+    else:
+        seconds = dict(TIERS)[tier]
+        first = -(-start // seconds) * seconds
+        last = (end + 1) // seconds * seconds
+        if first >= last:
+            return read_tier(conn, extents, table, finer, start, end,
+                             condition)
+    c = conn.cursor()
+    c.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?;",
+        (tier_table(table, tier), ))
+    if c.fetchone()[0] == 0:
+        return None
+    parts = [
+        pd.read_sql_query(
+            f'select * from {tier_table(table, tier)} where timestamp >= {first} and timestamp < {last}{condition};',
+            conn)
+    ]
+    if first > start:
+        parts.insert(
+            0,
+            read_tier(conn, extents, table, finer, start, first - 1,
+                      condition))
+    if last <= end:
+        parts.append(
+            read_tier(conn, extents, table, finer, last, end, condition))
+    return pd.concat([p for p in parts if p is not None], ignore_index=True)
+
+
+def read_probe(file_name, table, probe_id, start, end, collection_id,
+               node=None, max_points=None):
+    '''
+    Rows of a probe in the timings, self_timings or ters `table` from `start`
+    to `end` (inclusive), read like `ReportData` reads a collection: clipped
+    to the collection's time range, from the coarsest rollup tier with
+    `max_points` slices, only the nodes of the collection (or `node`), and
+    with the rows of the segment logs. Returns the tier and a data frame,
+    empty if the db has no such table or the range is outside the collection.
+    '''
+    conn = connect(file_name)
+    collection_start, collection_end = conn.execute(
+        'select start, end from collections where id = ?;',
+        (int(collection_id), )).fetchone()
+    # windows are aligned to their buckets, the first and last buckets may
+    # reach into the collections before and after
+    start, end = max(start, collection_start), min(end, collection_end)
+    bin_column = 'ter' if table == 'ters' else 'log_bin'
+    empty = pd.DataFrame(
+        {c: []
+         for c in ['probe_id', 'timestamp', bin_column, 'counts', 'node']})
+    if end < start:
+        return 'raw', empty
+    extents = rollup_extents(conn)
+    tier = choose_tier(extents, start, end, max_points)
+    condition = f' and probe_id = {int(probe_id)}' + nodes_clause(
+        conn, collection_id, node)
+    df = read_tier(conn, extents, table, tier, start, end, condition)
+    if df is None:
+        df = empty
+    directory = segment_dir(file_name)
+    # rollups are built from the compacted rows
+    if tier == 'raw' and os.path.isdir(directory):
+        records = read_segments(directory, 'hist', start, end)
+        records = records[records['probe_id'] == probe_id]
+        nodes = row_nodes(conn, collection_id, node)
+        if nodes:
+            records = records[np.isin(records['node'], nodes)]
+        if len(records):
+            df = pd.concat([df, pd.DataFrame(hist_rows(records, table))],
+                           ignore_index=True)
+    return tier, df
 
 
 class CollectionData:
-    min_ter = -99
-    max_ter = 150
+    min_ter = TER_FIRST_BIN
+    max_ter = TER_FIRST_BIN + TER_BINS - 1
+    # transactor phases timed by the probe catalog. The probes are named
+    # `<transactor>.<phase>`
+    phases = ['preflight', 'preclaim', 'doApply']
 
     def __init__(self, rd: ReportData):
         self.rd = rd
-        self._init_timing_dataframe()
+        self.data_frame = self._timing_dataframe(self.rd.timings)
+        # stats of the self (exclusive) time of the probes
+        self.self_data_frame = self._timing_dataframe(self.rd.self_timings)
         self._init_histograms()
 
-    def _init_timing_dataframe(self):
-        data = {
-            'timestamp': [],
-            'probe_id': [],
-            'mean': [],
-            'median': [],
-            'min': [],
-            'max': [],
-            'count': []
+    def _timing_dataframe(self, timings):
+        '''Stats of the histogram of every probe and timestamp'''
+        keys, histograms = Histogram.from_frame(
+            timings, ['timestamp', 'probe_id'], 'log_bin', LOG2_BINS)
+        df = keys.assign(**histograms.log2_stats())
+        return df[df['count'] > 0].reset_index(drop=True)
+
+    def transactors(self):
+        '''Transactors with phase probes'''
+        names = set()
+        for d in self.rd.probes['description']:
+            transactor, _, phase = d.rpartition('.')
+            if phase in self.phases:
+                names.add(transactor)
+        return sorted(names)
+
+    def phase_breakdown(self, transactor):
+        '''
+        Total time (usec) spent in each phase of the transactor. Returns a data
+        frame indexed on timestamp with a column for every phase.
+        '''
+        ids = {}
+        for probe_id, d in self.rd.probes['description'].items():
+            name, _, phase = d.rpartition('.')
+            if name == transactor and phase in self.phases:
+                ids[probe_id] = phase
+        df = self.data_frame[self.data_frame['probe_id'].isin(list(ids))]
+        result = pd.DataFrame({
+            'timestamp': df['timestamp'],
+            'phase': df['probe_id'].map(ids),
+            # the mean is stored as log2 usec
+            'total': np.exp2(df['mean']) * df['count']
+        })
+        result = result.pivot_table(
+            index='timestamp',
+            columns='phase',
+            values='total',
+            aggfunc='sum',
+            fill_value=0)
+        return result.reindex(columns=self.phases, fill_value=0)
+
+    def flamegraph(self):
+        '''
+        Layout of a flamegraph of the sampled stacks. Returns a data frame
+        with a row for every box: the function name, sample count, the left
+        and right edges (in samples) and the depth (0 is the root).
+        '''
+        # tree of frames. A node is [count, {frame_id: child node}]
+        root = [0, {}]
+        for frames, count in zip(self.rd.stacks['frames'],
+                                 self.rd.stacks['counts']):
+            node = root
+            node[0] += count
+            for frame_id in map(int, frames.split(',')):
+                node = node[1].setdefault(frame_id, [0, {}])
+                node[0] += count
+
+        names = self.rd.frames['name']
+        data = {'name': [], 'count': [], 'x0': [], 'x1': [], 'depth': []}
+        # children are sorted by name, so the same call path is always in
+        # the same place
+        todo = [(root[1], 0, 0)]
+        while todo:
+            children, x, depth = todo.pop()
+            for frame_id, (count, grand_children) in sorted(
+                    children.items(), key=lambda c: names[c[0]]):
+                data['name'].append(names[frame_id])
+                data['count'].append(count)
+                data['x0'].append(x)
+                data['x1'].append(x + count)
+                data['depth'].append(depth)
+                todo.append((grand_children, x, depth + 1))
+                x += count
+        return pd.DataFrame(data)
+
+    def load_frame(self):
+        '''
+        Load of every timeslice, indexed on timestamp: transactions per second
+        (`tx_rate`), busy cores (`cpu`), context switches per second
+        (`switch_rate`) and busy cores of every thread group (`cpu:<name>`).
+        Rates are summed over the nodes. With rollups the timestamps are the
+        tier's buckets and the rates are the mean of the slices in a bucket.
+        '''
+        tl = self.rd.thread_load[self.rd.thread_load['seconds'] > 0]
+        tx = self.rd.tx_counts[self.rd.tx_counts['seconds'] > 0]
+        columns = {
+            'tx_rate': (tx['counts'] / tx['seconds']).groupby(
+                tx['timestamp']).sum(),
+            'cpu': (tl['cpu'] / 1e6 / tl['seconds']).groupby(
+                tl['timestamp']).sum(),
+            'switch_rate': (tl['switches'] / tl['seconds']).groupby(
+                tl['timestamp']).sum()
         }
-        for (ts, probe_id), g in self.rd.timings.groupby(
-            ['timestamp', 'probe_id']):
-            count = 0
-            total = 0
-            bin_right_bound = np.left_shift(1, g['log_bin'])
-            for b, c in zip(bin_right_bound, g['counts']):
-                count += c
-                total += c * b
-            if count == 0:
-                continue
-            mean = total / count
-            total = 0
-            culm_count = 0
-            median_index = count / 2
-            median = None
-            min_val = None
-            max_val = None
-            for b, c in zip(bin_right_bound, g['counts']):
-                culm_count += c
-                if culm_count >= median_index and median is None:
-                    median = b
-                if min_val is None:
-                    min_val = b
-                max_val = b
-            data['timestamp'].append(ts)
-            data['probe_id'].append(probe_id)
-            data['mean'].append(math.log2(mean))
-            data['median'].append(math.log2(median))
-            data['min'].append(math.log2(min_val))
-            data['max'].append(math.log2(max_val))
-            data['count'].append(count)
-
-        self.data_frame = pd.DataFrame(data)
+        for name, g in tl.groupby('name'):
+            columns[f'cpu:{name}'] = (g['cpu'] / 1e6 / g['seconds']).groupby(
+                g['timestamp']).sum()
+        df = pd.DataFrame(columns).fillna(0)
+        df.index.name = 'timestamp'
+        buckets = [bucket_start(self.rd.tier, int(t)) for t in df.index]
+        return df.groupby(buckets).mean().rename_axis('timestamp')
+
+    def latency_vs_load(self, probe_id):
+        '''
+        Stats of the probe's time (see `data_frame`) of every timeslice joined
+        with the load of the slice (see `load_frame`)
+        '''
+        latency = self.data_frame[self.data_frame['probe_id'] ==
+                                  probe_id].sort_values('timestamp')
+        load = self.load_frame().reset_index()
+        if latency.empty or load.empty:
+            return pd.DataFrame(
+                columns=list(latency.columns) + list(load.columns[1:]))
+        # the load is sampled just after the histograms of the same slice
+        return pd.merge_asof(
+            latency.astype({'timestamp': np.int64}),
+            load.astype({'timestamp': np.int64}),
+            on='timestamp',
+            direction='nearest',
+            tolerance=1).dropna()
+
+    def _global_histograms(self, df, bin_column, num_bins, first_bin=0):
+        '''Histogram of every probe over the collection, a row for every probe id'''
+        # histograms are indexed on probe id
+        num_probes = int(self.rd.probes.index.max()) + 1 if len(
+            self.rd.probes) else 0
+        global_histogram = np.zeros([num_probes, num_bins], dtype=np.int64)
+        keys, histograms = Histogram.from_frame(df, ['probe_id'], bin_column,
+                                                num_bins, first_bin)
+        global_histogram[keys['probe_id'].astype(int)] = histograms.counts
+        return global_histogram
 
     def _init_histograms(self):
-        num_probes = len(self.rd.probes)
-        groups = self.rd.timings.groupby(['probe_id'])
-
-        # row for every probe, col for the histogram
-        global_histogram = np.zeros([num_probes, 64])
-        # local histogram is a dictionary keyed on probe_id, the value has a
-        # column for every timstamp and a row for every histogram bin
-        # The row and column indexes are this way so it may be easily displayed as an image
-        local_histograms = {}
-        for n, g in groups:
-            num_timestamps = len(g)
-            local_histograms[n] = np.zeros([64, num_timestamps])
-
-        for n, g in groups:
-            probe_id = n
-            sorted = g.sort_values(by='timestamp')
-            lh = local_histograms[probe_id]
-            for timestamp_index, (lb, c) in enumerate(
-                    zip(sorted['log_bin'], sorted['counts'])):
-                global_histogram[probe_id, lb] += c
-                lh[lb, timestamp_index] += c
-
-        groups = self.rd.ters.groupby(['probe_id'])
-
-        # row for every probe, col for the histogram
-        num_bins = self.max_ter - self.min_ter + 1
-        global_ter_histogram = np.zeros([num_probes, num_bins])
-        # local histogram is a dictionary keyed on probe_id, the value has a
-        # column for every timstamp and a row for every histogram bin
-        # The row and column indexes are this way so it may be easily displayed as an image
-        local_ter_histograms = {}
-        for n, g in groups:
-            num_timestamps = len(g)
-            local_ter_histograms[n] = np.zeros([num_bins, num_timestamps])
-
-        for n, g in groups:
-            probe_id = n
-            sorted = g.sort_values(by='timestamp')
-            lh = local_ter_histograms[probe_id]
-            for timestamp_index, (tv, c) in enumerate(
-                    zip(sorted['ter'], sorted['counts'])):
-                global_ter_histogram[probe_id, tv - self.min_ter] += c
-                lh[tv - self.min_ter, timestamp_index] += c
-
-        self.global_histogram = global_histogram
-        self.local_histograms = local_histograms
-        self.global_ter_histogram = global_ter_histogram
-        self.local_ter_histograms = local_ter_histograms
-        # TBD: normalize the local histograms so timestamps with more stamples don't distort the plot
-
-
-@lru_cache(maxsize=32)
-def _memoized_get_collection_data(db_file_name: str, collection_id: int):
-    rd = ReportData(db_file_name, collection_id)
+        self.global_histogram = self._global_histograms(
+            self.rd.timings, 'log_bin', LOG2_BINS)
+        self.global_ter_histogram = self._global_histograms(
+            self.rd.ters, 'ter', TER_BINS, TER_FIRST_BIN)
+        # local histograms are keyed on probe id, the value has a column for
+        # every timestamp and a row for every histogram bin. The row and
+        # column indexes are this way so it may be easily displayed as an
+        # image. They are built the first time a probe's are needed (see
+        # `local_histogram`).
+        self.local_histograms = {}
+        self.local_ter_histograms = {}
+        self._local_timestamps = {}
+
+    def local_histogram(self, probe_id, ters=False):
+        '''
+        Timestamps and histograms (a stack, one for every timestamp) of the
+        probe's timings, or ters
+        '''
+        key = (probe_id, ters)
+        if key not in self._local_timestamps:
+            if ters:
+                df, column, num_bins, first_bin = self.rd.ters, 'ter', TER_BINS, TER_FIRST_BIN
+                local = self.local_ter_histograms
+            else:
+                df, column, num_bins, first_bin = self.rd.timings, 'log_bin', LOG2_BINS, 0
+                local = self.local_histograms
+            keys, histograms = Histogram.from_frame(
+                df[df['probe_id'] == probe_id], ['timestamp'], column,
+                num_bins, first_bin)
+            # timestamps last: other threads take them to mean it's built
+            local[probe_id] = histograms.counts.T
+            self._local_timestamps[key] = keys['timestamp'].to_numpy()
+        local = self.local_ter_histograms if ters else self.local_histograms
+        return self._local_timestamps[key], Histogram(
+            local[probe_id].T,
+            TER_FIRST_BIN if ters else 0)
+
+    def heatmap(self, probe_id, max_columns, ters=False):
+        '''
+        Image of the probe's local histograms: a row for every bin (trimmed to
+        the bins with counts) and a column for every timeslice. Slices are
+        summed so there are at most `max_columns` columns, and every column is
+        normalized to the fraction of its samples in each bin, so slices with
+        more samples don't distort the plot. Returns None if the probe has no
+        data, otherwise a dictionary with the image and its x (timestamp) and
+        y (bin) extents.
+        '''
+        timestamps, histograms = self.local_histogram(probe_id, ters)
+        if len(timestamps) == 0:
+            return None
+        factor = max(1, int(np.ceil(len(timestamps) / max_columns)))
+        histograms = histograms.coarsen(factor)
+        used = np.flatnonzero(histograms.counts.sum(axis=0))
+        if len(used) == 0:
+            return None
+        lo, hi = used[0], used[-1] + 1
+        counts = histograms.counts[:, lo:hi]
+        totals = counts.sum(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            image = np.where(totals > 0, counts / totals, 0).T
+        # a slice covers the time to the next slice
+        step = np.median(np.diff(timestamps)) if len(timestamps) > 1 else 1
+        return {
+            'image': image,
+            'x': timestamps[0],
+            'dw': timestamps[-1] - timestamps[0] + step,
+            'y': histograms.first_bin + lo,
+            'dh': hi - lo
+        }
+
+
+class TxQuery:
+    '''
+    Transactions matching some predicates, read in chunks of at most
+    `chunk_size` rows so any number of transactions can be processed in
+    constant memory. The predicates are evaluated by sqlite (and on the
+    segment logs, see segment_log.py) and only the `columns` asked for are
+    read. Every predicate is optional:
+      collection_id: transactions of the collection (its time range and nodes)
+      start, end: `start <= timestamp <= end`
+      tx_types, ters, nodes: lists of the allowed values
+      min_duration, max_duration: `min_duration <= duration <= max_duration`
+        (nanoseconds)
+    '''
+
+    def __init__(self,
+                 file_name: str = 'probes.db',
+                 collection_id=None,
+                 start=None,
+                 end=None,
+                 tx_types=None,
+                 ters=None,
+                 nodes=None,
+                 min_duration=None,
+                 max_duration=None,
+                 columns=None,
+                 chunk_size=1000000):
+        self.file_name = file_name
+        self.conn = connect(file_name)
+        self.chunk_size = chunk_size
+        table_columns = [
+            r[1] for r in self.conn.execute('PRAGMA table_info(transactions);')
+        ]
+        if not table_columns:
+            raise ValueError("Invalid Collection Database.")
+        self.columns = list(columns or table_columns)
+        unknown = set(self.columns) - set(table_columns)
+        if unknown:
+            raise ValueError(f"unknown columns: {', '.join(sorted(unknown))}")
+        if collection_id is not None:
+            c = self.conn.execute(
+                'select start, end from collections where id = ?;',
+                (int(collection_id), ))
+            r = c.fetchone()
+            if r is None:
+                raise ValueError(f"no collection {collection_id}")
+            start = r[0] if start is None else max(start, r[0])
+            end = r[1] if end is None else min(end, r[1])
+            if nodes is None:
+                nodes = collection_nodes(self.conn, collection_id) or None
+        self.start = start
+        self.end = end
+        # column -> allowed values
+        self.values = {
+            k: [int(v) for v in values]
+            for k, values in [('type', tx_types), ('ter', ters), ('node',
+                                                                  nodes)]
+            if values is not None
+        }
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+
+    def _where_clause(self):
+        terms = []
+        params = []
+        for column, op, v in [('timestamp', '>=', self.start),
+                              ('timestamp', '<=', self.end),
+                              ('duration', '>=', self.min_duration),
+                              ('duration', '<=', self.max_duration)]:
+            if v is not None:
+                terms.append(f'{column} {op} ?')
+                params.append(int(v))
+        for column, values in self.values.items():
+            terms.append(f'{column} in ({",".join("?" * len(values))})'
+                         if values else '0')
+            params.extend(values)
+        if not terms:
+            return '', params
+        return 'where ' + ' and '.join(terms), params
+
+    def _mask(self, records):
+        '''The predicates evaluated on segment records'''
+        mask = np.ones(len(records), dtype=bool)
+        if self.min_duration is not None:
+            mask &= records['duration'] >= self.min_duration
+        if self.max_duration is not None:
+            mask &= records['duration'] <= self.max_duration
+        for column, values in self.values.items():
+            mask &= np.isin(records[column], values)
+        return mask
+
+    def chunks(self):
+        '''Data frames of the matching transactions, in time order per source'''
+        where_clause, params = self._where_clause()
+        for df in pd.read_sql_query(
+                f'select {", ".join(self.columns)} from transactions {where_clause};',
+                self.conn,
+                params=params,
+                chunksize=self.chunk_size):
+            if len(df):
+                yield df
+        directory = segment_dir(self.file_name)
+        if not os.path.isdir(directory):
+            return
+        for path in segment_files(directory, 'tx'):
+            # a memory map: only the chunk being converted is read
+            records = read_segment(path, self.start, self.end)
+            for i in range(0, len(records), self.chunk_size):
+                chunk = records[i:i + self.chunk_size]
+                chunk = chunk[self._mask(chunk)]
+                if len(chunk):
+                    yield pd.DataFrame(tx_rows(chunk))[self.columns]
+
+    def count(self, by=None):
+        '''Number of transactions, or a series of the counts of every value of `by`'''
+        if by is None:
+            return sum(len(df) for df in self.chunks())
+        counts = pd.Series(dtype=np.int64)
+        for df in self.chunks():
+            counts = counts.add(df.groupby(by).size(), fill_value=0)
+        return counts.astype(np.int64)
+
+    def histogram(self, column='duration'):
+        '''log2 usec Histogram of a column in nanoseconds (see histogram.py)'''
+        h = Histogram.zeros(LOG2_BINS)
+        for df in self.chunks():
+            values = df[column].dropna().to_numpy()
+            h.add_values(values.astype(np.int64) // 1000)
+        return h
+
+    def sketch(self, column='duration', relative_accuracy=0.01):
+        '''LogSketch of a column, for percentiles'''
+        sketch = LogSketch(relative_accuracy)
+        for df in self.chunks():
+            sketch.add_values(df[column].to_numpy(dtype=np.float64))
+        return sketch
+
+    def percentiles(self, qs=(50, 90, 99, 99.9), column='duration',
+                    relative_accuracy=0.01):
+        '''Percentiles of a column, within `relative_accuracy`'''
+        sketch = self.sketch(column, relative_accuracy)
+        return pd.Series(
+            sketch.quantiles(np.asarray(qs) / 100), index=list(qs))
+
+
+# collections kept loaded
+MAX_CACHED_COLLECTIONS = 32
+
+
+@lru_cache(maxsize=MAX_CACHED_COLLECTIONS)
+def _memoized_get_collection_data(db_file_name: str, collection_id: int,
+                                  node, max_points):
+    rd = ReportData(db_file_name, collection_id, node, max_points)
     return CollectionData(rd)
 
 
-def get_collection_data(db_file_name: str = 'probes.db', collection_id=None):
+def get_collection_data(db_file_name: str = 'probes.db',
+                        collection_id=None,
+                        node=None,
+                        max_points=None):
     if collection_id is None:
         collection_id = ReportData.default_collection_id(db_file_name)
-    return _memoized_get_collection_data(db_file_name, collection_id)
+    return _memoized_get_collection_data(db_file_name, collection_id, node,
+                                         max_points)
+
+
+class CollectionDataPool:
+    '''
+    Loads collections on a pool of worker threads, so a gui never waits on a
+    load. Results are shared by every user of the pool (see
+    `get_collection_data`), and a collection is only loaded once even if it's
+    requested again while it's loading. At most `max_cached` loaded
+    collections are kept, the least recently requested are dropped first.
+    '''
+
+    def __init__(self, max_workers=None,
+                 max_cached=MAX_CACHED_COLLECTIONS):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='collection_data')
+        self.lock = threading.Lock()
+        self.max_cached = max_cached
+        # least recently requested first
+        self.futures = OrderedDict()
+
+    def submit(self, db_file_name: str, collection_id=None, node=None,
+               max_points=None):
+        '''
+        Future of the `CollectionData` (see `get_collection_data`). Nothing
+        is read on the caller's thread, a None `collection_id` (the latest
+        collection) is looked up on the pool.
+        '''
+        if collection_id is None:
+            result = Future()
+
+            def resolve():
+                collection_id = ReportData.default_collection_id(db_file_name)
+                _forward(
+                    self.submit(db_file_name, collection_id, node,
+                                max_points), result)
+
+            _forward(self.executor.submit(resolve), result, on_error_only=True)
+            return result
+        key = (db_file_name, collection_id, node, max_points)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None or (future.done() and future.exception()):
+                # failed loads are retried
+                future = self.executor.submit(get_collection_data, *key)
+                self.futures[key] = future
+            self.futures.move_to_end(key)
+            self._evict()
+            return future
+
+    def _evict(self):
+        # loads in progress are kept, so they are never started twice
+        done = [k for k, f in self.futures.items() if f.done()]
+        for key in done[:max(len(self.futures) - self.max_cached, 0)]:
+            del self.futures[key]
+
+    def map(self, fn, db_file_name: str, collection_id=None, node=None,
+            max_points=None):
+        '''
+        Future of `fn(collection_data)`, run on the pool once the collection
+        is loaded. Use it to move aggregations off the caller's thread too.
+        '''
+        result = Future()
+
+        def run(collection_data):
+            try:
+                result.set_result(fn(collection_data))
+            except Exception as e:
+                result.set_exception(e)
+
+        def loaded(future):
+            if future.exception():
+                result.set_exception(future.exception())
+            else:
+                self.executor.submit(run, future.result())
+
+        self.submit(db_file_name, collection_id, node,
+                    max_points).add_done_callback(loaded)
+        return result
+
+    def precompute(self, db_file_name: str, limit=None):
+        '''
+        Load the latest `limit` collections of the db in the background.
+        `limit` defaults to, and is at most, the number of collections the
+        pool keeps (`max_cached`), as older loads would only push the latest
+        ones out. Returns a future of the futures of the collections.
+        '''
+        limit = self.max_cached if limit is None else min(
+            limit, self.max_cached)
+
+        def submit_all():
+            collections = pd.read_sql_query(
+                f'select id from collections order by start DESC limit {int(limit)};',
+                connect(db_file_name))
+            # the latest last, so they are the last to be dropped
+            return [
+                self.submit(db_file_name, int(collection_id))
+                for collection_id in reversed(collections['id'])
+            ]
+
+        return self.executor.submit(submit_all)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def _forward(future, result, on_error_only=False):
+    '''Set `result` to the outcome of `future` once it's done'''
+
+    def done(future):
+        if future.exception():
+            result.set_exception(future.exception())
+        elif not on_error_only:
+            result.set_result(future.result())
+
+    future.add_done_callback(done)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def collection_data_pool():
+    '''The process wide `CollectionDataPool`'''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = CollectionDataPool()
+        return _pool
@@ -0,0 +1,213 @@
+#/usr/bin/env python
+#
+# rollup    Merge the timing and ter histograms of a collection database into
+#           coarser time tiers and drop old slices. Reports read the coarsest
+#           tier that still has enough resolution for the plot, so long
+#           collections don't need to scan every raw slice.
+#           Run this periodically (from cron, for example); only new complete
+#           buckets are rolled up on every run.
+
+import argparse
+import time
+
+from collection_db import DB
+
+# name and length in seconds of the rollup tiers, finest first. Each tier is
+# built from the one before it, the first from the raw slices.
+TIERS = [('1m', 60), ('1h', 3600), ('1d', 86400)]
+
+# histogram tables that are rolled up, and the column holding the bin
+TABLES = {'timings': 'log_bin', 'self_timings': 'log_bin', 'ters': 'ter'}
+
+# don't roll up the last minute, the collector may still write to it
+SETTLE_SECONDS = 60
+
+
+def tier_table(table, tier):
+    if tier == 'raw':
+        return table
+    return f'{table}_{tier}'
+
+
+def bucket_start(tier, timestamp):
+    '''Start of the tier's bucket holding `timestamp`'''
+    if tier == 'raw':
+        return timestamp
+    seconds = dict(TIERS)[tier]
+    return (timestamp // seconds) * seconds
+
+
+def rollup_extents(conn):
+    '''
+    Return a dictionary keyed on tier name ('raw' for the collected slices)
+    with the (start, end) time range the tier holds. `end` is None for raw
+    data. Returns an empty dictionary if the db was never rolled up.
+    '''
+    c = conn.cursor()
+    c.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='rollups';"
+    )
+    if c.fetchone()[0] == 0:
+        return {}
+    c.execute('SELECT name, start, end FROM rollups;')
+    return {name: (start, end) for name, start, end in c.fetchall()}
+
+
+def choose_tier(extents, start, end, max_points=None):
+    '''
+    Return the name of the coarsest tier that holds the whole [start, end]
+    range with at least `max_points` slices, or the finest tier holding the
+    range if none has that resolution. With no `max_points` the raw slices
+    are used unless they were dropped.
+    '''
+
+    def covers(name):
+        if name not in extents:
+            return name == 'raw'
+        tier_start, tier_end = extents[name]
+        return tier_start <= start and (tier_end is None or end < tier_end)
+
+    available = [name for name, _ in reversed(TIERS) if covers(name)]
+    if covers('raw'):
+        available.append('raw')
+    if not available:
+        # nothing holds the whole range, use whatever is left
+        return 'raw' if 'raw' not in extents else TIERS[-1][0]
+    if max_points:
+        seconds = dict(TIERS)
+        wanted = (end - start) / max_points
+        for name in available:
+            if name == 'raw' or seconds[name] <= wanted:
+                return name
+    return available[-1]
+
+
+class RollupDB(DB):
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        c = self.conn.cursor()
+        # start is the first timestamp still stored for a tier, end is the
+        # end (exclusive) of the last bucket rolled up
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS rollups (name TEXT PRIMARY KEY,
+                                            start INTEGER, end INTEGER);
+        ''')
+        c.execute(
+            "INSERT OR IGNORE INTO rollups VALUES ('raw', 0, NULL);")
+        for name, _ in TIERS:
+            c.execute('INSERT OR IGNORE INTO rollups VALUES (?, 0, 0);',
+                      (name, ))
+            for table, bin_column in TABLES.items():
+                t = tier_table(table, name)
+                c.execute(f'''
+                CREATE TABLE IF NOT EXISTS {t} (probe_id INTEGER,
+                    timestamp INTEGER, {bin_column} INTEGER, counts INTEGER,
+                    node INTEGER DEFAULT 0);
+                ''')
+                c.execute(
+                    f'CREATE INDEX IF NOT EXISTS {t}_time ON {t} (timestamp);')
+        self.conn.commit()
+
+    def rollup(self, now):
+        '''Roll up every complete bucket older than `now`. Return the number of new rows'''
+        extents = rollup_extents(self.conn)
+        c = self.conn.cursor()
+        added = 0
+        source = 'raw'
+        source_end = now - SETTLE_SECONDS
+        for name, seconds in TIERS:
+            begin = extents[name][1]
+            # only complete buckets, and only what the source tier has
+            cutoff = (source_end // seconds) * seconds
+            if cutoff > begin:
+                for table, bin_column in TABLES.items():
+                    c.execute(f'''
+                    INSERT INTO {tier_table(table, name)}
+                    (probe_id, timestamp, {bin_column}, counts, node)
+                    SELECT probe_id, (timestamp / {seconds}) * {seconds} AS bucket,
+                           {bin_column}, SUM(counts), node
+                    FROM {tier_table(table, source)}
+                    WHERE timestamp >= ? AND timestamp < ?
+                    GROUP BY probe_id, bucket, {bin_column}, node;
+                    ''', (begin, cutoff))
+                    added += c.rowcount
+                c.execute('UPDATE rollups SET end = ? WHERE name = ?;',
+                          (cutoff, name))
+                self.conn.commit()
+                source_end = cutoff
+            else:
+                source_end = begin
+            source = name
+        return added
+
+    def apply_retention(self, now, keep_days):
+        '''
+        Drop slices older than `keep_days[tier]` days. Slices that have not
+        been rolled up into the next tier are always kept.
+        '''
+        extents = rollup_extents(self.conn)
+        names = ['raw'] + [name for name, _ in TIERS]
+        c = self.conn.cursor()
+        removed = 0
+        for i, name in enumerate(names):
+            days = keep_days.get(name)
+            if days is None:
+                continue
+            cutoff = now - int(days * 86400)
+            if i + 1 < len(names):
+                cutoff = min(cutoff, extents[names[i + 1]][1])
+            if cutoff <= extents[name][0]:
+                continue
+            for table in TABLES:
+                c.execute(
+                    f'DELETE FROM {tier_table(table, name)} WHERE timestamp < ?;',
+                    (cutoff, ))
+                removed += c.rowcount
+            c.execute('UPDATE rollups SET start = ? WHERE name = ?;',
+                      (cutoff, name))
+            self.conn.commit()
+        return removed
+
+
+def run(db_file, keep_days, rebuild=False):
+    db = RollupDB(db_file)
+    if rebuild:
+        c = db.conn.cursor()
+        for name, _ in TIERS:
+            for table in TABLES:
+                c.execute(f'DELETE FROM {tier_table(table, name)};')
+            c.execute('UPDATE rollups SET start = 0, end = 0 WHERE name = ?;',
+                      (name, ))
+        db.conn.commit()
+    now = int(time.time())
+    added = db.rollup(now)
+    removed = db.apply_retention(now, keep_days)
+    print(f'Added {added} rollup rows, removed {removed} expired rows')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Roll up collected histograms into coarser time tiers")
+    parser.add_argument(
+        "--db", required=True, help="Database file with the trace results")
+    parser.add_argument(
+        "--keep-raw",
+        type=float,
+        help="Days to keep the collected slices after they are rolled up")
+    for name, _ in TIERS:
+        parser.add_argument(
+            f"--keep-{name}",
+            type=float,
+            help=f"Days to keep the {name} rollups")
+    parser.add_argument(
+        "--rebuild",
+        action='store_true',
+        help=
+        "Recompute the rollups from the raw slices. Needed after older data is merged into the db"
+    )
+    args = parser.parse_args()
+
+    keep_days = {'raw': args.keep_raw}
+    for name, _ in TIERS:
+        keep_days[name] = getattr(args, f'keep_{name}')
+    run(args.db, keep_days, args.rebuild)
@@ -0,0 +1,369 @@
+#/usr/bin/env python
+#
+# segment_log   Append-only storage for the high rate rows (transactions,
+#               timings and ters) when sqlite can't keep up. Rows are written
+#               as fixed size records to preallocated, memory mapped segment
+#               files that are rotated when full. A sealed segment has a
+#               footer index of timestamps so readers can find a time range
+#               without scanning it. Segments are read with np.memmap and can
+#               be compacted into the sqlite tables of the collection db.
+#
+#               Segments of `probes.db` are in the `probes.db.segments`
+#               directory. The rest of the collection (probes, nodes,
+#               collections...) is still stored in the sqlite db.
+
+import argparse
+import glob
+import hashlib
+import mmap
+import numpy as np
+import os
+import pandas as pd
+import struct
+
+from collection_db import DB
+
+MAGIC = b'XRPLSEG1'
+# magic, kind, record size, capacity, count, sealed, index count, min and max
+# timestamp
+HEADER = struct.Struct('<8sIIQQIIqq')
+HEADER_SIZE = 64
+# a footer index entry every INDEX_STRIDE records
+INDEX_STRIDE = 4096
+INDEX_DTYPE = np.dtype([('timestamp', '<i8'), ('record', '<u8')])
+
+# null wait times (not collected in off-cpu mode) are stored as -1. The id is
+# raw bytes: numpy's S type would drop the trailing zero bytes of an id.
+TX_DTYPE = np.dtype([('id', 'V32'), ('timestamp', '<i8'), ('duration', '<i8'),
+                     ('type', '<i4'), ('ter', '<i4'), ('node', '<i4'),
+                     ('pad', '<i4'), ('offcpu', '<i8'), ('futex', '<i8')])
+# a row of the timings, self_timings or ters table. `bin` is the log_bin of
+# timings or the ter of ters.
+HIST_DTYPE = np.dtype([('timestamp', '<i8'), ('counts', '<i8'),
+                       ('probe_id', '<i4'), ('bin', '<i4'), ('node', '<i4'),
+                       ('table', '<i4')])
+
+KINDS = {'tx': (1, TX_DTYPE), 'hist': (2, HIST_DTYPE)}
+HIST_TABLES = ['timings', 'self_timings', 'ters']
+
+
+def segment_dir(db_file):
+    return db_file + '.segments'
+
+
+def _footer_size(capacity):
+    return (capacity // INDEX_STRIDE + 1) * INDEX_DTYPE.itemsize
+
+
+def _read_header(path):
+    with open(path, 'rb') as file:
+        fields = HEADER.unpack(file.read(HEADER.size))
+    if fields[0] != MAGIC:
+        raise ValueError(f'{path} is not a segment file')
+    names = ['magic', 'kind', 'record_size', 'capacity', 'count', 'sealed',
+             'index_count', 'min_timestamp', 'max_timestamp']
+    return dict(zip(names, fields))
+
+
+class SegmentWriter:
+    '''Appends records of one kind to the segments in a directory'''
+
+    def __init__(self, directory, kind, capacity=1 << 18):
+        self.directory = directory
+        self.kind = kind
+        self.kind_id, self.dtype = KINDS[kind]
+        self.capacity = capacity
+        os.makedirs(directory, exist_ok=True)
+        existing = sorted(glob.glob(os.path.join(directory, f'{kind}-*.seg')))
+        # never append to a segment written by another run
+        self.sequence = int(existing[-1][-10:-4]) + 1 if existing else 0
+        self._open_segment()
+
+    def _open_segment(self):
+        self.path = os.path.join(self.directory,
+                                 f'{self.kind}-{self.sequence:06d}.seg')
+        size = HEADER_SIZE + self.capacity * self.dtype.itemsize + _footer_size(
+            self.capacity)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+        self.mm = mmap.mmap(fd, size)
+        os.close(fd)
+        self.records = np.frombuffer(
+            self.mm, self.dtype, count=self.capacity, offset=HEADER_SIZE)
+        self.count = 0
+        self.min_timestamp = 0
+        self.max_timestamp = 0
+        self._write_header(sealed=0, index_count=0)
+
+    def _write_header(self, sealed, index_count):
+        HEADER.pack_into(self.mm, 0, MAGIC, self.kind_id,
+                         self.dtype.itemsize, self.capacity, self.count,
+                         sealed, index_count, self.min_timestamp,
+                         self.max_timestamp)
+
+    def _seal(self):
+        '''Write the footer index and close the segment'''
+        stamps = self.records['timestamp'][:self.count:INDEX_STRIDE]
+        index = np.frombuffer(
+            self.mm,
+            INDEX_DTYPE,
+            count=len(stamps),
+            offset=HEADER_SIZE + self.capacity * self.dtype.itemsize)
+        index['timestamp'] = stamps
+        index['record'] = np.arange(len(stamps), dtype=np.uint64) * INDEX_STRIDE
+        self._write_header(sealed=1, index_count=len(stamps))
+        # the views into the map must be gone before it can be closed
+        del index, stamps
+        self.records = None
+        self.mm.flush()
+        self.mm.close()
+
+    def append(self, rows):
+        '''Append a structured array of records, rotating segments as they fill'''
+        while len(rows):
+            if self.count == self.capacity:
+                self._seal()
+                self.sequence += 1
+                self._open_segment()
+            n = min(len(rows), self.capacity - self.count)
+            self.records[self.count:self.count + n] = rows[:n]
+            if self.count == 0:
+                self.min_timestamp = int(rows['timestamp'][0])
+            self.count += n
+            self.max_timestamp = max(self.max_timestamp,
+                                     int(rows['timestamp'][:n].max()))
+            # readers use the count in the header, update it last
+            self._write_header(sealed=0, index_count=0)
+            rows = rows[n:]
+
+    def close(self):
+        if self.records is not None:
+            self._seal()
+
+
+def read_segment(path, start=None, end=None):
+    '''
+    Records of a segment with `start <= timestamp <= end`, as a read only
+    np.memmap. Records are in the order they were written, which is time
+    order.
+    '''
+    header = _read_header(path)
+    dtype = {k: d for k, d in KINDS.values()}[header['kind']]
+    count = header['count']
+    if count == 0:
+        return np.zeros(0, dtype)
+    if (start is not None and header['max_timestamp'] < start) or (
+            end is not None and header['min_timestamp'] > end):
+        return np.zeros(0, dtype)
+    records = np.memmap(
+        path, dtype, mode='r', offset=HEADER_SIZE, shape=(count, ))
+    lo, hi = 0, count
+    if header['sealed'] and header['index_count']:
+        # narrow the search to the blocks of the footer index
+        index = np.memmap(
+            path,
+            INDEX_DTYPE,
+            mode='r',
+            offset=HEADER_SIZE + header['capacity'] * header['record_size'],
+            shape=(header['index_count'], ))
+        if start is not None:
+            block = max(np.searchsorted(index['timestamp'], start) - 1, 0)
+            lo = int(index['record'][block])
+        if end is not None:
+            block = np.searchsorted(index['timestamp'], end, side='right')
+            if block < len(index):
+                hi = int(index['record'][block])
+    if start is not None:
+        lo += int(np.searchsorted(records['timestamp'][lo:hi], start))
+    if end is not None:
+        hi = lo + int(
+            np.searchsorted(records['timestamp'][lo:hi], end, side='right'))
+    return records[lo:hi]
+
+
+def segment_files(directory, kind):
+    return sorted(glob.glob(os.path.join(directory, f'{kind}-*.seg')))
+
+
+def read_segments(directory, kind, start=None, end=None):
+    '''Records of every segment of `kind` in the time range, concatenated'''
+    parts = [
+        read_segment(path, start, end)
+        for path in segment_files(directory, kind)
+    ]
+    parts = [p for p in parts if len(p)]
+    if not parts:
+        return np.zeros(0, KINDS[kind][1])
+    return np.concatenate(parts)
+
+
+def id_hex(ids):
+    '''Hex strings of an array of raw (V32) transaction ids'''
+    text = np.ascontiguousarray(ids).tobytes().hex().upper()
+    return [text[i:i + 64] for i in range(0, len(text), 64)]
+
+
+def tx_rows(records):
+    '''Columns of the transactions table'''
+    return {
+        'id': id_hex(records['id']),
+        'type': records['type'],
+        'timestamp': records['timestamp'],
+        'duration': records['duration'],
+        'ter': records['ter'],
+        'node': records['node'],
+        'offcpu': np.where(records['offcpu'] < 0, np.nan, records['offcpu']),
+        'futex': np.where(records['futex'] < 0, np.nan, records['futex'])
+    }
+
+
+def hist_rows(records, table):
+    '''Columns of the timings, self_timings or ters table'''
+    records = records[records['table'] == HIST_TABLES.index(table)]
+    return {
+        'probe_id': records['probe_id'],
+        'timestamp': records['timestamp'],
+        'ter' if table == 'ters' else 'log_bin': records['bin'],
+        'counts': records['counts'],
+        'node': records['node']
+    }
+
+
+class SegmentDB(DB):
+    '''
+    Collection db that writes transactions, timings and ters to segment logs
+    rather than sqlite. Everything else is stored in the sqlite db.
+    '''
+
+    def __init__(self, file_name='data.db', capacity=1 << 18):
+        super().__init__(file_name)
+        directory = segment_dir(file_name)
+        self.tx_log = SegmentWriter(directory, 'tx', capacity)
+        self.hist_log = SegmentWriter(directory, 'hist', capacity)
+
+    def close(self):
+        self.tx_log.close()
+        self.hist_log.close()
+        super().close()
+
+    def _add_hist(self, table, probe_id, timestamp, bins, counts, node):
+        rows = np.zeros(len(bins), HIST_DTYPE)
+        rows['timestamp'] = timestamp
+        rows['counts'] = counts
+        rows['probe_id'] = probe_id
+        rows['bin'] = bins
+        rows['node'] = node
+        rows['table'] = HIST_TABLES.index(table)
+        self.hist_log.append(rows)
+
+    def add_timing(self, probe_id, timestamp, histogram, node=0,
+                   table='timings'):
+        self._add_hist(table, probe_id, timestamp, *histogram.to_rows(), node)
+
+    def add_ters(self, probe_id, timestamp, histogram, node=0):
+        self._add_hist('ters', probe_id, timestamp, *histogram.to_rows(),
+                       node)
+
+    def add_tx(self, txid_hex, timestamp, duration, tx_type, ter, node=0,
+               offcpu=None, futex=None):
+        row = np.zeros(1, TX_DTYPE)
+        row[0] = (bytes.fromhex(txid_hex), timestamp, duration, tx_type, ter,
+                  node, 0, -1 if offcpu is None else offcpu,
+                  -1 if futex is None else futex)
+        self.tx_log.append(row)
+
+
+def _digest(path):
+    '''Hash of the header and records of a segment, which identify it'''
+    header = _read_header(path)
+    size = HEADER_SIZE + header['count'] * header['record_size']
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while size > 0:
+            block = file.read(min(size, 1 << 20))
+            if not block:
+                break
+            h.update(block)
+            size -= len(block)
+    return h.hexdigest()
+
+
+def compact(db_file, include_open=False):
+    '''
+    Copy the records of the sealed segments of `db_file` into its sqlite
+    tables and remove the segments. With `include_open` the segments still
+    being written are also compacted; only use it when no collector is
+    writing to them. Return the number of rows copied.
+
+    A segment is recorded in the `compacted_segments` table in the same
+    transaction as its rows, so a segment left behind by a compaction that
+    stopped before removing it is removed without being copied again.
+    '''
+    db = DB(db_file)
+    c = db.conn.cursor()
+    # segment names are reused once all the segments are removed, so they
+    # are identified by their contents
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS compacted_segments (digest TEXT PRIMARY KEY,
+                                                   name TEXT);
+    ''')
+    db.conn.commit()
+    copied = 0
+    for kind in KINDS:
+        for path in segment_files(segment_dir(db_file), kind):
+            if not _read_header(path)['sealed'] and not include_open:
+                continue
+            digest = _digest(path)
+            c.execute('SELECT count(*) FROM compacted_segments WHERE digest = ?;',
+                      (digest, ))
+            if c.fetchone()[0]:
+                os.remove(path)
+                continue
+            records = read_segment(path)
+            if kind == 'tx':
+                tables = {'transactions': tx_rows(records)}
+            else:
+                tables = {t: hist_rows(records, t) for t in HIST_TABLES}
+            with db.transaction():
+                for table, columns in tables.items():
+                    df = pd.DataFrame(columns).astype(object)
+                    df = df.where(df.notna(), None)
+                    c.executemany(
+                        f'INSERT INTO {table} ({", ".join(df.columns)}) VALUES ({", ".join("?" * len(df.columns))});',
+                        df.itertuples(index=False, name=None))
+                    copied += len(df)
+                c.execute('INSERT INTO compacted_segments VALUES (?, ?);',
+                          (digest, os.path.basename(path)))
+            del records
+            os.remove(path)
+    return copied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compact the segment logs of a collection db into sqlite")
+    parser.add_argument(
+        "--db", required=True, help="Database file with the trace results")
+    parser.add_argument(
+        "--include-open",
+        action='store_true',
+        help="Also compact the segments still open. Only use when no collector is running")
+    parser.add_argument(
+        "--info",
+        action='store_true',
+        help="List the segments rather than compacting them")
+    args = parser.parse_args()
+
+    if args.info:
+        for kind in KINDS:
+            for path in segment_files(segment_dir(args.db), kind):
+                h = _read_header(path)
+                state = 'sealed' if h['sealed'] else 'open'
+                print(f'{path}: {h["count"]}/{h["capacity"]} records, '
+                      f'{h["min_timestamp"]}-{h["max_timestamp"]} ({state})')
+    else:
+        n = compact(args.db, args.include_open)
+        print(f'Compacted {n} rows')
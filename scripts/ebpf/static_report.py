@@ -0,0 +1,355 @@
+#/usr/bin/env python
+#
+# static_report Render standalone html (and optionally png) reports of the
+#               collections of a database without a bokeh server. Every
+#               collection is rendered by a worker process of a pool. The plot
+#               data computed for a collection is cached in the output
+#               directory, so rendering again (with png, or after changing the
+#               layout) doesn't reload the collection. Every probe has the
+#               plots of the bokeh server report: its timeline (with the self
+#               time), histograms of the time and of the TERs, the heatmap and
+#               its latency against the load of the node.
+
+import argparse
+from bokeh.core.properties import value
+from bokeh.embed import file_html
+from bokeh.io import export_png
+from bokeh.layouts import column, row
+from bokeh.models import ColumnDataSource, Div
+from bokeh.palettes import Viridis256
+from bokeh.plotting import figure
+from bokeh.resources import CDN, INLINE
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
+import html
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import sqlite3
+import sys
+
+from report_common import get_collection_data
+
+# bump when the cached plot data changes
+CACHE_VERSION = 2
+STATS = ['mean', 'median', 'max']
+SELF_STATS = ['mean', 'median']
+# load metrics the probes' latency is plotted against
+LOAD_METRICS = ['tx_rate', 'cpu']
+
+
+def plot_data(collection_data, max_columns):
+    '''
+    Everything the report plots for a collection, as plain data frames and
+    arrays so it can be cached and sent between processes
+    '''
+    cd = collection_data
+    rd = cd.rd
+    df = cd.data_frame
+    self_df = cd.self_data_frame
+    probes = {}
+    for probe_id, stats in df.groupby('probe_id'):
+        probe_id = int(probe_id)
+        self_stats = self_df[self_df['probe_id'] == probe_id]
+        probes[probe_id] = {
+            'name': rd.probes.loc[probe_id, 'description'],
+            'stats': stats[['timestamp', 'count', *STATS]].reset_index(
+                drop=True),
+            'self_stats': self_stats[['timestamp', *SELF_STATS]].reset_index(
+                drop=True),
+            'histogram': _used_bins(cd.global_histogram[probe_id]),
+            'ter_histogram': _used_bins(cd.global_ter_histogram[probe_id],
+                                        cd.min_ter),
+            'heatmap': cd.heatmap(probe_id, max_columns),
+            'load': cd.latency_vs_load(probe_id)[[
+                'timestamp', 'mean', *LOAD_METRICS
+            ]].reset_index(drop=True)
+        }
+    collection = rd.collections.loc[rd.collection_id]
+    return {
+        'version': CACHE_VERSION,
+        'collection_id': int(rd.collection_id),
+        'start': int(collection['start']),
+        'end': int(collection['end']),
+        'git_commit': collection['git_commit'],
+        'tags': list(rd.tags['tag']),
+        'probes': probes,
+        'phases': {t: cd.phase_breakdown(t)
+                   for t in cd.transactors()},
+        'flamegraph': cd.flamegraph()
+    }
+
+
+def _used_bins(hist, first_bin=0):
+    '''Bins and counts of a histogram from its first to its last used bin'''
+    used = np.flatnonzero(hist)
+    if not len(used):
+        return None
+    return (np.arange(used[0], used[-1] + 1) + first_bin,
+            hist[used[0]:used[-1] + 1])
+
+
+def _histogram_figure(histogram, y_axis_label, y_range=None):
+    bins, counts = histogram
+    f = figure(
+        plot_height=300,
+        plot_width=250,
+        x_axis_label='count',
+        y_axis_label=y_axis_label,
+        **({'y_range': y_range} if y_range else {}))
+    f.hbar(y=bins, right=counts, height=1)
+    return f
+
+
+def _probe_row(probe, width):
+    stats = probe['stats']
+    source = ColumnDataSource(stats)
+    timeline = figure(
+        plot_height=300,
+        plot_width=width,
+        title=f'{probe["name"]} ({stats["count"].sum()} calls)',
+        x_axis_label='timestamp',
+        y_axis_label='log2 usec')
+    for stat, color in zip(STATS, ['#3182bd', '#31a354', '#e6550d']):
+        timeline.line(
+            x='timestamp',
+            y=stat,
+            color=color,
+            legend=value(stat),
+            source=source)
+    self_source = ColumnDataSource(probe['self_stats'])
+    for stat, color in zip(SELF_STATS, ['#3182bd', '#31a354']):
+        timeline.line(
+            x='timestamp',
+            y=stat,
+            color=color,
+            line_dash='dashed',
+            legend=value('self ' + stat),
+            source=self_source)
+    figures = [
+        timeline,
+        _histogram_figure(probe['histogram'], 'bin', timeline.y_range)
+    ]
+    heatmap = probe['heatmap']
+    if heatmap is not None:
+        f = figure(
+            plot_height=300,
+            plot_width=width,
+            x_range=timeline.x_range,
+            x_axis_label='timestamp',
+            y_axis_label='log2 usec')
+        f.image(
+            image=[heatmap['image']],
+            x=heatmap['x'],
+            y=heatmap['y'],
+            dw=heatmap['dw'],
+            dh=heatmap['dh'],
+            palette=Viridis256)
+        figures.append(f)
+    return row(*figures)
+
+
+def _load_row(probe, width):
+    '''Mean time of the probe against every load metric, and its TERs'''
+    source = ColumnDataSource(probe['load'])
+    figures = []
+    for metric in LOAD_METRICS:
+        f = figure(
+            plot_height=300,
+            plot_width=width // len(LOAD_METRICS),
+            title=f'{probe["name"]} latency vs {metric}',
+            x_axis_label=metric,
+            y_axis_label='mean (log2 usec)')
+        f.circle(x=metric, y='mean', size=4, alpha=0.5, source=source)
+        figures.append(f)
+    if probe['ter_histogram'] is not None:
+        figures.append(_histogram_figure(probe['ter_histogram'], 'ter'))
+    return row(*figures)
+
+
+def _phase_figure(transactor, df, width):
+    phases = list(df.columns)
+    f = figure(
+        plot_height=300,
+        plot_width=width,
+        title=f'{transactor} time per phase',
+        x_axis_label='timestamp',
+        y_axis_label='total time (usec)')
+    # bar width is the smallest time between slices
+    bar_width = 0.9 * np.diff(df.index).min() if len(df) > 1 else 0.9
+    f.vbar_stack(
+        phases,
+        x='timestamp',
+        width=bar_width,
+        color=['#3182bd', '#31a354', '#e6550d'][:len(phases)],
+        legend=[value(p) for p in phases],
+        source=ColumnDataSource(
+            dict(timestamp=df.index, **{p: df[p]
+                                        for p in phases})))
+    return f
+
+
+def _flame_figure(df, width):
+    num_samples = df.loc[df['depth'] == 0, 'count'].sum()
+    f = figure(
+        plot_height=400,
+        plot_width=width,
+        title=f'Sampled stacks: {num_samples} samples',
+        tools='xpan,xwheel_zoom,reset,hover',
+        tooltips=[('function', '@name'), ('samples', '@count')],
+        x_axis_label='samples',
+        y_axis_label='stack depth')
+    f.quad(
+        left='x0',
+        right='x1',
+        bottom='depth',
+        top='top',
+        line_color='white',
+        fill_color='#e6550d',
+        source=ColumnDataSource(df.assign(top=df['depth'] + 0.95)))
+    return f
+
+
+def _title(data):
+    date = datetime.datetime.fromtimestamp(
+        data['start']).strftime('%Y-%m-%d %H:%M:%S')
+    return f'Collection {data["collection_id"]}: {date}'
+
+
+def report_layout(data, width=800):
+    '''Bokeh layout of the plots of a collection (see `plot_data`)'''
+    header = Div(text=(
+        f'<h1>{html.escape(_title(data))}</h1>'
+        f'<p>git commit {html.escape(str(data["git_commit"]))}, tags: '
+        f'{html.escape(", ".join(data["tags"]))}</p>'))
+    rows = [header]
+    for _, probe in sorted(data['probes'].items()):
+        rows.append(_probe_row(probe, width))
+        rows.append(_load_row(probe, width))
+    rows.extend(
+        _phase_figure(t, df, width) for t, df in data['phases'].items())
+    if len(data['flamegraph']):
+        rows.append(_flame_figure(data['flamegraph'], width))
+    return column(*rows)
+
+
+def _cache_key(db_file, max_points, max_columns):
+    stat = os.stat(db_file)
+    return (CACHE_VERSION, stat.st_mtime_ns, stat.st_size, max_points,
+            max_columns)
+
+
+def load_plot_data(db_file, collection_id, cache_dir, max_points=None,
+                   max_columns=800):
+    '''
+    Plot data of a collection, from the cache if the db didn't change since
+    it was computed
+    '''
+    key = _cache_key(db_file, max_points, max_columns)
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, f'{collection_id}.pickle')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as file:
+                cached_key, data = pickle.load(file)
+            if cached_key == key:
+                return data
+    data = plot_data(
+        get_collection_data(db_file, collection_id, max_points=max_points),
+        max_columns)
+    if cache_file:
+        # written under another name first so a reader never sees half a file
+        with open(cache_file + '.tmp', 'wb') as file:
+            pickle.dump((key, data), file)
+        os.replace(cache_file + '.tmp', cache_file)
+    return data
+
+
+def render_collection(db_file, collection_id, out_dir, png=False,
+                      inline=False, max_points=None, width=800):
+    '''Write the html (and png) report of a collection, return its file name'''
+    cache_dir = os.path.join(out_dir, '.cache')
+    data = load_plot_data(db_file, collection_id, cache_dir, max_points,
+                          width)
+    layout = report_layout(data, width)
+    name = f'collection_{collection_id}'
+    with open(os.path.join(out_dir, name + '.html'), 'w') as file:
+        file.write(
+            file_html(layout, INLINE if inline else CDN, _title(data)))
+    if png:
+        # needs selenium and a browser driver
+        export_png(layout, filename=os.path.join(out_dir, name + '.png'))
+    return name + '.html', data
+
+
+def write_index(out_dir, db_file, entries):
+    '''Page with a link to the report of every collection'''
+    items = ''.join(
+        f'<li><a href="{html.escape(file_name)}">{html.escape(_title(data))}</a>'
+        f' ({len(data["probes"])} probes, {html.escape(str(data["git_commit"]))})</li>\n'
+        for file_name, data in entries)
+    with open(os.path.join(out_dir, 'index.html'), 'w') as file:
+        file.write(f'<html><head><title>Rippled eBPF Probes</title></head>'
+                   f'<body><h1>{html.escape(db_file)}</h1>\n<ul>\n{items}'
+                   f'</ul></body></html>\n')
+
+
+def collection_ids(db_file):
+    conn = sqlite3.connect(db_file)
+    ids = pd.read_sql_query('select id from collections order by start;',
+                            conn)['id']
+    conn.close()
+    return [int(i) for i in ids]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Render standalone html reports of the collections of a db")
+    parser.add_argument(
+        "--db", required=True, help="Database file with the trace results")
+    parser.add_argument(
+        "--out", default='report', help="Directory to write the reports to")
+    parser.add_argument(
+        "--collection",
+        type=int,
+        action='append',
+        help="Collection id to render. May be repeated. Default is all the collections")
+    parser.add_argument(
+        "--png",
+        action='store_true',
+        help="Also write png images (needs selenium and a browser driver)")
+    parser.add_argument(
+        "--inline",
+        action='store_true',
+        help="Include bokeh's javascript in the html, so reports work offline")
+    parser.add_argument(
+        "--max-points",
+        type=int,
+        help="Read rollups with at least this many slices rather than the raw slices")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes. Default is the number of cpus")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.out, '.cache'), exist_ok=True)
+    ids = args.collection or collection_ids(args.db)
+    entries = {}
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(render_collection, args.db, collection_id,
+                            args.out, args.png, args.inline, args.max_points):
+            collection_id
+            for collection_id in ids
+        }
+        for future in as_completed(futures):
+            collection_id = futures[future]
+            try:
+                entries[collection_id] = future.result()
+            except Exception as e:
+                print(f'Collection {collection_id} failed: {e}', file=sys.stderr)
+                continue
+            print(f'Wrote {entries[collection_id][0]}')
+    write_index(args.out, args.db,
+                [entries[i] for i in ids if i in entries])
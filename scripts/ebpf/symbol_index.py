@@ -0,0 +1,249 @@
+#/usr/bin/env python
+#
+# symbol_index  Cache of the function symbols of a binary, keyed on the ELF
+#               build-id. Resolving symbols with a regex scans the whole (huge)
+#               rippled binary every time probes are attached. The index is
+#               built once per build and afterwards attaching a probe is a
+#               dictionary lookup. It also supports wildcards on demangled
+#               names, for example `ripple::*::doApply`.
+
+import argparse
+from fnmatch import fnmatchcase
+import numpy as np
+import os
+import sqlite3
+import struct
+import subprocess
+
+DEFAULT_CACHE_FILE = os.environ.get(
+    'XRPL_PROBE_SYMBOL_CACHE',
+    os.path.expanduser('~/.cache/xrpl-probe/symbols.db'))
+
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+STT_FUNC = 2
+
+
+class ElfFile:
+    '''Just enough of an ELF parser to read the build-id and function symbols'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            ident = f.read(16)
+            if ident[:4] != b'\x7fELF':
+                raise ValueError(f"{path} is not an ELF file")
+            self.is64 = ident[4] == 2
+            self.endian = '<' if ident[5] == 1 else '>'
+            if self.is64:
+                header = struct.unpack(self.endian + 'HHIQQQIHHHHHH',
+                                       f.read(48))
+                shdr_format = 'IIQQQQIIQQ'
+            else:
+                header = struct.unpack(self.endian + 'HHIIIIIHHHHHH',
+                                       f.read(36))
+                shdr_format = 'IIIIIIIIII'
+            shoff, shentsize, shnum, shstrndx = (header[5], header[10],
+                                                 header[11], header[12])
+            self.sections = []
+            for i in range(shnum):
+                f.seek(shoff + i * shentsize)
+                (name, type, flags, addr, offset, size, link, info, align,
+                 entsize) = struct.unpack(
+                     self.endian + shdr_format,
+                     f.read(struct.calcsize(shdr_format)))
+                self.sections.append({
+                    'name': name,
+                    'type': type,
+                    'offset': offset,
+                    'size': size,
+                    'link': link
+                })
+        if self.sections:
+            names = self.read_section(self.sections[shstrndx])
+            for s in self.sections:
+                end = names.find(b'\0', s['name'])
+                s['name'] = names[s['name']:end].decode()
+
+    def read_section(self, section):
+        with open(self.path, 'rb') as f:
+            f.seek(section['offset'])
+            return f.read(section['size'])
+
+    def build_id(self):
+        for s in self.sections:
+            if s['name'] == '.note.gnu.build-id':
+                note = self.read_section(s)
+                namesz, descsz, _ = struct.unpack(self.endian + 'III',
+                                                  note[:12])
+                desc_start = 12 + ((namesz + 3) & ~3)
+                return note[desc_start:desc_start + descsz].hex()
+        return None
+
+    def functions(self):
+        '''Return a dictionary of mangled function name to address'''
+        if self.is64:
+            dtype = np.dtype([('name', 'u4'), ('info', 'u1'), ('other', 'u1'),
+                              ('shndx', 'u2'), ('value', 'u8'),
+                              ('size', 'u8')])
+        else:
+            dtype = np.dtype([('name', 'u4'), ('value', 'u4'), ('size', 'u4'),
+                              ('info', 'u1'), ('other', 'u1'),
+                              ('shndx', 'u2')])
+        dtype = dtype.newbyteorder(self.endian)
+        result = {}
+        for s in self.sections:
+            if s['type'] not in (SHT_SYMTAB, SHT_DYNSYM):
+                continue
+            syms = np.frombuffer(self.read_section(s), dtype=dtype)
+            syms = syms[((syms['info'] & 0xf) == STT_FUNC)
+                        & (syms['value'] != 0) & (syms['shndx'] != 0)]
+            strtab = self.read_section(self.sections[s['link']])
+            # find the end of every name with one pass over the string table
+            nuls = np.flatnonzero(np.frombuffer(strtab, dtype=np.uint8) == 0)
+            ends = nuls[np.searchsorted(nuls, syms['name'])]
+            for start, end, addr in zip(syms['name'], ends, syms['value']):
+                name = strtab[start:end].decode('utf-8', 'replace')
+                result.setdefault(name, int(addr))
+        return result
+
+
+def binary_key(path):
+    '''The build-id of the binary, or its path, size and mtime if it has none'''
+    build_id = ElfFile(path).build_id()
+    if build_id:
+        return build_id
+    st = os.stat(path)
+    return f'{os.path.realpath(path)}:{st.st_size}:{int(st.st_mtime)}'
+
+
+def demangle(names):
+    '''Demangle the names with one call to c++filt. Names are unchanged if c++filt is missing'''
+    try:
+        p = subprocess.run(['c++filt'],
+                           input='\n'.join(names),
+                           stdout=subprocess.PIPE,
+                           universal_newlines=True,
+                           check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return list(names)
+    result = p.stdout.split('\n')
+    if len(result) < len(names):
+        return list(names)
+    return result[:len(names)]
+
+
+def short_name(demangled):
+    '''Demangled name without the argument list, the name wildcards match'''
+    i = demangled.find('(')
+    return demangled if i < 0 else demangled[:i]
+
+
+class BinarySymbols:
+    def __init__(self, key, rows):
+        self.key = key
+        # mangled name -> address
+        self.addresses = {}
+        # mangled name -> demangled name without the argument list
+        self.names = {}
+        for mangled, demangled, addr in rows:
+            self.addresses[mangled] = addr
+            self.names[mangled] = demangled
+
+    def address(self, mangled):
+        return self.addresses.get(mangled)
+
+    def match(self, pattern):
+        '''
+        Return a list of (mangled, demangled, address) for every function
+        whose demangled name (without arguments) matches the glob `pattern`.
+        '''
+        return [(m, d, self.addresses[m]) for m, d in self.names.items()
+                if fnmatchcase(d, pattern)]
+
+
+class SymbolIndex:
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE):
+        self.cache_file = cache_file
+        self.conn = None
+        # binary key -> BinarySymbols, so a binary is only loaded once per process
+        self.binaries = {}
+        # path -> binary key
+        self.keys = {}
+
+    def _connect(self):
+        if self.conn:
+            return self.conn
+        dirname = os.path.dirname(self.cache_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(self.cache_file)
+        c = self.conn.cursor()
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS binaries (key TEXT PRIMARY KEY, path TEXT);
+        ''')
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS symbols (key TEXT, mangled TEXT,
+                                            demangled TEXT, addr INTEGER);
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS SymbolsKeyIndex ON symbols (key);
+        ''')
+        self.conn.commit()
+        return self.conn
+
+    def symbols(self, path):
+        '''Return the BinarySymbols of the binary, building the index if needed'''
+        if path not in self.keys:
+            self.keys[path] = binary_key(path)
+        key = self.keys[path]
+        if key in self.binaries:
+            return self.binaries[key]
+
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute('SELECT count(*) FROM binaries WHERE key = ?;', (key, ))
+        if c.fetchone()[0] == 0:
+            functions = ElfFile(path).functions()
+            mangled = list(functions)
+            demangled = [short_name(d) for d in demangle(mangled)]
+            c.executemany(
+                'INSERT INTO symbols VALUES (?, ?, ?, ?);',
+                ((key, m, d, functions[m]) for m, d in zip(mangled, demangled)))
+            c.execute('INSERT INTO binaries VALUES (?, ?);', (key, path))
+            conn.commit()
+        c.execute('SELECT mangled, demangled, addr FROM symbols WHERE key = ?;',
+                  (key, ))
+        self.binaries[key] = BinarySymbols(key, c.fetchall())
+        return self.binaries[key]
+
+    def address(self, path, mangled):
+        '''Address of the mangled symbol in the binary, or None if it is not found'''
+        return self.symbols(path).address(mangled)
+
+
+# shared by every probe in the process
+_index = None
+
+
+def symbol_index():
+    global _index
+    if _index is None:
+        _index = SymbolIndex()
+    return _index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="List the functions of a binary matching a pattern")
+    parser.add_argument("-e", "--exe", required=True, help="binary to index")
+    parser.add_argument(
+        "--cache", default=DEFAULT_CACHE_FILE, help="symbol cache file")
+    parser.add_argument(
+        "pattern",
+        help="glob on the demangled name without arguments, e.g. 'ripple::*::doApply'")
+    args = parser.parse_args()
+
+    symbols = SymbolIndex(args.cache).symbols(args.exe)
+    for mangled, demangled, addr in sorted(symbols.match(args.pattern)):
+        print(f'{addr:#x} {demangled} {mangled}')
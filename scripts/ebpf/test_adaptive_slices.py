@@ -0,0 +1,71 @@
+import numpy as np
+
+from adaptive_slices import AdaptiveSlices
+from histogram import Histogram, LOG2_BINS, TER_BINS, TER_FIRST_BIN
+
+KEY = ('timings', 1, 7)
+
+
+def run_slices(num_slices, slow=(), failing=(), **kwargs):
+    '''
+    Add slices of 50 calls, return the stored (timestamp, calls, failures,
+    timestamps of the fine slices stored)
+    '''
+    stored = []
+
+    def write(timestamp, timings, ters):
+        failures = sum(
+            h.total() - h.counts[0 - TER_FIRST_BIN] for h in ters.values())
+        slices = sorted(k[2] for k in timings if k[0] == 'slice')
+        stored.append((timestamp, timings[KEY].total(), failures, slices))
+
+    slices = AdaptiveSlices(write, **kwargs)
+    rng = np.random.default_rng(0)
+    for timestamp in range(num_slices):
+        h = Histogram.zeros(LOG2_BINS)
+        values = rng.integers(100, 200, 50)
+        h.add_values(values * 20 if timestamp in slow else values)
+        ters = Histogram.zeros(TER_BINS, TER_FIRST_BIN)
+        ters.counts[0 - TER_FIRST_BIN] = 50
+        if timestamp in failing:
+            ters.counts[128 - TER_FIRST_BIN] = 30
+        # a probe of its own, so the stored rows tell which slices they hold
+        marker = Histogram.zeros(LOG2_BINS)
+        marker.add_values([1])
+        slices.add(timestamp, {
+            KEY: h,
+            ('slice', 0, timestamp): marker
+        }, {(1, 7): ters})
+    slices.flush()
+    return stored
+
+
+def test_totals():
+    stored = run_slices(100, slow=[50], failing=[70], coarse_slices=10,
+                        ring_size=5, after=3)
+    assert sum(s[1] for s in stored) == 100 * 50
+    assert sum(s[2] for s in stored) == 30
+
+
+def test_fine_slices_around_anomaly():
+    stored = run_slices(100, slow=[50], coarse_slices=10, ring_size=5,
+                        after=3)
+    timestamps = [s[0] for s in stored]
+    # the ring before the anomaly, the anomaly and the slices after it
+    assert all(t in timestamps for t in range(45, 54))
+    # no anomaly, only coarse slices
+    assert len(run_slices(100, coarse_slices=10, ring_size=5, after=3)) == 10
+
+
+def test_time_order_across_anomaly():
+    # anomalies while a coarse slice is in progress
+    stored = run_slices(100, slow=[23, 57], failing=[81], coarse_slices=10,
+                        ring_size=5, after=3)
+    timestamps = [s[0] for s in stored]
+    assert timestamps == sorted(timestamps)
+    assert len(set(timestamps)) == len(timestamps)
+    # every stored slice holds fine slices after those of the one before it
+    # and is stamped with its last one
+    spans = [s[3] for s in stored]
+    assert [t for span in spans for t in span] == list(range(100))
+    assert all(s[0] == s[3][-1] for s in stored)
@@ -0,0 +1,55 @@
+import os
+import pandas as pd
+import shutil
+import sqlite3
+
+from collection_db import DB
+from fleet_merge import read_source, run
+
+TX_ID = 'AB' * 32
+
+
+def write_source(db_file):
+    db = DB(db_file)
+    node = db.add_node('node')
+    # applied twice in the same second
+    db.add_tx(TX_ID, 1000, 10, 0, 0, node)
+    db.add_tx(TX_ID, 1000, 20, 0, 0, node)
+    # at the end of the first collection, where the second starts
+    db.add_tx(TX_ID, 2000, 30, 0, 0, node)
+    stack = db.add_stack([db.add_frame('main'), db.add_frame('apply')])
+    db.add_stack_samples(1500, [(stack, 5, node)])
+    db.add_collection(1000, 2000, 'abc', [], [node])
+    db.add_collection(2000, 3000, 'abc', [], [node])
+    db.close()
+
+
+def test_copies_merged_once(tmp_path, capsys):
+    for name in ['a', 'b']:
+        os.makedirs(tmp_path / name)
+        write_source(str(tmp_path / name / 'probes.db'))
+    fleet = str(tmp_path / 'fleet.db')
+    run(fleet, [str(tmp_path / 'a'), str(tmp_path / 'b')], jobs=1)
+    conn = sqlite3.connect(fleet)
+    durations = pd.read_sql_query(
+        'select duration from transactions order by duration;', conn)
+    assert list(durations['duration']) == [10, 20, 30]
+    # stacks are merged with their frames
+    stacks = pd.read_sql_query(
+        '''select stacks.frames as frames, sum(counts) as counts
+        from stack_samples join stacks on stack_id = stacks.id
+        group by stack_id;''', conn)
+    frames = dict(conn.execute('select id, name from frames;').fetchall())
+    assert [[frames[int(f)] for f in s.split(',')]
+            for s in stacks['frames']] == [['main', 'apply']]
+    assert list(stacks['counts']) == [10]
+
+
+def test_collection_windows_dont_overlap(tmp_path):
+    db_file = str(tmp_path / 'probes.db')
+    write_source(db_file)
+    data = read_source(db_file, [])
+    assert sorted(data['transactions']['duration']) == [10, 20, 30]
+    data = read_source(db_file, [2])
+    # the boundary row belongs to the second collection
+    assert sorted(data['transactions']['duration']) == [10, 20]
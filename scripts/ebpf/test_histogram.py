@@ -0,0 +1,34 @@
+import numpy as np
+
+from histogram import log2_bins
+
+
+def bpf_log2(v):
+    '''bcc's bpf_log2 of a 32 bit value'''
+    r = (v > 0xFFFF) << 4
+    v >>= r
+    shift = (v > 0xFF) << 3
+    v >>= shift
+    r |= shift
+    shift = (v > 0xF) << 2
+    v >>= shift
+    r |= shift
+    shift = (v > 0x3) << 1
+    v >>= shift
+    r |= shift
+    return r | (v >> 1)
+
+
+def bpf_log2l(v):
+    '''bcc's bpf_log2l, the slot of the timing histograms'''
+    hi = v >> 32
+    if hi:
+        return bpf_log2(hi) + 32 + 1
+    return bpf_log2(v & 0xFFFFFFFF) + 1
+
+
+def test_log2_bins_match_bpf():
+    values = [0, 1, 2, 3]
+    for e in range(2, 63):
+        values.extend([(1 << e) - 1, 1 << e, (1 << e) + 1])
+    assert log2_bins(values).tolist() == [bpf_log2l(v) for v in values]
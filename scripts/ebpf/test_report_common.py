@@ -0,0 +1,112 @@
+import threading
+
+import report_common
+from collection_db import DB
+from histogram import Histogram, LOG2_BINS
+from report_common import CollectionDataPool, ReportData, read_probe
+from rollup import RollupDB
+from segment_log import SegmentDB
+
+
+def loaded(db_file_name, collection_id, node, max_points):
+    return collection_id
+
+
+def test_pool_keeps_max_cached(monkeypatch):
+    monkeypatch.setattr(report_common, 'get_collection_data', loaded)
+    pool = CollectionDataPool(max_workers=1, max_cached=2)
+    for collection_id in [1, 2, 1, 3]:
+        assert pool.submit('probes.db', collection_id).result() == collection_id
+    # 2 is the least recently requested
+    assert [k[1] for k in pool.futures] == [1, 3]
+    pool.shutdown()
+
+
+def test_precompute_respects_max_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr(report_common, 'get_collection_data', loaded)
+    db_file = str(tmp_path / 'probes.db')
+    db = DB(db_file)
+    for start in range(5):
+        db.add_collection(start, start + 1, 'abc', [])
+    db.close()
+    pool = CollectionDataPool(max_workers=1, max_cached=2)
+    futures = pool.precompute(db_file).result()
+    assert [f.result() for f in futures] == [4, 5]
+    assert sorted(k[1] for k in pool.futures) == [4, 5]
+    futures = pool.precompute(db_file, limit=1).result()
+    assert [f.result() for f in futures] == [5]
+    # the latest collection, looked up on the pool
+    threads = []
+    default_collection_id = ReportData.default_collection_id
+    monkeypatch.setattr(
+        ReportData, 'default_collection_id', lambda f: threads.append(
+            threading.current_thread()) or default_collection_id(f))
+    assert pool.submit(db_file).result() == 5
+    assert threads and threading.current_thread() not in threads
+    pool.shutdown()
+
+
+def test_rollups_clipped_to_collection(tmp_path):
+    db_file = str(tmp_path / 'probes.db')
+    db = RollupDB(db_file)
+    probe_id = db.add_probe('probe')
+    h = Histogram.zeros(LOG2_BINS)
+    h.add_values([10])
+    # a slice every 10 seconds, two collections sharing an hour
+    for timestamp in range(1000, 9001, 10):
+        db.add_timing(probe_id, timestamp, h)
+    first = db.add_collection(1000, 4999, 'abc', [], [0])
+    second = db.add_collection(5000, 9000, 'abc', [], [0])
+    db.rollup(20000)
+    db.close()
+    for collection_id, start, end in [(first, 1000, 4999),
+                                      (second, 5000, 9000)]:
+        rd = ReportData(db_file, collection_id, max_points=1)
+        assert rd.tier == '1h'
+        assert rd.timings['counts'].sum() == len(range(start, end + 1, 10))
+        assert rd.timings['timestamp'].between(start, end).all()
+
+
+def test_read_probe_nodes_and_segments(tmp_path):
+    db_file = str(tmp_path / 'probes.db')
+    db = DB(db_file)
+    probe_id = db.add_probe('probe')
+    h = Histogram.zeros(LOG2_BINS)
+    h.add_values([10])
+    # another node's collection at the same time, and another probe
+    db.add_timing(probe_id, 1000, h, node=1)
+    db.add_timing(probe_id, 1000, h, node=2)
+    db.add_timing(probe_id + 1, 1000, h, node=1)
+    collection_id = db.add_collection(1000, 2000, 'abc', [], [1])
+    db.add_collection(1000, 2000, 'abc', [], [2])
+    db.close()
+    db = SegmentDB(db_file)
+    db.add_timing(probe_id, 1500, h, node=1)
+    db.add_timing(probe_id, 1500, h, node=2)
+    db.close()
+    tier, df = read_probe(db_file, 'timings', probe_id, 1000, 2000,
+                          collection_id)
+    assert tier == 'raw'
+    assert sorted(df['timestamp']) == [1000, 1500]
+    assert set(df['node']) == {1}
+
+
+def test_read_probe_back_to_back_collections(tmp_path):
+    db_file = str(tmp_path / 'probes.db')
+    db = DB(db_file)
+    probe_id = db.add_probe('probe')
+    fast, slow = Histogram.zeros(LOG2_BINS), Histogram.zeros(LOG2_BINS)
+    fast.add_values([10])
+    slow.add_values([1 << 20])
+    for timestamp in range(1000, 3001, 10):
+        db.add_timing(probe_id, timestamp, fast if timestamp <= 2000 else slow)
+    first = db.add_collection(1000, 2000, 'abc', [], [0])
+    second = db.add_collection(2001, 3000, 'abc', [], [0])
+    db.close()
+    # the window of the first collection aligned to 4096 second buckets
+    _, df = read_probe(db_file, 'timings', probe_id, 0, 4095, first)
+    assert df['timestamp'].between(1000, 2000).all()
+    assert df['log_bin'].max() == 4
+    _, df = read_probe(db_file, 'timings', probe_id, 0, 4095, second)
+    assert df['timestamp'].between(2001, 3000).all()
+    assert df['log_bin'].min() == 21
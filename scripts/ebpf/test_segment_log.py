@@ -0,0 +1,61 @@
+import numpy as np
+import os
+import pandas as pd
+import pytest
+import sqlite3
+
+from segment_log import SegmentDB, compact, read_segments, segment_dir, tx_rows
+from tx_lookup import lookup
+
+# ids ending in zero bytes, and all zero
+IDS = ['AB' * 30 + '0000', '00' * 32, '01' + '00' * 31, 'CD' * 32]
+
+
+def write_txs(db_file, capacity=2):
+    db = SegmentDB(db_file, capacity=capacity)
+    for i, tx_id in enumerate(IDS):
+        db.add_tx(tx_id, 1000 + i, 10 * i, 0, 0)
+    db.add_collection(1000, 2000, 'abc', [], [0])
+    db.close()
+
+
+def test_ids_round_trip(tmp_path):
+    db_file = str(tmp_path / 'probes.db')
+    write_txs(db_file)
+    records = read_segments(segment_dir(db_file), 'tx')
+    assert tx_rows(records)['id'] == IDS
+
+
+def test_compact_keeps_ids(tmp_path):
+    db_file = str(tmp_path / 'probes.db')
+    write_txs(db_file)
+    compact(db_file, include_open=True)
+    df = pd.read_sql_query('select id from transactions order by timestamp;',
+                           sqlite3.connect(db_file))
+    assert list(df['id']) == IDS
+
+
+def test_lookup_segments(tmp_path):
+    db_file = str(tmp_path / 'probes.db')
+    write_txs(db_file)
+    df = lookup([db_file], IDS[:2])
+    assert sorted(df['id']) == sorted(IDS[:2])
+
+
+def test_compact_after_interrupted_compact(tmp_path, monkeypatch):
+    db_file = str(tmp_path / 'probes.db')
+    write_txs(db_file)
+
+    def fail(path):
+        raise OSError('stopped')
+
+    # stopped after copying the first segment, before removing it
+    with monkeypatch.context() as m:
+        m.setattr(os, 'remove', fail)
+        with pytest.raises(OSError):
+            compact(db_file, include_open=True)
+    compact(db_file, include_open=True)
+    df = pd.read_sql_query('select id from transactions order by timestamp;',
+                           sqlite3.connect(db_file))
+    assert list(df['id']) == IDS
+    assert read_segments(segment_dir(db_file), 'tx').size == 0
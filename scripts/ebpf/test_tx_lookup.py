@@ -0,0 +1,55 @@
+import os
+import pytest
+
+from collection_db import DB
+from tx_lookup import TxIndexDB, id_array, lookup
+
+IDS = ['%064X' % (i * 0x1234567 + 1) for i in range(4)]
+
+
+def write_txs(db_file, ids):
+    db = DB(db_file)
+    for i, tx_id in enumerate(ids):
+        db.add_tx(tx_id, 1000 + i, 10 * i, 0, 0)
+    db.close()
+
+
+def test_id_array_rejects_bad_ids():
+    with pytest.raises(ValueError) as e:
+        id_array([IDS[0], 'XYZ', IDS[1][:-1]])
+    assert 'XYZ' in str(e.value)
+    assert IDS[1][:-1] in str(e.value)
+
+
+def test_index_rebuilt_when_transactions_change(tmp_path):
+    db_file = str(tmp_path / 'probes.db')
+    write_txs(db_file, IDS[:2])
+    DB(db_file).add_collection(1000, 2000, 'abc', [], [0])
+    assert len(lookup([db_file], IDS)) == 2
+    # more transactions of the collection, as compacting segments adds
+    write_txs(db_file, IDS[2:])
+    assert sorted(lookup([db_file], IDS)['id']) == IDS
+
+
+def test_missing_db_not_created(tmp_path, capsys):
+    db_file = str(tmp_path / 'missing.db')
+    with pytest.raises(ValueError):
+        TxIndexDB(db_file)
+    assert lookup([db_file], IDS).empty
+    assert 'does not exist' in capsys.readouterr().err
+    assert not os.path.exists(db_file)
+
+
+def test_index_kept_when_other_collections_change(tmp_path, monkeypatch):
+    db_file = str(tmp_path / 'probes.db')
+    write_txs(db_file, IDS[:2])
+    DB(db_file).add_collection(1000, 2000, 'abc', [], [0])
+    TxIndexDB(db_file).index(1)
+    # a later collection's transactions
+    db = DB(db_file)
+    db.add_tx(IDS[2], 5000, 10, 0, 0)
+    db.close()
+    index_db = TxIndexDB(db_file)
+    # used as it is, not rebuilt
+    monkeypatch.setattr(index_db, 'build_index', None)
+    assert list(index_db.index(1).ids) == sorted(id_array(IDS[:2]))
@@ -1,48 +1,169 @@
 #include <uapi/linux/ptrace.h>
 
-BPF_HASH(start, u32);
-BPF_HISTOGRAM(dist);
-BPF_HISTOGRAM(tecs, int, 51);
-BPF_HISTOGRAM(result, int, 51);
-BPF_HISTOGRAM(negs, int, 400);
+// Deepest nesting of traced probes on one thread
+#define MAX_DEPTH 8
 
-int trace_func_entry(struct pt_regs *ctx) {
+// A traced call in progress
+struct frame_t {
+  u64 start;
+  // inclusive time of the traced calls made from this one
+  u64 child;
+  u32 probe;
+  u32 pad;
+};
+
+// Every thread keeps a stack of the traced calls in progress so probes that
+// nest (a transactor span and its doApply phase, for example) or recurse don't
+// overwrite each other, and the time spent in nested probes can be subtracted
+// to get the self (exclusive) time of a probe.
+struct call_stack_t {
+  u32 depth;
+  // frames (bit i for frames[i]) ended by the return of a probe below them
+  // whose own return hasn't run yet, see func_return
+  u32 ended;
+  struct frame_t frames[MAX_DEPTH];
+};
+
+// Histograms are keyed on the traced process and the probe as well as the bin
+// so a single program can collect data for several rippled instances on the
+// same host.
+struct hist_key_t {
+  u32 tgid;
+  u32 probe;
+  u32 slot;
+};
+
+BPF_HASH(stacks, u32, struct call_stack_t, 10240);
+// inclusive time
+BPF_HISTOGRAM(dist, struct hist_key_t, 64 * MAX_NODES * NUM_PROBES);
+// self time: inclusive time less the time in nested probes
+BPF_HISTOGRAM(self_dist, struct hist_key_t, 64 * MAX_NODES * NUM_PROBES);
+BPF_HISTOGRAM(tecs, struct hist_key_t, 51 * MAX_NODES * NUM_PROBES);
+BPF_HISTOGRAM(result, struct hist_key_t, 2 * MAX_NODES * NUM_PROBES);
+BPF_HISTOGRAM(negs, struct hist_key_t, 400 * MAX_NODES * NUM_PROBES);
+
+static inline int func_entry(struct pt_regs *ctx, u32 probe) {
   u64 pid_tgid = bpf_get_current_pid_tgid();
   u32 pid = pid_tgid;
   u32 tgid = pid_tgid >> 32;
   u64 ts = bpf_ktime_get_ns();
 
   FILTER
-  start.update(&pid, &ts);
+  struct call_stack_t *s = stacks.lookup(&pid);
+  if (s == 0) {
+    struct call_stack_t empty = {};
+    stacks.update(&pid, &empty);
+    s = stacks.lookup(&pid);
+    if (s == 0) {
+      return 0;
+    }
+  }
+
+  u32 depth = s->depth;
+  if (depth >= MAX_DEPTH) {
+    // returns were missed (an exception unwound traced calls), start over
+    depth = 0;
+  }
+  s->frames[depth].start = ts;
+  s->frames[depth].child = 0;
+  s->frames[depth].probe = probe;
+  s->depth = depth + 1;
+  // a new call, the returns of the ended frames were missed
+  s->ended = 0;
 
   return 0;
 }
 
-int trace_func_return(struct pt_regs *ctx) {
+static inline void record_times(u32 tgid, u32 probe, u64 inclusive, u64 self) {
+  struct hist_key_t key = {.tgid = tgid, .probe = probe};
+
+  // store as histogram (convert from nsec to usec)
+  key.slot = bpf_log2l(inclusive/1000);
+  dist.increment(key);
+  key.slot = bpf_log2l(self/1000);
+  self_dist.increment(key);
+}
+
+static inline int func_return(struct pt_regs *ctx, u32 probe) {
   u64 pid_tgid = bpf_get_current_pid_tgid();
   u32 pid = pid_tgid;
   u32 tgid = pid_tgid >> 32;
+  u64 ts = bpf_ktime_get_ns();
 
-  // calculate delta time
-  u64* tsp = start.lookup(&pid);
-  if (tsp == 0) {
+  struct call_stack_t *s = stacks.lookup(&pid);
+  if (s == 0) {
     return 0; // missed start
   }
-  u64 delta = bpf_ktime_get_ns() - *tsp;
-  start.delete(&pid);
+  u32 depth = s->depth;
+  if (depth > MAX_DEPTH) {
+    depth = 0;
+  }
 
-  // store as histogram (convert from nsec to usec)
-  dist.increment(bpf_log2l(delta/1000));
+  // The probe's frame is the top one, unless probes started after it end at
+  // the same function return (a span that exits in doApply and the doApply
+  // phase, for example) and their return hasn't run yet.
+  int found = -1;
+#pragma unroll
+  for (int i = MAX_DEPTH - 1; i >= 0; --i) {
+    if (found < 0 && i < depth && s->frames[i].probe == probe) {
+      found = i;
+    }
+  }
 
+  if (found >= 0) {
+    // End the frames above the probe's frame, then the probe's frame. Every
+    // frame adds its inclusive time to its parent's child time. The frames
+    // above are marked ended, so their own return still records their ter.
+#pragma unroll
+    for (int i = MAX_DEPTH - 1; i >= 0; --i) {
+      if (i >= found && i < depth) {
+        u64 inclusive = ts - s->frames[i].start;
+        u64 child = s->frames[i].child;
+        record_times(tgid, s->frames[i].probe, inclusive,
+                     inclusive > child ? inclusive - child : 0);
+        if (i > 0) {
+          s->frames[i - 1].child += inclusive;
+        }
+        if (i > found) {
+          s->ended |= 1 << i;
+        }
+      }
+    }
+    s->depth = found;
+  } else {
+    // The frame was ended by the return of an enclosing probe at the same
+    // function return. Its times are recorded, only the ter is left.
+    int ended = -1;
+#pragma unroll
+    for (int i = MAX_DEPTH - 1; i >= 0; --i) {
+      if (ended < 0 && (s->ended & (1 << i)) && s->frames[i].probe == probe) {
+        ended = i;
+      }
+    }
+    if (ended < 0) {
+      return 0; // missed start
+    }
+    s->ended &= ~(1 << ended);
+  }
+
+  struct hist_key_t key = {.tgid = tgid, .probe = probe};
   int ret = PT_REGS_RC(ctx);
   if (ret>100 && ret<150)
   {
-      tecs.increment(ret-100);
+      key.slot = ret-100;
+      tecs.increment(key);
   }
   else if (ret<0)
-      negs.increment(-ret);
+  {
+      key.slot = -ret;
+      negs.increment(key);
+  }
 
-  result.increment(!!ret);
+  key.slot = !!ret;
+  result.increment(key);
 
   return 0;
 }
+
+// trace_func_entry_N and trace_func_return_N for every probe id N
+PROBE_FUNCTIONS
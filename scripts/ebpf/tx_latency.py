@@ -6,51 +6,160 @@
 # TODO:
 # Support for user probes
 
-from bcc import BPF, USDT
+from bcc import BPF, USDT, PerfType, PerfSWConfig
 import argparse
+import bisect
 from collections import defaultdict
 from contextlib import contextmanager
 import ctypes as ct
+import math
 import numpy as np
 import os
 import signal
-import sqlite3
+import socket
 import time
 
+from adaptive_slices import AdaptiveSlices
+from collection_db import DB
+from histogram import Histogram, LOG2_BINS, ter_histogram
+from metrics_exporter import MetricsExporter, counter_family, histogram_family
+from proc_load import ThreadLoad
+from probe_catalog import DEFAULT_CATALOG, load_catalog, resolve_probes
+from segment_log import SegmentDB
+from symbol_index import symbol_index
+
+# the timed probes are in the probe catalog (see probe_catalog.json)
 mangled_names = {}
-mangled_preflight = {}
-mangled_doapply = {}
 # Transactor::operator()()
 mangled_names['transactor'] = '_ZN6ripple10TransactorclEv'
-mangled_preflight[
-    'payment'] = '_ZN6ripple7Payment9preflightERKNS_16PreflightContextE'
-mangled_doapply['payment'] = '_ZN6ripple7Payment7doApplyEv'
-mangled_preflight[
-    'createoffer'] = '_ZN6ripple11CreateOffer9preflightERKNS_16PreflightContextE'
-mangled_doapply['createoffer'] = '_ZN6ripple11CreateOffer7doApplyEv'
+
+
+# transactor class of rippled's TxType values, used to name probes
+tx_type_names = {
+    0: 'Payment',
+    1: 'EscrowCreate',
+    2: 'EscrowFinish',
+    3: 'SetAccount',
+    4: 'EscrowCancel',
+    5: 'SetRegularKey',
+    7: 'CreateOffer',
+    8: 'CancelOffer',
+    10: 'CreateTicket',
+    12: 'SetSignerList',
+    13: 'PayChanCreate',
+    14: 'PayChanFund',
+    15: 'PayChanClaim',
+    16: 'CreateCheck',
+    17: 'CashCheck',
+    18: 'CancelCheck',
+    19: 'DepositPreauth',
+    20: 'SetTrust',
+    21: 'DeleteAccount',
+    100: 'Change',
+    101: 'Change',
+    102: 'Change'
+}
+
+
+def tx_type_name(tx_type):
+    return tx_type_names.get(tx_type, f'TxType{tx_type}')
+
+
+# upper bound on the number of processes a single collector can trace
+MAX_NODES = 32
+
+
+def resolve_library(exe):
+    libpath = BPF.find_library(exe) or BPF.find_exe(exe)
+    if not libpath:
+        raise ValueError("can't resolve library %s" % exe)
+    return libpath
+
+
+def resolve_targets(pids=None, exes=None):
+    '''
+    Return a list of (pid, library) tuples to attach probes to. A pid of None
+    traces every process running the library. If both pids and exes are given
+    the exes are matched to the pids (a single exe is used for all the pids).
+    '''
+    pids = pids or []
+    exes = exes or []
+    targets = []
+    if pids:
+        if exes and len(exes) not in (1, len(pids)):
+            raise ValueError("number of exes must be 1 or match the number of pids")
+        for i, pid in enumerate(pids):
+            if not exes:
+                # get the exe from the pid
+                exe = f'/proc/{pid}/exe'
+            else:
+                exe = exes[i] if len(exes) > 1 else exes[0]
+            targets.append((pid, resolve_library(exe)))
+    else:
+        targets = [(None, resolve_library(exe)) for exe in exes]
+    if not targets:
+        raise ValueError("must specify a pid or exe to trace")
+    if len(targets) > MAX_NODES:
+        raise ValueError("can trace at most %d processes" % MAX_NODES)
+    return targets
+
+
+def attach_symbol(attach, library, symbol, **kwargs):
+    '''
+    Call `attach` (a uprobe or uretprobe attach function) on a mangled symbol.
+    The address is looked up in the build-id keyed symbol index, so the huge
+    rippled binary is only scanned once per build. Falls back to a regex scan
+    of the binary if the symbol can't be found in the index.
+    '''
+    try:
+        addr = symbol_index().address(library, symbol)
+    except (OSError, ValueError):
+        addr = None
+    if addr is None:
+        attach(name=library, sym_re=symbol, **kwargs)
+    else:
+        attach(name=library, addr=addr, **kwargs)
+
+
+def tgid_filter(targets):
+    '''BPF statement that returns early for processes that are not traced'''
+    pids = [pid for pid, _ in targets]
+    if not pids or None in pids:
+        # an exe is traced system wide, the uprobe already limits the processes
+        return ''
+    cond = ' && '.join(f'tgid != {pid}' for pid in pids)
+    return 'if (%s) { return 0; }' % cond
 
 
 class TXLatency:
-    def __init__(self, trace_entry, trace_exit=None, pid=None, exe=None):
-        if pid and not exe:
-            # get the exe from the pid
-            exe = f'/proc/{pid}/exe'
-
-        if not trace_entry:
-            raise ValueError("must specify entry to trace")
-        if not trace_exit:
-            trace_exit = trace_entry
-
-        library = exe
-        libpath = BPF.find_library(library) or BPF.find_exe(library)
-        if not libpath:
-            raise ValueError("can't resolve library %s" % library)
-        library = libpath
-
-        self.trace_entry = trace_entry
-        self.trace_exit = trace_exit
-        self.pid = pid
-        self.library = library
+    '''
+    Time every probe of the catalog (see probe_catalog.py) with a single BPF
+    program. Each probe gets its own generated entry and return functions and
+    all of them are attached in one pass.
+    '''
+    # number of slots in each per-process, per-probe histogram of tx_latency.c
+    table_sizes = {
+        'dist': 64,
+        'self_dist': 64,
+        'result': 2,
+        'tecs': 51,
+        'negs': 400
+    }
+
+    probe_functions = '''
+int trace_func_entry_{id}(struct pt_regs *ctx) {{ return func_entry(ctx, {id}); }}
+int trace_func_return_{id}(struct pt_regs *ctx) {{ return func_return(ctx, {id}); }}
+'''
+
+    def __init__(self, probes, targets=None):
+        '''`probes` is a list of registered probe_catalog.Probe'''
+        if not probes:
+            raise ValueError("must specify probes to trace")
+        if not targets:
+            raise ValueError("must specify processes to trace")
+
+        self.probes = probes
+        self.targets = targets
 
         # load the program from the c file
         prog_file = os.path.dirname(
@@ -61,48 +170,89 @@ class TXLatency:
         self.b = BPF(text=self.substitutions(bpf_text))
 
     def substitutions(self, program):
-        filter = ''
-        if self.pid:
-            filter = 'if (tgid != %d) { return 0; }' % self.pid
-        bpf_text = program.replace('FILTER', filter)
+        bpf_text = program.replace('FILTER', tgid_filter(self.targets))
+        if None in [pid for pid, _ in self.targets]:
+            max_nodes = MAX_NODES
+        else:
+            max_nodes = len(self.targets)
+        bpf_text = bpf_text.replace('MAX_NODES', str(max_nodes))
+        bpf_text = bpf_text.replace('NUM_PROBES', str(len(self.probes)))
+        functions = ''.join(
+            self.probe_functions.format(id=p.id) for p in self.probes)
+        bpf_text = bpf_text.replace('PROBE_FUNCTIONS', functions)
         return bpf_text
 
     def attach_probes(self):
-        self.b.attach_uprobe(
-            name=self.library,
-            sym_re=self.trace_entry,
-            fn_name="trace_func_entry",
-            pid=self.pid or -1)
-        self.b.attach_uretprobe(
-            name=self.library,
-            sym_re=self.trace_exit,
-            fn_name="trace_func_return",
-            pid=self.pid or -1)
+        for p in self.probes:
+            for pid, library in self.targets:
+                entries, exits = p.symbols.get(library, ([], []))
+                for symbol in entries:
+                    attach_symbol(
+                        self.b.attach_uprobe,
+                        library,
+                        symbol,
+                        fn_name=f"trace_func_entry_{p.id}",
+                        pid=pid or -1)
+                for symbol in exits:
+                    attach_symbol(
+                        self.b.attach_uretprobe,
+                        library,
+                        symbol,
+                        fn_name=f"trace_func_return_{p.id}",
+                        pid=pid or -1)
         matched = self.b.num_open_uprobes()
 
         if matched == 0:
-            raise ValueError(
-                "0 functions matched by \"%s\". Exiting." % self.pattern)
-
-    def _table_to_np(self, table):
-        return np.array([t.value for t in table.itervalues()])
-        pass
+            raise ValueError("0 functions matched by the probe catalog. Exiting.")
+
+    def _table_histograms(self, name):
+        '''
+        Split a table keyed on (tgid, probe, slot) into a dictionary keyed on
+        (probe id, tgid) of Histograms
+        '''
+        size = self.table_sizes[name]
+        rows = [(k.probe, k.tgid, k.slot, v.value)
+                for k, v in self.b.get_table(name).items() if k.slot < size]
+        if not rows:
+            return {}
+        probes, tgids, slots, values = map(np.array, zip(*rows))
+        keys, index = np.unique(
+            np.stack([probes, tgids], axis=1), axis=0, return_inverse=True)
+        stack = Histogram.from_rows(slots, values, size, index=index.ravel(),
+                                    size=len(keys))
+        return {(int(p), int(t)): stack[i] for i, (p, t) in enumerate(keys)}
 
     def dist(self):
-        return self._table_to_np(self.b.get_table("dist"))
+        return self._table_histograms("dist")
+
+    def self_dist(self):
+        return self._table_histograms("self_dist")
 
     def result(self):
-        return self._table_to_np(self.b.get_table("result"))
+        return self._table_histograms("result")
 
     def raw_result(self):
         return self.b.get_table("result")
 
     def tecs(self):
-        return self._table_to_np(self.b.get_table("tecs"))
+        return self._table_histograms("tecs")
 
     def negs(self):
-        return self._table_to_np(self.b.get_table("negs"))
-
+        return self._table_histograms("negs")
+
+    def ters(self):
+        '''Cumulative ter Histograms keyed on (probe id, tgid)'''
+        results = self.result()
+        tecs = self.tecs()
+        negs = self.negs()
+        sizes = self.table_sizes
+        return {
+            key: ter_histogram(
+                results.get(key, Histogram.zeros(sizes['result'])),
+                tecs.get(key, Histogram.zeros(sizes['tecs'])),
+                negs.get(key, Histogram.zeros(sizes['negs'])))
+            for key in set(results) | set(tecs) | set(negs)
+        }
 
 
 class TXUSDTProbes:
@@ -111,23 +261,47 @@ class TXUSDTProbes:
         _fields_ = [("tx_type", ct.c_uint32),
                     ("ter", ct.c_int32),
                     ("duration", ct.c_uint64),
-                    ("id", ct.c_uint8*32)]
-
-    def __init__(self, db, pid=None, exe=None):
-
-        if pid and not exe:
-            # get the exe from the pid
-            exe = f'/proc/{pid}/exe'
+                    ("id", ct.c_uint8*32),
+                    ("tgid", ct.c_uint32),
+                    ("pad", ct.c_uint32),
+                    ("offcpu", ct.c_uint64),
+                    ("futex", ct.c_uint64)]
+
+    # one of these is generated for every traced process, see tx_usdt_probes.c
+    exit_function = '''
+int
+trace_txn_exit_{index}(struct pt_regs* ctx)
+{{
+    uint64_t id_addr = 0, type_addr = 0, ter_addr = 0;
+    bpf_usdt_readarg(1, ctx, &id_addr);
+    bpf_usdt_readarg(2, ctx, &type_addr);
+    bpf_usdt_readarg(3, ctx, &ter_addr);
+    return txn_exit(ctx, id_addr, type_addr, ter_addr);
+}}
+'''
+
+    def __init__(self, db, targets, node_of, offcpu=False):
+        '''
+        `node_of` maps the tgid a transaction ran in to the node id stored
+        with the transaction. With `offcpu` the time a transaction's thread
+        was switched out, and waiting on a futex, is also collected.
+        '''
+        if not targets:
+            raise ValueError("must specify processes to trace")
 
         self.db = db
-        library = exe
-        libpath = BPF.find_library(library) or BPF.find_exe(library)
-        if not libpath:
-            raise ValueError("can't resolve library %s" % library)
-        library = libpath
-
-        self.pid = pid
-        self.library = library
+        self.targets = targets
+        self.node_of = node_of
+        self.offcpu = offcpu
+        # (node, tx type, kind) -> histogram of the off-cpu ('offcpu') or
+        # futex ('lock_wait') time of the transactions in this timeslice
+        self.wait_histograms = defaultdict(lambda: Histogram.zeros(LOG2_BINS))
+        # node -> tx type -> number of transactions in this timeslice
+        self.tx_counts = defaultdict(lambda: defaultdict(int))
+        # (node, tx type) -> number of transactions since the start
+        self.tx_totals = defaultdict(int)
+        # events dropped because the perf buffer was full
+        self.lost = 0
 
         # load the program from the c file
         prog_file = os.path.dirname(
@@ -135,7 +309,10 @@ class TXUSDTProbes:
         with open(prog_file, 'r') as file:
             self.bpf_text = file.read()
 
-        self.usdt_exit = USDT(pid=self.pid)
+        self.usdt_exits = [
+            USDT(pid=pid) if pid else USDT(path=library)
+            for pid, library in self.targets
+        ]
 
     hex_table = {0:'0',1:'1',2:'2',3:'3',4:'4',5:'5',6:'6',7:'7',8:'8',9:'9',
                  10:'A',11:'B',12:'C',13: 'D',14:'E',15:'F'}
@@ -145,209 +322,485 @@ class TXUSDTProbes:
         return ''.join([ht[i>>4] + ht[i&0xf] for i in raw])
 
     def substitutions(self, program):
-        filter = ''
-        if self.pid:
-            filter = 'if (tgid != %d) { return 0; }' % self.pid
-        bpf_text = program.replace('FILTER', filter)
+        bpf_text = program.replace('FILTER', tgid_filter(self.targets))
+        exit_functions = ''.join(
+            self.exit_function.format(index=i)
+            for i in range(len(self.usdt_exits)))
+        bpf_text = bpf_text.replace('USDT_EXIT_FUNCTIONS', exit_functions)
+        bpf_text = bpf_text.replace('OFFCPU', '1' if self.offcpu else '0')
         return bpf_text
 
     def tx_exit_callback(self, cpu, data, size):
         pd = ct.cast(data, ct.POINTER(self.TxExitData)).contents
         timestamp = int(time.time())
-        self.db.add_tx(self.to_hex(pd.id), timestamp, pd.duration, pd.tx_type, pd.ter)
+        node = self.node_of(pd.tgid)
+        self.tx_counts[node][pd.tx_type] += 1
+        self.tx_totals[(node, pd.tx_type)] += 1
+        if not self.offcpu:
+            self.db.add_tx(self.to_hex(pd.id), timestamp, pd.duration,
+                           pd.tx_type, pd.ter, node)
+            return
+        self.db.add_tx(self.to_hex(pd.id), timestamp, pd.duration, pd.tx_type,
+                       pd.ter, node, pd.offcpu, pd.futex)
+        for kind, ns in [('offcpu', pd.offcpu), ('lock_wait', pd.futex)]:
+            self.wait_histograms[(node, pd.tx_type,
+                                  kind)].add_values([ns // 1000])
+
+    def take_wait_histograms(self):
+        '''Return the wait histograms since the last call and start new ones'''
+        result = self.wait_histograms
+        self.wait_histograms = defaultdict(lambda: Histogram.zeros(LOG2_BINS))
+        return result
+
+    def take_tx_counts(self):
+        '''Return the transaction counts since the last call and start new ones'''
+        result = self.tx_counts
+        self.tx_counts = defaultdict(lambda: defaultdict(int))
+        return result
+
+    def lost_callback(self, lost):
+        self.lost += lost
 
     def attach_probes(self):
         # probe must be enabled before the BPF program is compiled or it will never trigger
         # I don't know why
-        self.usdt_exit.enable_probe(probe="transactor_exit", fn_name="trace_txn_exit")
-        self.b = BPF(text=self.substitutions(self.bpf_text), usdt_contexts=[self.usdt_exit])
-        self.b["exit_data"].open_perf_buffer(lambda cpu, data, size: self.tx_exit_callback(cpu, data, size))
+        for i, usdt_exit in enumerate(self.usdt_exits):
+            usdt_exit.enable_probe(
+                probe="transactor_exit", fn_name=f"trace_txn_exit_{i}")
+        self.b = BPF(text=self.substitutions(self.bpf_text), usdt_contexts=self.usdt_exits)
+        self.b["exit_data"].open_perf_buffer(
+            lambda cpu, data, size: self.tx_exit_callback(cpu, data, size),
+            lost_cb=self.lost_callback)
         trace_entry=mangled_names['transactor']
-        self.b.attach_uprobe(
-            name=self.library,
-            sym_re=trace_entry,
-            fn_name="trace_txn_entry",
-            pid=self.pid or -1)
+        for pid, library in self.targets:
+            attach_symbol(
+                self.b.attach_uprobe,
+                library,
+                trace_entry,
+                fn_name="trace_txn_entry",
+                pid=pid or -1)
         matched = self.b.num_open_uprobes()
 
         if matched == 0:
             raise ValueError(
-                "0 functions matched by \"%s\". Exiting." % self.pattern)
-
-
-class DB:
-    def __init__(self, file_name='data.db'):
-        self.file_name = file_name
-        self.conn = sqlite3.connect(self.file_name)
-        # create tables, if needed
-        c = self.conn.cursor()
-        c.execute(
-            "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='probes';"
-        )
-        r = c.fetchone()
-        if r[0] == 0:
-            print('Creating db tables')
-            self.create_tables()
-
-    def create_tables(self):
-        c = self.conn.cursor()
-        c.execute('''
-        CREATE TABLE collections (id INTEGER PRIMARY KEY ASC,
-                                  start INTEGER, end INTEGER, git_commit TEXT);
-        ''')
-        c.execute('''
-        CREATE TABLE probes (id INTEGER PRIMARY KEY ASC, description TEXT);
-        ''')
-        # N.B. sqlite was not comipled with foreign key support on my dev machine.
-        # the following will not work
-        # CREATE TABLE timings (FOREIGN KEY (probe_id) REFERENCES probes(id)...
-        c.execute('''
-        CREATE TABLE timings (probe_id INTEGER, timestamp INTEGER,
-                              log_bin INTEGER, counts INTEGER);
-        ''')
-        c.execute('''
-        CREATE TABLE ters (probe_id INTEGER, timestamp INTEGER,
-                           ter INTEGER, counts INTEGER);
-        ''')
-
-        # store the version and other info as tags
-        c.execute('''
-        CREATE TABLE tags (collection_id INTEGER, tag TEXT);
-        ''')
-        c.execute('''
-        CREATE TABLE transactions (id CHARACTER(64),
-              type INTEGER, timestamp INTEGER, duration INTEGER, ter INTEGER);
-        ''')
-        c.execute('''
-        CREATE INDEX IdIndex ON transactions (id);
-        ''')
-
-        probes = [(0, 'transactor'), (1, 'payment'), (2, 'offer_create')]
-        c.executemany('''INSERT INTO probes VALUES (?,?);''', probes)
-        self.conn.commit()
-
-    def add_timing(self, probe_id, timestamp, histogram):
-        c = self.conn.cursor()
-        values = []
-        for i, v in enumerate(histogram):
-            if v:
-                values.append((probe_id, timestamp, i, int(v)))
-        if values:
-            c.executemany('INSERT INTO timings VALUES (?, ?, ?, ?);', values)
-        self.conn.commit()
-
-    def add_ters(self, probe_id, timestamp, result, tecs, negs):
-        c = self.conn.cursor()
-        values = []
-        if result[0]:
-            values.append((probe_id, timestamp, 0, int(result[0])))  # success
-        for i, v in enumerate(tecs):
-            if v:
-                values.append((probe_id, timestamp, i + 100, int(v)))
-        for i, v in enumerate(negs):
-            if v:
-                values.append((probe_id, timestamp, -i, int(v)))
-        if values:
-            c.executemany('INSERT INTO ters VALUES (?, ?, ?, ?);', values)
-        self.conn.commit()
-
-    def add_collection(self, start, end, commit, tags):
-        c = self.conn.cursor()
-        values = (start, end, commit)
-        c.execute(
-            'INSERT INTO collections (start, end, git_commit) VALUES (?, ?, ?);',
-            values)
-        values = []
-        collection_id = c.lastrowid
-        for t in tags:
-            values.append((collection_id, t))
-        c.executemany('INSERT INTO tags VALUES (?,?);', values)
-        self.conn.commit()
-
-    def add_tx(self, txid_hex, timestamp, duration, tx_type, ter):
-        c = self.conn.cursor()
-        values = (txid_hex, timestamp, duration, tx_type, ter)
-        c.execute(
-            'INSERT INTO transactions (id, timestamp, duration, type, ter) VALUES (?, ?, ?, ?, ?);',
-            values)
-        self.conn.commit()
+                "0 functions matched by \"%s\". Exiting." % trace_entry)
+
+
+class ProcMaps:
+    '''
+    Executable mappings of a process. Used to turn an address into a
+    (binary, offset) pair that is the same for every process running the binary.
+    '''
+
+    def __init__(self, pid):
+        self.mappings = []
+        try:
+            with open(f'/proc/{pid}/maps', 'r') as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) < 6 or 'x' not in parts[1]:
+                        continue
+                    start, end = (int(a, 16) for a in parts[0].split('-'))
+                    self.mappings.append((start, end, int(parts[2], 16),
+                                          parts[5]))
+        except OSError:
+            # the process exited
+            pass
+        self.mappings.sort()
+        self.starts = [m[0] for m in self.mappings]
+
+    def lookup(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr < self.mappings[i][1]:
+            start, _, offset, path = self.mappings[i]
+            return path, addr - start + offset
+        return None, addr
+
+
+class TXProfiler:
+    '''
+    Sample the user stacks of the traced processes with a perf event. Counts
+    are kept in the kernel and every unique stack is symbolized once per
+    binary, not once per sample.
+    '''
+
+    def __init__(self, db, targets, node_of, frequency=99,
+                 transactor_only=False, max_stacks=16384):
+        if not targets or None in [pid for pid, _ in targets]:
+            raise ValueError("profiling needs the pids of the processes to sample")
+
+        self.db = db
+        self.targets = targets
+        self.node_of = node_of
+        self.frequency = frequency
+        self.transactor_only = transactor_only
+        self.max_stacks = max_stacks
+        # (binary, offset) -> frame id
+        self.frame_cache = {}
+        # tuple of frame ids -> stack id
+        self.stack_cache = {}
+        self.proc_maps = {}
+
+        # load the program from the c file
+        prog_file = os.path.dirname(
+            os.path.realpath(__file__)) + '/tx_profile.c'
+        with open(prog_file, 'r') as file:
+            bpf_text = file.read()
+
+        self.b = BPF(text=self.substitutions(bpf_text))
+
+    def substitutions(self, program):
+        bpf_text = program.replace('FILTER', tgid_filter(self.targets))
+        bpf_text = bpf_text.replace('MAX_STACKS', str(self.max_stacks))
+        bpf_text = bpf_text.replace('TRANSACTOR_ONLY',
+                                    '1' if self.transactor_only else '0')
+        return bpf_text
+
+    def attach_probes(self):
+        if self.transactor_only:
+            for pid, library in self.targets:
+                attach_symbol(
+                    self.b.attach_uprobe,
+                    library,
+                    mangled_names['transactor'],
+                    fn_name="trace_transactor_entry",
+                    pid=pid)
+                attach_symbol(
+                    self.b.attach_uretprobe,
+                    library,
+                    mangled_names['transactor'],
+                    fn_name="trace_transactor_return",
+                    pid=pid)
+        self.b.attach_perf_event(
+            ev_type=PerfType.SOFTWARE,
+            ev_config=PerfSWConfig.CPU_CLOCK,
+            fn_name="do_perf_event",
+            sample_freq=self.frequency)
+
+    def _frame_id(self, tgid, addr):
+        if tgid not in self.proc_maps:
+            self.proc_maps[tgid] = ProcMaps(tgid)
+        binary, offset = self.proc_maps[tgid].lookup(addr)
+        key = (binary, offset) if binary else (tgid, addr)
+        frame_id = self.frame_cache.get(key)
+        if frame_id is None:
+            name = self.b.sym(addr, tgid, demangle=True).decode(
+                'utf-8', 'replace')
+            if name == '[unknown]' and binary:
+                name = f'[unknown] ({os.path.basename(binary)})'
+            frame_id = self.db.add_frame(name)
+            self.frame_cache[key] = frame_id
+        return frame_id
+
+    def _stack_id(self, tgid, user_stack_id, stack_traces):
+        # stored root first
+        addrs = list(stack_traces.walk(user_stack_id))
+        frames = tuple(self._frame_id(tgid, a) for a in reversed(addrs))
+        stack_id = self.stack_cache.get(frames)
+        if stack_id is None:
+            stack_id = self.db.add_stack(frames)
+            self.stack_cache[frames] = stack_id
+        return stack_id
+
+    def sample(self, timestamp):
+        counts = self.b.get_table("counts")
+        stack_traces = self.b.get_table("stack_traces")
+        # samples for the same (node, stack) are summed as different kernel
+        # stack ids may symbolize to the same frames
+        samples = defaultdict(int)
+        for k, v in counts.items():
+            stack_id = self._stack_id(k.tgid, k.user_stack_id, stack_traces)
+            samples[(self.node_of(k.tgid), stack_id)] += v.value
+        # the kernel keeps counting while the tables are read, samples taken
+        # between reading and clearing are lost
+        counts.clear()
+        stack_traces.clear()
+        self.db.add_stack_samples(timestamp, [
+            (stack_id, count, node)
+            for (node, stack_id), count in samples.items()
+        ])
 
 
 # this class is meant to be used with a context manager so the end timestamp is correctly written
 class TraceRippled:
-    def __init__(self, pid, exe, commit, tags, db_file):
-        self.db = DB(db_file)
-
-        # transactor_trace = TXLatency(
-        #     trace_entry=mangled_names['transactor'], pid=pid, exe=exe)
-        pay_trace = TXLatency(
-            trace_entry=mangled_preflight['payment'],
-            trace_exit=mangled_doapply['payment'],
-            pid=pid,
-            exe=exe)
-        offer_trace = TXLatency(
-            trace_entry=mangled_preflight['createoffer'],
-            trace_exit=mangled_doapply['createoffer'],
-            pid=pid,
-            exe=exe)
-        self.usdt_probes = TXUSDTProbes(db=self.db, pid=pid, exe=exe)
-        # tuble of probe_id (defined in the db class), if ters should be sampled, and trace
-        self.traces = [
-            # disable transactor trace as the USDT trace also traces the entry and we can't have two entry traces
-            # (0, False, transactor_trace),
-            (1, True, pay_trace),
-            (2, True, offer_trace)]
+    def __init__(self,
+                 pids,
+                 exes,
+                 commit,
+                 tags,
+                 db_file,
+                 node_names=None,
+                 catalog_file=DEFAULT_CATALOG,
+                 offcpu=False,
+                 profile_frequency=0,
+                 profile_transactor_only=False,
+                 metrics_port=None,
+                 metrics_address='',
+                 segments=False,
+                 fine_timeslice=0,
+                 coarse_slices=1,
+                 anomaly_window=120):
+        # with `segments` transactions, timings and ters are written to
+        # segment logs next to the db (see segment_log.py)
+        self.db = SegmentDB(db_file) if segments else DB(db_file)
+
+        targets = resolve_targets(pids, exes)
+        # map the tgid of every traced process to its node id in the db.
+        # Processes found by tracing an exe are added as they are seen.
+        self.nodes = {}
+        # node id -> name, used as the node label of the exported metrics
+        self.node_names = {}
+        node_names = node_names or []
+        for i, (pid, _) in enumerate(targets):
+            if pid is None:
+                continue
+            name = node_names[i] if i < len(node_names) else None
+            self.add_node(pid, name or self.default_node_name(pid))
+
+        # the transactor probe is not in the catalog as the USDT trace also
+        # traces the entry of Transactor::operator()
+        probes = resolve_probes(
+            load_catalog(catalog_file), targets, symbol_index())
+        # new probes are added to the probes table as they are first traced
+        for p in probes:
+            p.id = self.db.add_probe(p.name)
+        self.probes = {p.id: p for p in probes}
+        self.latency = TXLatency(probes, targets)
+        self.usdt_probes = TXUSDTProbes(
+            db=self.db, targets=targets, node_of=self.node_of, offcpu=offcpu)
+        # probe ids of the per transaction type wait histograms
+        self.wait_probes = {}
         # eBPF is computing cumulative results. Save these results so contribution from this timeslice can be computed
-        self.last_culm_timing = [None, None, None]
-        self.last_culm_ters = [None, None, None]
-        for t in self.traces:
-            t[2].attach_probes()
+        # Timings are keyed on (table, probe id, tgid), ters on (probe id, tgid)
+        self.last_culm_timing = {}
+        self.last_culm_ters = {}
+        # with a `fine_timeslice` the probes are sampled every fine slice and
+        # stored `coarse_slices` at a time, except around anomalies
+        self.adaptive = None
+        if fine_timeslice:
+            self.adaptive = AdaptiveSlices(
+                self.write_probes,
+                coarse_slices,
+                ring_size=max(1, anomaly_window // fine_timeslice),
+                after=max(1, anomaly_window // fine_timeslice))
+        # tgid -> cpu use of the threads of every traced process
+        self.thread_load = {}
+        # thread group name -> id in the thread_names table
+        self.thread_names = {}
+        self.start_thread_load()
+        self.last_sample_time = time.monotonic()
+        # optional sampled stack profiler
+        self.profiler = None
+        if profile_frequency:
+            self.profiler = TXProfiler(
+                db=self.db,
+                targets=targets,
+                node_of=self.node_of,
+                frequency=profile_frequency,
+                transactor_only=profile_transactor_only)
+        self.latency.attach_probes()
         self.usdt_probes.attach_probes()
+        if self.profiler:
+            self.profiler.attach_probes()
         self.start_timestamp = int(time.time())
         self.commit = commit
         self.tags = tags
+        # optional OpenMetrics endpoint, updated by `update_metrics`
+        self.exporter = None
+        if metrics_port:
+            self.exporter = MetricsExporter(metrics_port, metrics_address)
+
+    def default_node_name(self, tgid):
+        return f'{socket.gethostname()}:{tgid}'
+
+    def add_node(self, tgid, name):
+        node = self.db.add_node(name)
+        self.nodes[tgid] = node
+        self.node_names[node] = name
+        return node
+
+    def node_of(self, tgid):
+        if tgid not in self.nodes:
+            return self.add_node(tgid, self.default_node_name(tgid))
+        return self.nodes[tgid]
 
     def shutdown(self):
+        if self.exporter:
+            self.exporter.close()
+        for load in self.thread_load.values():
+            load.close()
+        if self.adaptive:
+            self.adaptive.flush()
         self.db.add_collection(self.start_timestamp, int(time.time()),
-                               self.commit, self.tags)
+                               self.commit, self.tags,
+                               sorted(set(self.nodes.values())))
+        self.db.close()
+
+    def probe_diffs(self):
+        '''
+        Timings and ters of the probes since the last call, as Histograms
+        keyed on (table, probe id, tgid) and (probe id, tgid)
+        '''
+        t = self.latency
+        timings = {}
+        # inclusive and self (exclusive) time
+        for table, dists in [('timings', t.dist()),
+                             ('self_timings', t.self_dist())]:
+            for (probe_id, tgid), d in dists.items():
+                last = self.last_culm_timing.get((table, probe_id, tgid))
+                self.last_culm_timing[(table, probe_id, tgid)] = d
+                timings[(table, probe_id, tgid)] = d - last if last is not None else d
+
+        ters = {}
+        for (probe_id, tgid), h in t.ters().items():
+            if not self.probes[probe_id].ters:
+                continue
+            last = self.last_culm_ters.get((probe_id, tgid))
+            self.last_culm_ters[(probe_id, tgid)] = h
+            ters[(probe_id, tgid)] = h - last if last is not None else h
+        return timings, ters
+
+    def write_probes(self, timestamp, timings, ters):
+        '''Store a slice of timings and ters (see `probe_diffs`)'''
+        for (table, probe_id, tgid), h in timings.items():
+            self.db.add_timing(probe_id, timestamp, h, self.node_of(tgid),
+                               table)
+        for (probe_id, tgid), h in ters.items():
+            self.db.add_ters(probe_id, timestamp, h, self.node_of(tgid))
+
+    def sample_fine(self):
+        '''Sample the probes into the fine slice ring (see adaptive_slices.py)'''
+        timestamp = int(time.time())
+        reasons = self.adaptive.add(timestamp, *self.probe_diffs())
+        for r in reasons:
+            print(f'Anomaly at {timestamp}: {r}')
 
     def sample_probes(self):
-        for i, t in enumerate(self.traces):
-            d = t[2].dist()
-            timestamp = int(time.time())
-            if self.last_culm_timing[i] is not None:
-                # compute diff
-                diff = d - self.last_culm_timing[i]
-            else:
-                diff = d
-            self.last_culm_timing[i] = d
-            self.db.add_timing(t[0], timestamp, diff)
-            if t[1]:
-                results = t[2].result()
-                tecs = t[2].tecs()
-                negs = t[2].negs()
-                timestamp = int(time.time())
-                if self.last_culm_ters[i]:
-                    results_diff = results - self.last_culm_ters[i][0]
-                    tecs_diff = tecs - self.last_culm_ters[i][1]
-                    negs_diff = negs - self.last_culm_ters[i][2]
-                else:
-                    results_diff = results
-                    tecs_diff = tecs
-                    negs_diff = negs
-                self.last_culm_ters[i] = (results, tecs, negs)
-                self.db.add_ters(t[0], timestamp, results_diff, tecs_diff,
-                                 negs_diff)
+        if self.adaptive:
+            self.sample_fine()
+        else:
+            self.write_probes(int(time.time()), *self.probe_diffs())
+
+        if self.profiler:
+            self.profiler.sample(int(time.time()))
 
         self.usdt_probes.b.kprobe_poll(10)
+        if self.usdt_probes.offcpu:
+            self.sample_wait_histograms()
+        self.sample_load()
+        if self.exporter:
+            self.update_metrics(poll=False)
+
+    def update_metrics(self, poll=True):
+        '''
+        Snapshot the cumulative probe histograms, results and event counts
+        for the metrics endpoint. Scrapes are served from the snapshot.
+        '''
+        if poll:
+            self.usdt_probes.b.kprobe_poll(10)
+        t = self.latency
+        families = []
+        for name, help, dists in [
+            ('xrpl_probe_latency_seconds', 'Inclusive time of the probe', t.dist()),
+            ('xrpl_probe_self_latency_seconds',
+             'Time of the probe not spent in nested probes', t.self_dist())
+        ]:
+            families.append(
+                histogram_family(name, help, [({
+                    'probe': self.probes[probe_id].name,
+                    'node': self.node_names.get(self.node_of(tgid))
+                }, d) for (probe_id, tgid), d in sorted(dists.items())]))
+
+        series = []
+        for (probe_id, tgid), h in sorted(t.ters().items()):
+            if not self.probes[probe_id].ters:
+                continue
+            labels = {
+                'probe': self.probes[probe_id].name,
+                'node': self.node_names.get(self.node_of(tgid))
+            }
+            series.extend(({
+                **labels, 'ter': int(ter)
+            }, v) for ter, v in zip(*h.to_rows()))
+        families.append(
+            counter_family('xrpl_probe_results',
+                           'Return codes of the probe', series))
+
+        u = self.usdt_probes
+        families.append(
+            counter_family('xrpl_transactions', 'Transactions applied', [({
+                'node': self.node_names.get(node),
+                'type': tx_type_name(tx_type)
+            }, n) for (node, tx_type), n in sorted(u.tx_totals.items())]))
+        families.append(
+            counter_family(
+                'xrpl_probe_events_lost',
+                'Transaction events dropped because the perf buffer was full',
+                [({}, u.lost)]))
+        self.exporter.update(families)
+
+    def sample_load(self):
+        '''
+        Store the transactions of every type, and the cpu use and context
+        switches of the threads of every traced process, in this timeslice
+        '''
+        timestamp = int(time.time())
+        now = time.monotonic()
+        seconds = now - self.last_sample_time
+        self.last_sample_time = now
+        for node, counts in self.usdt_probes.take_tx_counts().items():
+            self.db.add_tx_counts(timestamp, seconds, counts, node)
+
+        for tgid, load in list(self.thread_load.items()):
+            try:
+                load_seconds, groups = load.sample()
+            except OSError:
+                load.close()
+                del self.thread_load[tgid]
+                continue
+            rows = []
+            for name, (threads, cpu, switches) in groups.items():
+                if name not in self.thread_names:
+                    self.thread_names[name] = self.db.add_thread_name(name)
+                rows.append((self.thread_names[name], threads, cpu, switches))
+            self.db.add_thread_load(timestamp, load_seconds, rows,
+                                    self.node_of(tgid))
+        self.start_thread_load()
+
+    def start_thread_load(self):
+        '''
+        Start sampling the threads of the traced processes not sampled yet.
+        Processes found by tracing an exe are sampled once they are seen.
+        '''
+        for tgid in self.nodes:
+            if tgid not in self.thread_load:
+                try:
+                    # the first sample is the baseline for the next timeslice
+                    self.thread_load[tgid] = ThreadLoad(tgid)
+                except OSError:
+                    continue  # the process exited
+
+    def sample_wait_histograms(self):
+        '''
+        Store the off-cpu and lock wait histograms of every transaction type
+        as timings of the `<transactor>.offcpu` and `<transactor>.lock_wait`
+        probes
+        '''
+        timestamp = int(time.time())
+        for (node, tx_type, kind), hist in self.usdt_probes.take_wait_histograms(
+        ).items():
+            name = f'{tx_type_name(tx_type)}.{kind}'
+            if name not in self.wait_probes:
+                self.wait_probes[name] = self.db.add_probe(name)
+            self.db.add_timing(self.wait_probes[name], timestamp, hist, node)
 
 
 @contextmanager
-def trace_rippled(pid, exe, commit, tags, db_file):
+def trace_rippled(pids, exes, commit, tags, db_file, **kwargs):
     """Start a trace and return a trace client"""
     try:
         client = None
-        client = TraceRippled(pid, exe, commit, tags, db_file)
+        client = TraceRippled(pids, exes, commit, tags, db_file, **kwargs)
         yield client
     finally:
         if client:
@@ -358,16 +811,55 @@ def signal_ignore(signal, frame):
     pass
 
 
-def run(pid, exe, commit, tags, db_file, timeslice, duration):
-    with trace_rippled(pid, exe, commit, tags, db_file) as t:
+def run(pids,
+        exes,
+        commit,
+        tags,
+        db_file,
+        timeslice,
+        duration,
+        metrics_interval=15,
+        fine_timeslice=0,
+        **kwargs):
+    if fine_timeslice:
+        # the fine slices are merged into slices of `timeslice` seconds. The
+        # last fine slice of a timeslice is shorter when `fine_timeslice`
+        # doesn't divide it.
+        kwargs['coarse_slices'] = max(1, math.ceil(timeslice / fine_timeslice))
+    with trace_rippled(pids, exes, commit, tags, db_file,
+                       fine_timeslice=fine_timeslice, **kwargs) as t:
         exiting = False
-        seconds = 0
+        # every kind of sample has its own deadline, advanced by its own
+        # period, so the metrics snapshot (updated more often than the db)
+        # and the fine slices don't change the length of the db slices
+        start = time.monotonic()
+        next_sample = start + timeslice
+        next_fine = start + fine_timeslice if fine_timeslice else None
+        next_metrics = start + metrics_interval if t.exporter else None
+        end = start + duration if duration > 0 else None
         while not exiting:
             try:
-                time.sleep(timeslice)
-                t.sample_probes()
-                seconds += timeslice
-                if duration > 0 and seconds >= duration:
+                deadline = min(
+                    d for d in [next_sample, next_fine, next_metrics, end]
+                    if d is not None)
+                time.sleep(max(0, deadline - time.monotonic()))
+                now = time.monotonic()
+                sampled = now >= next_sample
+                if sampled:
+                    # also samples the last fine slice of the timeslice, and
+                    # updates the metrics
+                    t.sample_probes()
+                    if next_fine is not None:
+                        next_fine = next_sample + fine_timeslice
+                    next_sample += timeslice
+                elif next_fine is not None and now >= next_fine:
+                    t.sample_fine()
+                    next_fine += fine_timeslice
+                if next_metrics is not None and now >= next_metrics:
+                    if not sampled:
+                        t.update_metrics()
+                    next_metrics += metrics_interval
+                if end is not None and now >= end:
                     exiting = True
             except KeyboardInterrupt:
                 # trap Ctrl-C:
@@ -375,17 +867,83 @@ def run(pid, exe, commit, tags, db_file, timeslice, duration):
                 exiting = True
 
 
+def comma_list(text):
+    # convert the comma separated text into a python list
+    if not text:
+        return []
+    return [i.strip() for i in text.split(',')]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Save trace probe info to a database")
-    parser.add_argument("-p", "--pid", type=int, help="trace this PID only")
-    parser.add_argument("-e", "--exe", help="executable to trace")
+    parser.add_argument(
+        "-p",
+        "--pid",
+        type=int,
+        nargs='+',
+        help="trace these PIDs only")
+    parser.add_argument(
+        "-e",
+        "--exe",
+        nargs='+',
+        help="executables to trace. Traces every process running them if no pid is given")
+    parser.add_argument(
+        "-n",
+        "--node-names",
+        help=
+        "Comma separated list of names for the traced pids, in order. Defaults to host:pid"
+    )
+    parser.add_argument(
+        "--catalog",
+        default=DEFAULT_CATALOG,
+        help="Probe catalog (json) with the functions to time")
+    parser.add_argument(
+        "--offcpu",
+        action='store_true',
+        help="Collect the time transactions spend switched out and waiting on futexes")
+    parser.add_argument(
+        "--profile-frequency",
+        type=int,
+        default=0,
+        help="Sample the user stacks of the traced pids this many times a second. 0 disables profiling")
+    parser.add_argument(
+        "--profile-transactor-only",
+        action='store_true',
+        help="Only sample threads running Transactor::operator()")
+    parser.add_argument(
+        "--segments",
+        action='store_true',
+        help="Write transactions, timings and ters to segment logs rather than sqlite, for high transaction rates")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve the probe histograms and counters in the OpenMetrics format on this port")
+    parser.add_argument(
+        "--metrics-address",
+        default='',
+        help="Address the metrics endpoint listens on. Defaults to all addresses")
+    parser.add_argument(
+        "--metrics-interval",
+        type=int,
+        default=15,
+        help="Seconds between snapshots of the metrics endpoint")
     parser.add_argument(
         "-s",
         "--timeslice",
         type=int,
         help="Timeslice length, in seconds",
         default=600)
+    parser.add_argument(
+        "--fine-timeslice",
+        type=int,
+        default=0,
+        help="Sample the probes every this many seconds, and store these fine slices around latency anomalies. Other slices are stored at the --timeslice length. 0 disables it")
+    parser.add_argument(
+        "--anomaly-window",
+        type=int,
+        default=120,
+        help="Seconds of fine slices stored before and after an anomaly")
     parser.add_argument(
         "-d",
         "--duration",
@@ -407,9 +965,22 @@ if __name__ == '__main__':
     )
     args = parser.parse_args()
 
-    tags = []
-    if args.tags:
-        # convert the comma separated text into a python list
-        tags = [i.strip() for i in args.tags.split(',')]
-    run(args.pid, args.exe, args.commit, tags, args.db, args.timeslice,
-        args.duration)
+    tags = comma_list(args.tags)
+    run(args.pid,
+        args.exe,
+        args.commit,
+        tags,
+        args.db,
+        args.timeslice,
+        args.duration,
+        node_names=comma_list(args.node_names),
+        catalog_file=args.catalog,
+        offcpu=args.offcpu,
+        profile_frequency=args.profile_frequency,
+        profile_transactor_only=args.profile_transactor_only,
+        metrics_port=args.metrics_port,
+        metrics_address=args.metrics_address,
+        metrics_interval=args.metrics_interval,
+        segments=args.segments,
+        fine_timeslice=args.fine_timeslice,
+        anomaly_window=args.anomaly_window)
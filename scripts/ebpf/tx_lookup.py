@@ -0,0 +1,354 @@
+#/usr/bin/env python
+#
+# tx_lookup     Find transactions by id across all the collections of one or
+#               more collection databases. Every collection gets an index of
+#               its sorted binary transaction ids and a Bloom filter, stored
+#               in the `tx_index` table the first time the collection is
+#               searched. The Bloom filter skips the collections that can't
+#               have an id, and the ids that pass are found by binary search.
+
+import argparse
+import glob
+import numpy as np
+import os
+import pandas as pd
+import re
+import sqlite3
+import sys
+
+from segment_log import read_segments, segment_dir, tx_rows
+
+# ~1% false positives
+BLOOM_BITS_PER_ID = 10
+BLOOM_HASHES = 7
+
+# sqlite's limit on the number of parameters of a statement
+MAX_PARAMETERS = 900
+
+
+HEX_ID = re.compile('[0-9A-Fa-f]{64}')
+
+
+def id_array(hex_ids):
+    '''
+    Binary (32 byte) ids of hex transaction ids. Raises ValueError naming the
+    ids that aren't 64 hex digits.
+    '''
+    if len(hex_ids) == 0:
+        return np.zeros(0, 'S32')
+    bad = [i for i in hex_ids if not HEX_ID.fullmatch(i)]
+    if bad:
+        raise ValueError(f'Invalid transaction ids: {", ".join(bad)}')
+    return np.frombuffer(bytes.fromhex(''.join(hex_ids)), dtype='S32')
+
+
+def _bloom_positions(ids, num_bits):
+    # transaction ids are hashes, so words of the id are already independent
+    # uniform hashes
+    words = np.frombuffer(ids.tobytes(), dtype='<u4').reshape(-1, 8)
+    return words[:, :BLOOM_HASHES].astype(np.uint64) % np.uint64(num_bits)
+
+
+def bloom_filter(ids):
+    # whole bytes, so the size can be recovered from the packed filter
+    num_bits = max((len(ids) * BLOOM_BITS_PER_ID + 7) // 8 * 8, 8)
+    bits = np.zeros(num_bits, dtype=bool)
+    bits[_bloom_positions(ids, num_bits).ravel()] = True
+    return np.packbits(bits)
+
+
+def bloom_contains(bloom, ids):
+    '''Mask of the ids that may be in the filter'''
+    if len(ids) == 0:
+        return np.zeros(0, dtype=bool)
+    positions = _bloom_positions(ids, len(bloom) * 8)
+    # packbits stores the first bit in the high bit of a byte
+    set_bits = bloom[positions >> np.uint64(3)] & (
+        np.uint8(0x80) >> (positions & np.uint64(7)).astype(np.uint8))
+    return np.all(set_bits != 0, axis=1)
+
+
+class CollectionIndex:
+    '''Sorted binary ids of the transactions of a collection, and their rowids'''
+
+    def __init__(self, ids, rowids, bloom):
+        self.ids = ids
+        self.rowids = rowids
+        self.bloom = bloom
+
+    def find(self, ids):
+        '''Return the indexes into `ids` found in the collection, and their rowids'''
+        candidates = np.flatnonzero(bloom_contains(self.bloom, ids))
+        if len(candidates) == 0 or len(self.ids) == 0:
+            return candidates[:0], self.rowids[:0]
+        pos = np.searchsorted(self.ids, ids[candidates])
+        pos[pos == len(self.ids)] = 0
+        found = self.ids[pos] == ids[candidates]
+        return candidates[found], self.rowids[pos[found]]
+
+
+class TxIndexDB:
+    def __init__(self, file_name):
+        # connecting would create an empty db
+        if not os.path.isfile(file_name):
+            raise ValueError(f'{file_name} does not exist')
+        self.file_name = file_name
+        self.conn = sqlite3.connect(file_name)
+        self.collections = pd.read_sql_query(
+            'select * from collections order by start;',
+            self.conn,
+            index_col='id')
+        try:
+            # `max_rowid` is the largest rowid of the transactions table when
+            # the index was built, so only the rows added since then need to
+            # be checked to know if it's still current (see `index`)
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tx_index (collection_id INTEGER PRIMARY KEY,
+                   count INTEGER, ids BLOB, rowids BLOB, bloom BLOB,
+                   max_rowid INTEGER);
+            ''')
+            columns = [
+                r[1] for r in self.conn.execute('PRAGMA table_info(tx_index);')
+            ]
+            if 'max_rowid' not in columns:
+                # indexes stored before, they're rebuilt the first time
+                self.conn.execute(
+                    'ALTER TABLE tx_index ADD COLUMN max_rowid INTEGER;')
+            self.conn.commit()
+            self.writable = True
+        except sqlite3.OperationalError:
+            # read only db, indexes are built every time
+            self.writable = False
+
+    def _has_table(self, name):
+        c = self.conn.cursor()
+        c.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?;",
+            (name, ))
+        return c.fetchone()[0] != 0
+
+    def _where_clause(self, collection_id):
+        start, end = self.collections.loc[collection_id, ['start', 'end']]
+        where_clause = f'where timestamp >= {start} and timestamp <= {end}'
+        if self._has_table('collection_nodes'):
+            c = self.conn.cursor()
+            c.execute(
+                'select node from collection_nodes where collection_id = ?;',
+                (int(collection_id), ))
+            nodes = [r[0] for r in c.fetchall()]
+            if nodes:
+                where_clause += f' and node in ({",".join(map(str, nodes))})'
+        return where_clause
+
+    def _max_rowid(self):
+        # the last row of the table's b-tree, no scan
+        return self.conn.execute(
+            'select max(rowid) from transactions;').fetchone()[0] or 0
+
+    def build_index(self, collection_id):
+        c = self.conn.cursor()
+        max_rowid = self._max_rowid()
+        c.execute(
+            f'select rowid, id from transactions {self._where_clause(collection_id)};'
+        )
+        rows = c.fetchall()
+        rowids = np.array([r[0] for r in rows], dtype=np.int64)
+        ids = id_array([r[1] for r in rows])
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        rowids = rowids[order]
+        bloom = bloom_filter(ids)
+        if self.writable:
+            c.execute(
+                'INSERT OR REPLACE INTO tx_index (collection_id, count, ids, rowids, bloom, max_rowid) VALUES (?, ?, ?, ?, ?, ?);',
+                (int(collection_id), len(ids), ids.tobytes(),
+                 rowids.tobytes(), bloom.tobytes(), max_rowid))
+            self.conn.commit()
+        return CollectionIndex(ids, rowids, bloom)
+
+    def index(self, collection_id, rebuild=False):
+        '''
+        The stored index of the collection, rebuilt if transactions of the
+        collection were added since it was built (merged or compacted into
+        the db). Only the rows added since are read to find out.
+        '''
+        if self.writable and not rebuild:
+            c = self.conn.cursor()
+            c.execute(
+                'select ids, rowids, bloom, max_rowid from tx_index where collection_id = ?;',
+                (int(collection_id), ))
+            r = c.fetchone()
+            if r and r[3] is not None and self._current(collection_id, r[3]):
+                return CollectionIndex(
+                    np.frombuffer(r[0], dtype='S32'),
+                    np.frombuffer(r[1], dtype=np.int64),
+                    np.frombuffer(r[2], dtype=np.uint8))
+        return self.build_index(collection_id)
+
+    def _current(self, collection_id, built_max_rowid):
+        '''
+        If an index built when the largest rowid was `built_max_rowid` still
+        has all the transactions of the collection
+        '''
+        max_rowid = self._max_rowid()
+        if max_rowid == built_max_rowid:
+            return True
+        if max_rowid < built_max_rowid:
+            # rows were removed
+            return False
+        # a rowid range, not a scan of the table
+        c = self.conn.cursor()
+        c.execute(
+            f'select count(*) from transactions {self._where_clause(collection_id)} and rowid > ?;',
+            (built_max_rowid, ))
+        if c.fetchone()[0]:
+            return False
+        # none of the new rows are the collection's, don't look at them again
+        c.execute(
+            'UPDATE tx_index SET max_rowid = ? WHERE collection_id = ?;',
+            (max_rowid, int(collection_id)))
+        self.conn.commit()
+        return True
+
+    def _rows(self, rowids):
+        '''Transactions with the given rowids'''
+        parts = []
+        for i in range(0, len(rowids), MAX_PARAMETERS):
+            chunk = [int(r) for r in rowids[i:i + MAX_PARAMETERS]]
+            parts.append(
+                pd.read_sql_query(
+                    f'select rowid, * from transactions where rowid in ({",".join("?" * len(chunk))});',
+                    self.conn,
+                    params=chunk))
+        return pd.concat(parts, ignore_index=True)
+
+    def _node_names(self):
+        if not self._has_table('nodes'):
+            return {0: 'default'}
+        return dict(self.conn.execute('select id, name from nodes;').fetchall())
+
+    def lookup(self, ids, rebuild=False):
+        '''
+        Return the transactions with the binary `ids` (see `id_array`) in any
+        collection of the db, along with the collection they are in
+        '''
+        found = []
+        for collection_id in self.collections.index:
+            _, rowids = self.index(collection_id, rebuild).find(ids)
+            if len(rowids) == 0:
+                continue
+            df = self._rows(rowids)
+            df['collection_id'] = collection_id
+            found.append(df)
+        segments = self._lookup_segments(ids)
+        if segments is not None:
+            found.append(segments)
+        if not found:
+            return None
+        df = pd.concat(found, ignore_index=True).drop(
+            columns=['rowid'], errors='ignore')
+        collections = self.collections.rename(columns={
+            'start': 'collection_start',
+            'end': 'collection_end'
+        })
+        df = df.join(collections, on='collection_id')
+        if 'node' not in df:
+            df['node'] = 0
+        df['node_name'] = df['node'].map(self._node_names())
+        df['db'] = self.file_name
+        return df
+
+    def _lookup_segments(self, ids):
+        '''Transactions in segment logs that were not compacted into the db'''
+        directory = segment_dir(self.file_name)
+        if not os.path.isdir(directory):
+            return None
+        records = read_segments(directory, 'tx')
+        # S32 values are equal exactly when all their 32 bytes are
+        records = records[np.isin(records['id'].view('S32'), ids)]
+        if len(records) == 0:
+            return None
+        df = pd.DataFrame(tx_rows(records))
+        # segments are associated with a collection by time
+        parts = []
+        for collection_id, start, end in zip(self.collections.index,
+                                             self.collections['start'],
+                                             self.collections['end']):
+            part = df[(df['timestamp'] >= start) & (df['timestamp'] <= end)]
+            parts.append(part.assign(collection_id=collection_id))
+        return pd.concat(parts, ignore_index=True)
+
+
+def db_files(sources):
+    '''Expand directories into the db files they contain'''
+    result = []
+    for s in sources:
+        if os.path.isdir(s):
+            result.extend(sorted(glob.glob(os.path.join(s, '*.db'))))
+        else:
+            result.append(s)
+    return result
+
+
+def lookup(sources, tx_ids, rebuild=False):
+    '''
+    Find the hex transaction ids in the collection dbs (files or directories
+    of db files). Returns a data frame with a row for every collection a
+    transaction is in, or an empty data frame if none is found.
+    '''
+    ids = np.unique(id_array([i.strip().upper() for i in tx_ids]))
+    found = []
+    for f in db_files(sources):
+        try:
+            df = TxIndexDB(f).lookup(ids, rebuild)
+        except (sqlite3.Error, pd.errors.DatabaseError, ValueError) as e:
+            print(f'Skipping {f}: {e}', file=sys.stderr)
+            continue
+        if df is not None:
+            found.append(df)
+    if not found:
+        return pd.DataFrame()
+    columns = [
+        'id', 'duration', 'type', 'ter', 'timestamp', 'node_name',
+        'collection_id', 'collection_start', 'collection_end', 'git_commit',
+        'db'
+    ]
+    df = pd.concat(found, ignore_index=True)
+    return df[[c for c in columns if c in df]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Find transactions by id in collection databases")
+    parser.add_argument(
+        "--db",
+        required=True,
+        action='append',
+        help="Collection database, or directory of .db files, to search. May be repeated")
+    parser.add_argument(
+        "-f",
+        "--file",
+        help="File with a transaction id on every line. - reads stdin")
+    parser.add_argument(
+        "--rebuild",
+        action='store_true',
+        help="Rebuild the indexes of the collections")
+    parser.add_argument("--csv", action='store_true', help="Print csv")
+    parser.add_argument("ids", nargs='*', help="Transaction ids (hex)")
+    args = parser.parse_args()
+
+    tx_ids = list(args.ids)
+    if args.file:
+        with (sys.stdin if args.file == '-' else open(args.file)) as file:
+            tx_ids.extend(line.strip() for line in file if line.strip())
+    try:
+        result = lookup(args.db, tx_ids, args.rebuild)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if result.empty:
+        print('No transactions found')
+    elif args.csv:
+        result.to_csv(sys.stdout, index=False)
+    else:
+        print(result.to_string(index=False))
@@ -0,0 +1,52 @@
+#include <uapi/linux/ptrace.h>
+#include <uapi/linux/bpf_perf_event.h>
+
+struct stack_key_t {
+  u32 tgid;
+  int user_stack_id;
+};
+
+// sample counts are kept in the kernel, user space only reads the unique
+// stacks once per timeslice
+BPF_HASH(counts, struct stack_key_t, u64, MAX_STACKS);
+BPF_STACK_TRACE(stack_traces, MAX_STACKS);
+// threads currently inside Transactor::operator()
+BPF_HASH(in_transactor, u32, u64);
+
+int trace_transactor_entry(struct pt_regs *ctx) {
+  u64 pid_tgid = bpf_get_current_pid_tgid();
+  u32 pid = pid_tgid;
+  u32 tgid = pid_tgid >> 32;
+  u64 one = 1;
+
+  FILTER
+  in_transactor.update(&pid, &one);
+
+  return 0;
+}
+
+int trace_transactor_return(struct pt_regs *ctx) {
+  u32 pid = bpf_get_current_pid_tgid();
+  in_transactor.delete(&pid);
+  return 0;
+}
+
+int do_perf_event(struct bpf_perf_event_data *ctx) {
+  u64 pid_tgid = bpf_get_current_pid_tgid();
+  u32 pid = pid_tgid;
+  u32 tgid = pid_tgid >> 32;
+
+  FILTER
+  if (TRANSACTOR_ONLY && in_transactor.lookup(&pid) == 0) {
+    return 0;
+  }
+
+  struct stack_key_t key = {.tgid = tgid};
+  key.user_stack_id = stack_traces.get_stackid(&ctx->regs, BPF_F_USER_STACK);
+  if (key.user_stack_id < 0) {
+    return 0; // missed stack (the map is full, or no user stack)
+  }
+  counts.increment(key);
+
+  return 0;
+}
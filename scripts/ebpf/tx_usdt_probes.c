@@ -9,9 +9,30 @@ struct tx_exit_data_t
     int ter;
     u64 duration;
     u8 id[32];
+    // process the transaction ran in, so one program can trace several nodes
+    u32 tgid;
+    u32 pad;
+    // time the thread was switched out, and waiting on a futex, while the
+    // transaction was in progress. Only collected in off-cpu mode.
+    u64 offcpu;
+    u64 futex;
 };
 
-BPF_HASH(start, u32);
+// Deepest nesting of Transactor::operator() on one thread
+#define MAX_DEPTH 4
+
+// Start times of the transactors in progress on a thread, so a transactor
+// applied while another is in progress doesn't overwrite its start time
+struct start_stack_t
+{
+    u32 depth;
+    u32 pad;
+    u64 start[MAX_DEPTH];
+    u64 offcpu[MAX_DEPTH];
+    u64 futex[MAX_DEPTH];
+};
+
+BPF_HASH(start, u32, struct start_stack_t);
 BPF_PERF_OUTPUT(exit_data);
 
 int
@@ -24,13 +45,119 @@ trace_txn_entry(struct pt_regs* ctx)
 
     FILTER
 
-    start.update(&pid, &ts);
+    struct start_stack_t* s = start.lookup(&pid);
+    if (s == 0)
+    {
+        struct start_stack_t empty = {};
+        start.update(&pid, &empty);
+        s = start.lookup(&pid);
+        if (s == 0)
+        {
+            return 0;
+        }
+    }
+    u32 depth = s->depth;
+    if (depth >= MAX_DEPTH)
+    {
+        // exits were missed (an exception unwound the transactor), start over
+        depth = 0;
+    }
+    s->start[depth] = ts;
+    s->offcpu[depth] = 0;
+    s->futex[depth] = 0;
+    s->depth = depth + 1;
 
     return 0;
 }
 
-int
-trace_txn_exit(struct pt_regs* ctx)
+#if OFFCPU
+// thread id -> when a thread with a transaction in progress was switched out
+BPF_HASH(offcpu_start, u32, u64, 10240);
+// thread id -> when a thread with a transaction in progress started a futex wait
+BPF_HASH(futex_start, u32, u64, 10240);
+
+// add the wait to the innermost transaction in progress on the thread
+static inline void
+add_wait(u32 pid, u64 delta, int is_futex)
+{
+    struct start_stack_t* s = start.lookup(&pid);
+    if (s == 0)
+    {
+        return;
+    }
+    u32 top = s->depth - 1;
+    if (top >= MAX_DEPTH)
+    {
+        return;  // no transaction in progress
+    }
+    if (is_futex)
+        s->futex[top] += delta;
+    else
+        s->offcpu[top] += delta;
+}
+
+TRACEPOINT_PROBE(sched, sched_switch)
+{
+    u64 ts = bpf_ktime_get_ns();
+    u32 prev = args->prev_pid;
+    u32 next = args->next_pid;
+
+    struct start_stack_t* s = start.lookup(&prev);
+    if (s != 0 && s->depth > 0)
+    {
+        offcpu_start.update(&prev, &ts);
+    }
+
+    u64* tsp = offcpu_start.lookup(&next);
+    if (tsp != 0)
+    {
+        add_wait(next, ts - *tsp, 0);
+        offcpu_start.delete(&next);
+    }
+    return 0;
+}
+
+TRACEPOINT_PROBE(syscalls, sys_enter_futex)
+{
+    // the ops that block: FUTEX_WAIT, FUTEX_LOCK_PI, FUTEX_WAIT_BITSET,
+    // FUTEX_WAIT_REQUEUE_PI and FUTEX_LOCK_PI2, without the private and clock
+    // flags
+    int cmd = args->op & 0x7f;
+    if (cmd != 0 && cmd != 6 && cmd != 9 && cmd != 11 && cmd != 13)
+    {
+        return 0;
+    }
+    u32 pid = bpf_get_current_pid_tgid();
+    struct start_stack_t* s = start.lookup(&pid);
+    if (s == 0 || s->depth == 0)
+    {
+        return 0;
+    }
+    u64 ts = bpf_ktime_get_ns();
+    futex_start.update(&pid, &ts);
+    return 0;
+}
+
+TRACEPOINT_PROBE(syscalls, sys_exit_futex)
+{
+    u32 pid = bpf_get_current_pid_tgid();
+    u64* tsp = futex_start.lookup(&pid);
+    if (tsp == 0)
+    {
+        return 0;
+    }
+    add_wait(pid, bpf_ktime_get_ns() - *tsp, 1);
+    futex_start.delete(&pid);
+    return 0;
+}
+#endif
+
+// Shared by every `trace_txn_exit_N` function. bcc resolves
+// `bpf_usdt_readarg` against the enclosing function's USDT context, so there
+// is one generated exit function per traced process (see USDT_EXIT_FUNCTIONS)
+// and they all read their arguments and call this.
+static inline int
+txn_exit(struct pt_regs* ctx, uint64_t id_addr, uint64_t type_addr, uint64_t ter_addr)
 {
     u64 pid_tgid = bpf_get_current_pid_tgid();
     u32 pid = pid_tgid;
@@ -39,26 +166,39 @@ trace_txn_exit(struct pt_regs* ctx)
 
     FILTER
 
-    struct tx_exit_data_t data;
+    struct tx_exit_data_t data = {};
 
-    // calculate delta time
-    u64* tsp = start.lookup(&pid);
-    if (tsp == 0)
+    // calculate delta time from the innermost transactor in progress
+    struct start_stack_t* s = start.lookup(&pid);
+    if (s == 0)
     {
         return 0;  // missed start
     }
-    data.duration = bpf_ktime_get_ns() - *tsp;
-    start.delete(&pid);
+    u32 depth = s->depth;
+    if (depth == 0 || depth > MAX_DEPTH)
+    {
+        return 0;  // missed start
+    }
+    depth -= 1;
+    data.duration = ts - s->start[depth];
+    data.offcpu = s->offcpu[depth];
+    data.futex = s->futex[depth];
+    if (depth > 0)
+    {
+        // the waits are also part of the enclosing transaction
+        s->offcpu[depth - 1] += data.offcpu;
+        s->futex[depth - 1] += data.futex;
+    }
+    s->depth = depth;
 
-    uint64_t addr;
-    bpf_usdt_readarg(1, ctx, &addr);
-    bpf_probe_read(data.id, 32 * sizeof(u8), (void*)addr);
-    bpf_usdt_readarg(2, ctx, &addr);
+    data.tgid = tgid;
+    bpf_probe_read(data.id, 32 * sizeof(u8), (void*)id_addr);
     int typeAsInt;
-    bpf_probe_read(&typeAsInt, sizeof(int), (void*)addr);
+    bpf_probe_read(&typeAsInt, sizeof(int), (void*)type_addr);
     data.type = typeAsInt;
-    bpf_usdt_readarg(3, ctx, &addr);
-    bpf_probe_read(&data.ter, sizeof(int), (void*)addr);
+    bpf_probe_read(&data.ter, sizeof(int), (void*)ter_addr);
     exit_data.perf_submit(ctx, &data, sizeof(data));
     return 0;
 }
+
+USDT_EXIT_FUNCTIONS